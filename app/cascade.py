@@ -0,0 +1,90 @@
+import json
+import re
+import threading
+from collections import deque
+from typing import Optional, Tuple
+
+from app.config import settings
+
+SMALL_TIER = "small"
+LARGE_TIER = "large"
+
+_LABEL_RE = re.compile(r'\b(SPAM|Unwanted|Important)\b', re.IGNORECASE)
+_CONFIDENCE_RE = re.compile(r'(?<![\w.])(0?\.\d+|1(?:\.0+)?|0)(?![\w.])')
+_LABELS = {"spam": "SPAM", "unwanted": "Unwanted", "important": "Important"}
+
+def parse_label_and_confidence(content: str) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Reads a label and a 0-1 confidence from a small-model answer such as
+    "SPAM 0.93", "Important (confidence: 0.6)" or a JSON object. Either part is
+    None when it cannot be found.
+    """
+    text = (content or "").strip()
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            label = _LABELS.get(str(data.get("classification", "")).lower())
+            confidence = data.get("confidence")
+            return label, float(confidence) if isinstance(confidence, (int, float)) else None
+    except ValueError:
+        pass
+    label_match = _LABEL_RE.search(text)
+    label = _LABELS[label_match.group(1).lower()] if label_match else None
+    rest = text[label_match.end():] if label_match else text
+    confidence_match = _CONFIDENCE_RE.search(rest)
+    return label, float(confidence_match.group(1)) if confidence_match else None
+
+def needs_escalation(label: Optional[str], confidence: Optional[float]) -> bool:
+    """
+    Decides whether a small-model answer must be confirmed by the large model:
+    unparseable or unsure answers, and every 'Important' label, because that
+    one triggers an automatic reply.
+    """
+    if label is None or confidence is None or label == "Important":
+        return True
+    return confidence < settings.CASCADE_CONFIDENCE_THRESHOLD
+
+class CascadeStats:
+    """
+    Per-tier counters and recent latencies of the classification cascade:
+    how many emails each tier settled, how many the small tier escalated, and
+    p50/p95 request latency, for tuning CASCADE_CONFIDENCE_THRESHOLD.
+    """
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._tiers = {
+            tier: {"requests": 0, "settled": 0, "escalated": 0, "latencies": deque(maxlen=window)}
+            for tier in (SMALL_TIER, LARGE_TIER)
+        }
+
+    def record(self, tier: str, latency: float, settled: int = 0, escalated: int = 0):
+        with self._lock:
+            stats = self._tiers[tier]
+            stats["requests"] += 1
+            stats["settled"] += settled
+            stats["escalated"] += escalated
+            stats["latencies"].append(latency)
+
+    def summary(self) -> dict:
+        with self._lock:
+            result = {}
+            for tier, stats in self._tiers.items():
+                latencies = sorted(stats["latencies"])
+                result[tier] = {
+                    "requests": stats["requests"],
+                    "settled": stats["settled"],
+                    "escalated": stats["escalated"],
+                    "p50_seconds": _percentile(latencies, 0.50),
+                    "p95_seconds": _percentile(latencies, 0.95),
+                }
+            return result
+
+def _percentile(sorted_values: list, fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 4)
+
+# Shared statistics, logged after every mailbox check while the cascade is enabled
+cascade_stats = CascadeStats()
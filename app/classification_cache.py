@@ -0,0 +1,224 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from app import database
+from app.config import settings
+
+# SimHash fingerprints are split into 4 bands of 16 bits. Two fingerprints within
+# a Hamming distance of 3 must share at least one band exactly (pigeonhole), so
+# near-duplicate candidates can be found with indexed equality lookups.
+SIMHASH_BITS = 64
+BAND_COUNT = 4
+BAND_BITS = SIMHASH_BITS // BAND_COUNT
+BAND_MASK = (1 << BAND_BITS) - 1
+
+_URL_RE = re.compile(r'https?://\S+|www\.\S+')
+_DIGITS_RE = re.compile(r'\d+')
+_TOKEN_RE = re.compile(r'\w+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes email text so trivially different copies of a campaign compare equal:
+    lowercases, masks URLs and numbers (tracking links, dates, order numbers)
+    and collapses whitespace.
+    """
+    text = (text or "").lower()
+    text = _URL_RE.sub(" url ", text)
+    text = _DIGITS_RE.sub("0", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+def content_hash(subject: str, body: str) -> str:
+    """Returns the exact-match cache key for the normalized subject and body."""
+    normalized = normalize_text(subject) + "\n" + normalize_text(body)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def simhash(text: str) -> int:
+    """
+    Computes a 64-bit SimHash over word 3-shingles of the normalized text.
+    Similar texts produce fingerprints with a small Hamming distance.
+    """
+    tokens = _TOKEN_RE.findall(normalize_text(text))
+    if len(tokens) >= 3:
+        shingles = [" ".join(tokens[i:i + 3]) for i in range(len(tokens) - 2)]
+    else:
+        shingles = tokens or [""]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def _bands(fingerprint: int) -> list[int]:
+    return [(fingerprint >> (i * BAND_BITS)) & BAND_MASK for i in range(BAND_COUNT)]
+
+class ClassificationCache:
+    """
+    Persistent cache of LLM classifications stored in the 'classification_cache'
+    table of emails.db. Lookups try an exact hash of the normalized content first,
+    then a SimHash near-duplicate match. Entries expire after `ttl_seconds` and
+    the least recently used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, max_distance: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = min(max_distance, BAND_COUNT - 1) # Band lookup only guarantees recall up to 3 bits
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._initialized_for = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = database.get_connection()
+        if self._initialized_for != database.DATABASE_FILE:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS classification_cache (
+                    content_hash TEXT PRIMARY KEY,
+                    simhash INTEGER NOT NULL,
+                    band0 INTEGER NOT NULL,
+                    band1 INTEGER NOT NULL,
+                    band2 INTEGER NOT NULL,
+                    band3 INTEGER NOT NULL,
+                    classification TEXT NOT NULL,
+                    hit_count INTEGER DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_cache_band0 ON classification_cache (band0);
+                CREATE INDEX IF NOT EXISTS idx_cache_band1 ON classification_cache (band1);
+                CREATE INDEX IF NOT EXISTS idx_cache_band2 ON classification_cache (band2);
+                CREATE INDEX IF NOT EXISTS idx_cache_band3 ON classification_cache (band3);
+                CREATE INDEX IF NOT EXISTS idx_cache_last_used ON classification_cache (last_used_at);
+            """)
+            self._initialized_for = database.DATABASE_FILE
+        return conn
+
+    def get(self, subject: str, body: str) -> Optional[str]:
+        """
+        Returns the cached classification for this content, or None on a miss.
+        """
+        key = content_hash(subject, body)
+        now = time.time()
+        min_created = now - self.ttl_seconds
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    "SELECT classification FROM classification_cache WHERE content_hash = ? AND created_at >= ?",
+                    (key, min_created)
+                ).fetchone()
+                if row:
+                    self._touch(conn, key, now)
+                    self.exact_hits += 1
+                    return row[0]
+
+                if self.max_distance >= 0:
+                    fingerprint = simhash(subject + " " + body)
+                    bands = _bands(fingerprint)
+                    candidates = conn.execute(
+                        """
+                        SELECT content_hash, simhash, classification FROM classification_cache
+                        WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND created_at >= ?
+                        """,
+                        (*bands, min_created)
+                    ).fetchall()
+                    best = None
+                    for candidate_key, candidate_hash, classification in candidates:
+                        distance = hamming_distance(fingerprint, _to_unsigned(candidate_hash))
+                        if distance <= self.max_distance and (best is None or distance < best[0]):
+                            best = (distance, candidate_key, classification)
+                    if best:
+                        self._touch(conn, best[1], now)
+                        self.near_hits += 1
+                        return best[2]
+
+                self.misses += 1
+                return None
+
+    def put(self, subject: str, body: str, classification: str):
+        """
+        Stores a classification for this content and evicts expired and
+        least recently used entries.
+        """
+        key = content_hash(subject, body)
+        fingerprint = simhash(subject + " " + body)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self.evictions += self._insert_and_evict(conn, key, fingerprint, classification, now)
+            except Exception as e:
+                print(f"Error storing classification cache entry: {e}")
+
+    def _insert_and_evict(self, conn: sqlite3.Connection, key: str, fingerprint: int, classification: str, now: float) -> int:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO classification_cache
+                (content_hash, simhash, band0, band1, band2, band3, classification, hit_count, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+            """,
+            (key, _to_signed(fingerprint), *_bands(fingerprint), classification, now, now)
+        )
+        evicted = conn.execute(
+            "DELETE FROM classification_cache WHERE created_at < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM classification_cache").fetchone()[0]
+        if count > self.max_entries:
+            evicted += conn.execute(
+                """
+                DELETE FROM classification_cache WHERE content_hash IN (
+                    SELECT content_hash FROM classification_cache ORDER BY last_used_at ASC LIMIT ?
+                )
+                """,
+                (count - self.max_entries,)
+            ).rowcount
+        return evicted
+
+    def _touch(self, conn: sqlite3.Connection, key: str, now: float):
+        conn.execute(
+            "UPDATE classification_cache SET hit_count = hit_count + 1, last_used_at = ? WHERE content_hash = ?",
+            (now, key)
+        )
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters for this process."""
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+# Shared cache used by the classification nodes
+classification_cache = ClassificationCache(
+    max_entries=settings.CLASSIFICATION_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.CLASSIFICATION_CACHE_TTL_SECONDS,
+    max_distance=settings.CLASSIFICATION_CACHE_MAX_DISTANCE,
+)
@@ -14,5 +14,60 @@ class Settings(BaseSettings):
     EMAIL_APP_PASSWORD: str
     API_KEY: str
 
+    # Mailbox sync
+    MAIL_USE_TLS: bool = True # IMAP over implicit TLS and SMTP STARTTLS; disable only for local test servers such as the benchmark stand-ins
+    IMAP_MAILBOX: str = "inbox"
+    MAIL_SYNC_MODE: str = "uid" # "uid": incremental UID watermark sync, "unseen": SEARCH UNSEEN on every run
+    IMAP_IDLE_ENABLED: bool = False # Process new mail as soon as it arrives via IMAP IDLE
+    IMAP_IDLE_TIMEOUT_SECONDS: int = 600 # Re-issue IDLE this often (servers drop IDLE after ~29 minutes)
+    IMAP_FETCH_CHUNK_SIZE: int = 50 # Messages downloaded per FETCH round trip and processed per batch
+    IMAP_FETCH_MODE: str = "full" # "full" downloads whole messages; "structure" reads BODYSTRUCTURE and fetches only headers and the text part
+    IMAP_HEALTHCHECK_INTERVAL_SECONDS: float = 30 # Send NOOP before reusing a session idle for longer than this
+    SMTP_IDLE_TIMEOUT_SECONDS: float = 60 # Send NOOP before reusing an SMTP session idle for longer than this
+    SMTP_MAX_MESSAGES_PER_SESSION: int = 100 # Reconnect after this many messages on one SMTP connection
+    PIPELINE_QUEUE_SIZE: int = 100 # Emails buffered between two ingest stages (fetch, parse, classify, reply, store); bounds memory whatever the backlog
+    DB_WRITE_BATCH_SIZE: int = 50 # Processed emails written to SQLite per transaction
+    EXPORT_FETCH_SIZE: int = 1000 # Rows read from SQLite per chunk when streaming /export
+    JOB_HISTORY_SIZE: int = 100 # Finished /check-mails jobs kept for GET /jobs/{id}
+    POLLER_ENABLED: bool = True # Check the mailbox periodically from inside the app instead of an external cron
+    POLL_MIN_INTERVAL_SECONDS: float = 15 # Poll interval while mail is flowing
+    POLL_MAX_INTERVAL_SECONDS: float = 300 # Upper bound of the interval while the inbox is idle
+    POLL_BACKOFF_FACTOR: float = 2.0 # Interval multiplier after each poll that found no mail
+
+    # Reply outbox
+    OUTBOX_POLL_INTERVAL_SECONDS: float = 5 # How often the dispatcher looks for due replies
+    OUTBOX_BATCH_SIZE: int = 50 # Replies sent per dispatcher round
+    OUTBOX_MAX_ATTEMPTS: int = 8 # Give up on a reply after this many failed sends
+    OUTBOX_BASE_BACKOFF_SECONDS: float = 30 # First retry delay, doubled on every further attempt
+    OUTBOX_MAX_BACKOFF_SECONDS: float = 3600
+    OUTBOX_LEASE_SECONDS: float = 300 # A reply claimed by a crashed dispatcher becomes due again after this
+
+    # Classification tuning
+    PARALLEL_CLASSIFICATION: bool = True # Classify a whole batch concurrently before running the graph
+    LLM_MODEL: str = "llama3-8b-8192" # Groq model used for classification
+    LLM_LARGE_MODEL: str = "llama3-70b-8192" # Second tier of the cascade
+    CASCADE_ENABLED: bool = False # Ask the small model for a confidence and send only unsure or 'Important' emails to the large model
+    CASCADE_CONFIDENCE_THRESHOLD: float = 0.8 # Small-model answers below this confidence are escalated
+    LLM_MAX_CONCURRENCY: int = 8 # Maximum number of in-flight LLM requests in parallel mode
+    LLM_REQUESTS_PER_MINUTE: int = 30 # Client-side request budget; match your Groq plan
+    LLM_TOKENS_PER_MINUTE: int = 30000 # Client-side token budget; match your Groq plan
+    LLM_MAX_RETRIES: int = 4 # Retries of rate-limited or failed LLM calls before deferring the email
+    LLM_RETRY_BASE_SECONDS: float = 1 # First retry delay when the server sends no Retry-After
+    LLM_RETRY_MAX_SECONDS: float = 60
+    LLM_BREAKER_FAILURE_THRESHOLD: int = 5 # Consecutive failed calls that open the circuit breaker
+    LLM_BREAKER_RESET_SECONDS: float = 60 # How long the breaker stays open before a trial call
+    CLASSIFICATION_BATCH_MAX_EMAILS: int = 20 # Emails packed into one classification prompt in parallel mode (1 disables batching)
+    CLASSIFICATION_BATCH_TOKEN_BUDGET: int = 3000 # Approximate prompt tokens per batched classification request
+    PROMPT_BODY_MAX_TOKENS: int = 1000 # Email bodies are cut to about this many tokens (head and tail) in prompts; 0 disables
+    PROMPT_STRIP_QUOTES: bool = True # Drop quoted replies and signatures from prompt bodies
+    CLASSIFICATION_CACHE_ENABLED: bool = True # Reuse classifications of identical/near-identical emails
+    CLASSIFICATION_CACHE_MAX_ENTRIES: int = 50000
+    CLASSIFICATION_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    CLASSIFICATION_CACHE_MAX_DISTANCE: int = 3 # SimHash Hamming distance for near-duplicates (-1 disables)
+    PRECLASSIFIER_ENABLED: bool = True # Settle confident SPAM/Unwanted emails with the local model
+    PRECLASSIFIER_MODEL_PATH: str = "preclassifier.npz"
+    PRECLASSIFIER_THRESHOLD: float = 0.98 # Minimum posterior probability to skip the LLM
+    PRECLASSIFIER_MIN_TRAINING_EMAILS: int = 200 # Stay idle until the model has seen enough history
+
 # Instantiate settings to be imported across the application
 settings = Settings()
\ No newline at end of file
@@ -1,84 +1,780 @@
 import sqlite3
 import datetime
-from typing import Optional, Tuple
+import hashlib
+import threading
+import time
+import zlib
+from typing import Iterator, Optional, Tuple
+
+from app.metrics import DB_LATENCY, timed
 
 DATABASE_FILE = "emails.db"
 
+# Per-connection tuning: WAL lets readers run alongside the writer, NORMAL
+# synchronous is durable across application crashes in WAL mode, and the larger
+# page cache and mmap keep hot pages out of the syscall path.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -20000", # 20 MB
+    "PRAGMA mmap_size = 268435456", # 256 MB
+    "PRAGMA busy_timeout = 5000",
+]
+
+_local = threading.local()
+_connections_lock = threading.Lock()
+_connections: dict[sqlite3.Connection, threading.Thread] = {} # Pooled connection -> owning thread
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns this thread's long-lived connection to DATABASE_FILE, opening and
+    tuning it on first use. Callers must not close it; use `with conn:` for a
+    transaction that commits on success and rolls back on error.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DATABASE_FILE:
+        if conn is not None:
+            _forget_connection(conn)
+        conn = open_connection()
+        _local.conn = conn
+        _local.path = DATABASE_FILE
+        with _connections_lock:
+            # Short-lived threads (pipeline stages, graph workers) exit without closing theirs
+            dead = [c for c, thread in _connections.items() if not thread.is_alive()]
+            for c in dead:
+                del _connections[c]
+            _connections[conn] = threading.current_thread()
+        for c in dead:
+            c.close()
+    return conn
+
+def close_thread_connection():
+    """Closes the calling thread's pooled connection, if it has one; for threads about to exit."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _forget_connection(conn)
+        _local.__dict__.clear()
+
+def open_connection() -> sqlite3.Connection:
+    """
+    Opens a new tuned connection to DATABASE_FILE that is not pooled. The caller
+    owns it and must close it.
+    """
+    # check_same_thread=False so close_all_connections() can run at shutdown and
+    # streamed exports can be read from whichever worker thread resumes them
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    # Used by the email_records view and the search triggers to read compressed bodies
+    conn.create_function("inflate", 1, inflate_body, deterministic=True)
+    return conn
+
+# zlib level for email bodies: close to the best ratio at a fraction of level 9's cost
+BODY_COMPRESSION_LEVEL = 6
+
+def compress_body(body: str) -> bytes:
+    return zlib.compress(body.encode("utf-8"), BODY_COMPRESSION_LEVEL)
+
+def inflate_body(data: Optional[bytes]) -> Optional[str]:
+    return zlib.decompress(data).decode("utf-8") if data is not None else None
+
+def body_hash(body: str) -> str:
+    """Content address of a body in email_bodies."""
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def _forget_connection(conn: sqlite3.Connection):
+    with _connections_lock:
+        _connections.pop(conn, None)
+    conn.close()
+
+def close_all_connections():
+    """Closes every pooled connection; called at application shutdown."""
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _local.__dict__.clear()
+
 def init_db():
     """Initializes the SQLite database and creates the 'emails' table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT UNIQUE,
+                subject TEXT,
+                sender TEXT,
+                body TEXT, -- Only for rows written before bodies moved to email_bodies; see migrate_inline_bodies()
+                classification TEXT,
+                response_sent BOOLEAN DEFAULT FALSE,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                body_hash TEXT,
+                classification_source TEXT -- 'llm', 'cache', 'preclassifier' or 'fallback'; NULL for emails stored before it was recorded
+            )
+        """)
+        if "classification_source" not in {row[1] for row in cursor.execute("PRAGMA table_info(emails)")}:
+            cursor.execute("ALTER TABLE emails ADD COLUMN classification_source TEXT")
+        migrated = init_body_storage(cursor)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS mailbox_state (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER NOT NULL,
+                last_uid INTEGER NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT NOT NULL UNIQUE,
+                to_address TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                sent_at DATETIME
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        # Keyset pagination for the dashboard, optionally narrowed by classification or sender
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_timestamp_id ON emails (timestamp, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_classification_timestamp_id ON emails (classification, timestamp, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_sender_timestamp_id ON emails (sender, timestamp, id)")
+        init_stats_table(cursor)
+        try:
+            init_search_index(cursor)
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable (SQLite built without FTS5?): {e}")
+    if migrated:
+        # Hand the pages the inline bodies used back to the file system
+        conn.execute("VACUUM")
+        print(f"Moved {migrated} inline bodies to compressed storage and vacuumed the database.")
+    print(f"Database '{DATABASE_FILE}' initialized.")
+
+def init_body_storage(cursor: sqlite3.Cursor) -> int:
+    """
+    Creates email_bodies, where bodies are stored zlib-compressed and
+    deduplicated by their SHA-256, and the email_records view, which reads
+    like the 'emails' table with the body column resolved. The body is only
+    decompressed for rows whose body column is actually selected. Triggers
+    delete a body once no email refers to it any more. Databases from before
+    the side table are migrated once. Returns the number of migrated bodies.
+    """
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(emails)")}
+    if "body_hash" not in columns:
+        cursor.execute("ALTER TABLE emails ADD COLUMN body_hash TEXT")
+    search_index = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'").fetchone()
+    if search_index and "email_records" not in search_index[0]:
+        # The index read bodies straight from 'emails'; init_search_index() rebuilds it after the migration
+        cursor.execute("DROP TABLE emails_fts")
+        for trigger in _SEARCH_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS email_bodies (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL -- Uncompressed length in bytes
+        )
+    """)
+    # A body is deleted with the last email that refers to it
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_body_hash ON emails (body_hash)")
+    unreferenced = "old.body_hash IS NOT NULL AND NOT EXISTS (SELECT 1 FROM emails WHERE body_hash = old.body_hash)"
+    release = "BEGIN DELETE FROM email_bodies WHERE hash = old.body_hash; END"
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS email_bodies_release_delete AFTER DELETE ON emails WHEN {unreferenced} {release}")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS email_bodies_release_update AFTER UPDATE OF body_hash ON emails
+        WHEN old.body_hash IS NOT new.body_hash AND {unreferenced} {release}
+    """)
+    # Same columns, in the same order, as 'emails' had before bodies moved out, plus
+    # the ones added since. Recreated on every start so new columns show up.
+    cursor.execute("DROP VIEW IF EXISTS email_records")
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id TEXT UNIQUE,
+        CREATE VIEW email_records AS
+        SELECT id, message_id, subject, sender,
+            COALESCE((SELECT inflate(data) FROM email_bodies WHERE hash = emails.body_hash), body) AS body,
+            classification, response_sent, timestamp, classification_source
+        FROM emails
+    """)
+    migrated = migrate_inline_bodies(cursor)
+    pruned = prune_email_bodies(cursor)
+    if pruned:
+        print(f"Removed {pruned} email bodies no email refers to.")
+    return migrated
+
+def store_bodies(cursor: sqlite3.Cursor, bodies: list[Optional[str]]) -> list[Optional[str]]:
+    """
+    Stores the bodies that are not stored yet and returns the hash of each
+    (None for a missing body). Bodies already present are neither compressed
+    nor written again.
+    """
+    hashes = [body_hash(body) if body is not None else None for body in bodies]
+    new = {h: body for h, body in zip(hashes, bodies) if h is not None}
+    keys = list(new)
+    for start in range(0, len(keys), 500): # Stay below SQLite's bound-parameter limit
+        chunk = keys[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for (stored,) in cursor.execute(f"SELECT hash FROM email_bodies WHERE hash IN ({placeholders})", chunk):
+            del new[stored]
+    cursor.executemany(
+        "INSERT INTO email_bodies (hash, data, size) VALUES (?, ?, ?) ON CONFLICT(hash) DO NOTHING",
+        [(h, compress_body(body), len(body.encode("utf-8"))) for h, body in new.items()]
+    )
+    return hashes
+
+def prune_email_bodies(cursor: sqlite3.Cursor) -> int:
+    """
+    Deletes bodies no email refers to, e.g. left behind by versions that stored
+    the body of every re-fetched email. Returns the number of deleted bodies.
+    """
+    cursor.execute("DELETE FROM email_bodies WHERE NOT EXISTS (SELECT 1 FROM emails WHERE body_hash = email_bodies.hash)")
+    return cursor.rowcount
+
+def migrate_inline_bodies(cursor: sqlite3.Cursor, chunk_size: int = 1000) -> int:
+    """Moves bodies still stored inline in 'emails' to email_bodies, chunk by chunk."""
+    migrated = 0
+    while True:
+        rows = cursor.execute(
+            "SELECT id, body FROM emails WHERE body IS NOT NULL AND body_hash IS NULL LIMIT ?", (chunk_size,)
+        ).fetchall()
+        if not rows:
+            return migrated
+        hashes = store_bodies(cursor, [body for _, body in rows])
+        cursor.executemany("UPDATE emails SET body_hash = ?, body = NULL WHERE id = ?", [(h, row[0]) for h, row in zip(hashes, rows)])
+        migrated += len(rows)
+
+def _stats_key(row: str = "") -> str:
+    """Key of an email in email_stats: the day it was stored, its classification and whether it was replied to."""
+    return f"date({row}timestamp), COALESCE({row}classification, 'Unclassified'), COALESCE({row}response_sent, 0) != 0"
+
+def init_stats_table(cursor: sqlite3.Cursor):
+    """
+    Creates email_stats, the number of emails per (day, classification,
+    response_sent), kept up to date by triggers on 'emails' so aggregate
+    views never scan the emails themselves. An update moves the email from its
+    old key to its new one. A database created before the table existed is
+    backfilled once, when the table is first created.
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_stats'").fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS email_stats (
+            day TEXT NOT NULL,
+            classification TEXT NOT NULL,
+            response_sent INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, classification, response_sent)
+        ) WITHOUT ROWID
+    """)
+    increment = f"""
+        INSERT INTO email_stats (day, classification, response_sent, count) VALUES ({_stats_key('new.')}, 1)
+        ON CONFLICT (day, classification, response_sent) DO UPDATE SET count = count + 1;
+    """
+    decrement = f"""
+        UPDATE email_stats SET count = count - 1
+        WHERE (day, classification, response_sent) = ({_stats_key('old.')});
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS email_stats_insert AFTER INSERT ON emails BEGIN {increment} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS email_stats_delete AFTER DELETE ON emails BEGIN {decrement} END")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS email_stats_update AFTER UPDATE OF timestamp, classification, response_sent ON emails
+        WHEN ({_stats_key('old.')}) IS NOT ({_stats_key('new.')})
+        BEGIN {decrement} {increment} END
+    """)
+    if not exists:
+        cursor.execute(f"""
+            INSERT INTO email_stats (day, classification, response_sent, count)
+            SELECT {_stats_key()}, COUNT(*) FROM emails GROUP BY 1, 2, 3
+        """)
+
+# bm25 weights of the subject, sender and body columns: a hit in the subject counts most
+SEARCH_RANK = "bm25(10.0, 5.0, 1.0)"
+
+# Triggers of earlier versions, which decompressed bodies through inflate() and so
+# made every write to 'emails' fail on connections without that function
+_SEARCH_TRIGGERS = ("emails_fts_insert", "emails_fts_delete", "emails_fts_before_update", "emails_fts_update")
+
+def init_search_index(cursor: sqlite3.Cursor):
+    """
+    Creates the FTS5 index over the subject, sender and body of stored emails.
+    It is an external-content table on email_records: the text lives only in
+    'emails' and email_bodies. store_emails_bulk() indexes new emails with the
+    plain text it already has. Triggers log every other change to 'emails',
+    from any SQLite client, in emails_fts_pending together with the text the
+    index holds, without decompressing anything; sync_search_index() applies
+    the log. The index is built from scratch when it or the log is first
+    created, since nothing logged the changes made before that.
+    """
+    existing = cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('emails_fts', 'emails_fts_pending')"
+    ).fetchone()[0] == 2
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+            subject, sender, body,
+            content = 'email_records', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    for trigger in _SEARCH_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS emails_fts_pending (
+            seq INTEGER PRIMARY KEY, -- Order of the changes
+            id INTEGER NOT NULL, -- emails.id
+            indexed INTEGER NOT NULL, -- 1: the index holds the text below; 0: inserted, not indexed yet
             subject TEXT,
             sender TEXT,
-            body TEXT,
-            classification TEXT,
-            response_sent BOOLEAN DEFAULT FALSE,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            body TEXT, -- Inline body, for rows from before email_bodies
+            body_data BLOB -- Compressed body, copied before the email (and maybe its body) goes
         )
     """)
-    conn.commit()
-    conn.close()
-    print(f"Database '{DATABASE_FILE}' initialized.")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS emails_fts_log_insert AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts_pending (id, indexed) VALUES (new.id, 0);
+        END
+    """)
+    indexed_text = """
+        INSERT INTO emails_fts_pending (id, indexed, subject, sender, body, body_data)
+        VALUES (old.id, 1, old.subject, old.sender, old.body, (SELECT data FROM email_bodies WHERE hash = old.body_hash));
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS emails_fts_log_delete BEFORE DELETE ON emails BEGIN {indexed_text} END")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS emails_fts_log_update BEFORE UPDATE OF subject, sender, body, body_hash ON emails
+        BEGIN {indexed_text} END
+    """)
+    if not existing:
+        cursor.execute(f"INSERT INTO emails_fts (emails_fts, rank) VALUES ('rank', '{SEARCH_RANK}')")
+        cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')") # Backfill from email_records
+        cursor.execute("DELETE FROM emails_fts_pending")
+        print("Full-text search index created and backfilled.")
+    else:
+        _apply_search_log(cursor)
 
-def store_email_data(message_id: str, subject: str, sender: str, body: str, classification: str, response_sent: bool = False):
+def _has_search_index(cursor: sqlite3.Cursor) -> bool:
+    """True once init_search_index() ran, i.e. SQLite has FTS5 and the change log exists."""
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts_pending'").fetchone() is not None
+
+def _apply_search_log(cursor: sqlite3.Cursor) -> int:
     """
-    Stores or updates email data in the database.
-    If message_id already exists, it updates the response_sent status.
+    Brings the index up to date with the changes logged in emails_fts_pending.
+    For each changed email, the text the index held before its first logged
+    change is removed, and the email is indexed again if it still exists, so
+    any sequence of updates, deletes and reused ids ends in sync. Returns the
+    number of emails re-synced.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    try:
+    # SQLite takes the bare columns from the row holding MIN(seq)
+    changes = cursor.execute(
+        "SELECT id, MIN(seq), indexed, subject, sender, body, body_data FROM emails_fts_pending GROUP BY id"
+    ).fetchall()
+    if not changes:
+        return 0
+    cursor.executemany(
+        "INSERT INTO emails_fts (emails_fts, rowid, subject, sender, body) VALUES ('delete', ?, ?, ?, ?)",
+        [(row_id, subject, sender, inflate_body(data) if data is not None else body)
+         for row_id, _, indexed, subject, sender, body, data in changes if indexed]
+    )
+    cursor.execute("""
+        INSERT INTO emails_fts (rowid, subject, sender, body)
+        SELECT id, subject, sender, body FROM email_records WHERE id IN (SELECT id FROM emails_fts_pending)
+    """)
+    cursor.execute("DELETE FROM emails_fts_pending")
+    return len(changes)
+
+def sync_search_index() -> int:
+    """Applies changes made to 'emails' outside store_emails_bulk() (e.g. with the sqlite3 shell) to the search index."""
+    conn = get_connection()
+    if not _has_search_index(conn.cursor()):
+        return 0
+    if conn.execute("SELECT 1 FROM emails_fts_pending LIMIT 1").fetchone() is None:
+        return 0
+    with conn:
+        return _apply_search_log(conn.cursor())
+
+def _index_new_emails(cursor: sqlite3.Cursor, records: list[dict]):
+    """
+    Adds freshly inserted emails to the search index, if SQLite has FTS5, and
+    drops the log entries their inserts left.
+    """
+    if not _has_search_index(cursor):
+        return
+    message_ids = [r["message_id"] for r in records]
+    cursor.executemany(
+        "INSERT INTO emails_fts (rowid, subject, sender, body) SELECT id, ?, ?, ? FROM emails WHERE message_id = ?",
+        [(r["subject"], r["sender"], r["body"], r["message_id"]) for r in records]
+    )
+    for start in range(0, len(message_ids), 500): # Stay below SQLite's bound-parameter limit
+        chunk = message_ids[start:start + 500]
         cursor.execute(
+            f"DELETE FROM emails_fts_pending WHERE indexed = 0 AND id IN (SELECT id FROM emails WHERE message_id IN ({','.join('?' * len(chunk))}))",
+            chunk
+        )
+
+@timed(DB_LATENCY, operation="store_emails_bulk")
+def store_emails_bulk(records: list[dict]) -> int:
+    """
+    Upserts a whole batch of processed emails in one transaction.
+    Each record has message_id, subject, sender, body, classification,
+    response_sent, an optional classification_source and an optional reply
+    ({"to_address", "subject", "body"}).
+    Replies are queued in the outbox in the same transaction; the unique
+    message_id in the outbox ensures each email is replied to at most once,
+    however many runs store it. Returns the number of newly queued replies.
+    """
+    if not records:
+        return 0
+    now = datetime.datetime.now()
+    conn = get_connection()
+    sync_search_index() # Earlier changes from other clients first, so they cannot touch the rows added here
+    with conn:
+        existing = get_existing_message_ids([r["message_id"] for r in records])
+        new_records = {} # The first record of a message_id inserts it; later ones only reclassify it
+        for r in records:
+            if r["message_id"] not in existing:
+                new_records.setdefault(r["message_id"], r)
+        # The upsert keeps the body of a stored email, so only new emails' bodies are written
+        inserted = [new_records.get(r["message_id"]) is r for r in records]
+        hashes = store_bodies(conn.cursor(), [r["body"] if new else None for r, new in zip(records, inserted)])
+        conn.executemany(
             """
-            INSERT INTO emails (message_id, subject, sender, body, classification, response_sent)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO emails (message_id, subject, sender, body_hash, classification, classification_source, response_sent)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(message_id) DO UPDATE SET
+                classification = excluded.classification,
+                classification_source = excluded.classification_source,
+                response_sent = MAX(emails.response_sent, excluded.response_sent), -- A sent reply is never reset
+                timestamp = ?
             """,
-            (message_id, subject, sender, body, classification, response_sent)
+            [
+                (r["message_id"], r["subject"], r["sender"], h, r["classification"], r.get("classification_source"), r.get("response_sent", False), now)
+                for r, h in zip(records, hashes)
+            ]
         )
-        conn.commit()
-        print(f"Successfully stored new email: '{subject}' (ID: {message_id})")
-    except sqlite3.IntegrityError:
-        # If message_id already exists, update the response_sent status
-        print(f"Email with message_id '{message_id}' already exists. Updating response_sent status.")
-        cursor.execute(
+        _index_new_emails(conn.cursor(), list(new_records.values()))
+        replies = [r for r in records if r.get("reply")]
+        queued_before = conn.total_changes
+        conn.executemany(
             """
-            UPDATE emails SET classification = ?, response_sent = ?, timestamp = ? WHERE message_id = ?
+            INSERT INTO outbox (message_id, to_address, subject, body, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(message_id) DO NOTHING
             """,
-            (classification, response_sent, datetime.datetime.now(), message_id)
+            [
+                (r["message_id"], r["reply"]["to_address"], r["reply"]["subject"], r["reply"]["body"], time.time())
+                for r in replies
+            ]
         )
-        conn.commit()
+        queued = conn.total_changes - queued_before
+    print(f"Stored {len(records)} emails in one transaction; queued {queued} new replies.")
+    return queued
+
+@timed(DB_LATENCY, operation="store_email_data")
+def store_email_data(message_id: str, subject: str, sender: str, body: str, classification: str, response_sent: bool = False,
+                     reply: Optional[dict] = None, classification_source: Optional[str] = None):
+    """
+    Stores or updates email data in the database.
+    If message_id already exists, it updates the classification and response_sent status.
+    If `reply` is given, it is queued in the outbox in the same transaction.
+    """
+    try:
+        store_emails_bulk([{
+            "message_id": message_id,
+            "subject": subject,
+            "sender": sender,
+            "body": body,
+            "classification": classification,
+            "classification_source": classification_source,
+            "response_sent": response_sent,
+            "reply": reply,
+        }])
     except Exception as e:
         print(f"Error storing/updating email data for '{message_id}': {e}")
-    finally:
-        conn.close()
 
+@timed(DB_LATENCY, operation="claim_due_replies")
+def claim_due_replies(limit: int, lease_seconds: float) -> list[tuple]:
+    """
+    Atomically claims up to `limit` outbox rows that are due for (re)sending.
+    Claimed rows are leased for `lease_seconds`; rows whose lease expired because
+    a dispatcher crashed mid-send become due again.
+    Returns (id, message_id, to_address, subject, body, attempts) tuples.
+    """
+    now = time.time()
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE") # Serializes concurrent dispatchers
+    try:
+        rows = conn.execute(
+            """
+            SELECT id, message_id, to_address, subject, body, attempts FROM outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+            """,
+            (now, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+            [(now + lease_seconds, row[0]) for row in rows]
+        )
+        conn.commit()
+        return [row[:5] + (row[5] + 1,) for row in rows]
+    except Exception:
+        conn.rollback()
+        raise
+
+@timed(DB_LATENCY, operation="mark_reply_sent")
+def mark_reply_sent(outbox_id: int, message_id: str):
+    """Marks an outbox entry as sent and sets response_sent on the email in one transaction."""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+            (datetime.datetime.now(), outbox_id)
+        )
+        conn.execute("UPDATE emails SET response_sent = 1 WHERE message_id = ?", (message_id,))
+
+@timed(DB_LATENCY, operation="mark_reply_failed")
+def mark_reply_failed(outbox_id: int, error: str, retry_at: Optional[float]):
+    """Schedules a retry at `retry_at`, or gives up on the reply when it is None."""
+    conn = get_connection()
+    with conn:
+        if retry_at is None:
+            conn.execute("UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (error, outbox_id))
+        else:
+            conn.execute(
+                "UPDATE outbox SET status = 'pending', last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (error, retry_at, outbox_id)
+            )
+
+@timed(DB_LATENCY, operation="get_email_by_message_id")
 def get_email_by_message_id(message_id: str) -> Optional[Tuple]: #-> tuple | None:
     """
     Retrieves an email record from the database by its message_id.
     Returns a tuple representing the row, or None if not found.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM emails WHERE message_id = ?", (message_id,))
-    email_data = cursor.fetchone()
-    conn.close()
-    return email_data
+    return get_connection().execute("SELECT * FROM email_records WHERE message_id = ?", (message_id,)).fetchone()
+
+@timed(DB_LATENCY, operation="get_existing_message_ids")
+def get_existing_message_ids(message_ids: list[str]) -> set[str]:
+    """
+    Returns the subset of the given message_ids that are already stored,
+    using one query per chunk instead of one query per email.
+    """
+    existing = set()
+    if not message_ids:
+        return existing
+    conn = get_connection()
+    for start in range(0, len(message_ids), 500): # Stay below SQLite's bound-parameter limit
+        chunk = message_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT message_id FROM emails WHERE message_id IN ({placeholders})", chunk)
+        existing.update(row[0] for row in rows)
+    return existing
+
+@timed(DB_LATENCY, operation="get_emails_by_message_ids")
+def get_emails_by_message_ids(message_ids: list[str]) -> dict[str, tuple]:
+    """
+    Bulk version of get_email_by_message_id. Returns a mapping of message_id to row
+    for the ids that are stored.
+    """
+    found = {}
+    conn = get_connection()
+    for start in range(0, len(message_ids), 500):
+        chunk = message_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT * FROM email_records WHERE message_id IN ({placeholders})", chunk)
+        found.update((row[1], row) for row in rows)
+    return found
 
+@timed(DB_LATENCY, operation="get_mailbox_state")
+def get_mailbox_state(mailbox: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (uidvalidity, last_uid) sync watermark of a mailbox, or None if it was never synced.
+    """
+    return get_connection().execute(
+        "SELECT uidvalidity, last_uid FROM mailbox_state WHERE mailbox = ?", (mailbox,)
+    ).fetchone()
+
+@timed(DB_LATENCY, operation="save_mailbox_state")
+def save_mailbox_state(mailbox: str, uidvalidity: int, last_uid: int):
+    """Stores the highest processed UID of a mailbox together with its UIDVALIDITY."""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO mailbox_state (mailbox, uidvalidity, last_uid, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity,
+                last_uid = excluded.last_uid, updated_at = excluded.updated_at
+            """,
+            (mailbox, uidvalidity, last_uid, datetime.datetime.now())
+        )
+
+EMAIL_FIELDS = ["id", "message_id", "subject", "sender", "body", "classification", "response_sent", "timestamp"]
+
+@timed(DB_LATENCY, operation="query_emails")
+def query_emails(limit: int, after: Optional[Tuple[str, int]] = None, classification: Optional[str] = None,
+                 sender: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                 fields: Optional[list[str]] = None) -> Tuple[list[dict], bool]:
+    """
+    Returns one page of emails, newest first, using keyset pagination on
+    (timestamp, id): `after` is the (timestamp, id) of the last row of the
+    previous page. Only the requested `fields` are read, so bodies are only
+    looked up and decompressed when asked for. Returns the rows as dicts and whether more rows follow.
+    Raises ValueError for unknown fields.
+    """
+    fields = fields or EMAIL_FIELDS
+    unknown = set(fields) - set(EMAIL_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    # id and timestamp are always read because the next cursor is built from them
+    columns = ["id", "timestamp"] + [f for f in fields if f not in ("id", "timestamp")]
+
+    conditions = []
+    params: list = []
+    if classification:
+        conditions.append("classification = ?")
+        params.append(classification)
+    if sender:
+        conditions.append("sender = ?")
+        params.append(sender)
+    if date_from:
+        conditions.append("timestamp >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("timestamp < ?")
+        params.append(date_to)
+    if after:
+        conditions.append("(timestamp, id) < (?, ?)")
+        params.extend(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    rows = get_connection().execute(
+        f"SELECT {', '.join(columns)} FROM email_records {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+        params + [limit + 1] # One extra row tells whether another page exists
+    ).fetchall()
+    has_more = len(rows) > limit
+    return [dict(zip(columns, row)) for row in rows[:limit]], has_more
+
+@timed(DB_LATENCY, operation="get_email_stats")
+def get_email_stats(date_from: Optional[str] = None, date_to: Optional[str] = None) -> list[dict]:
+    """
+    Per-day email counts from the email_stats summary table, oldest day first:
+    [{"day", "total", "by_classification": {classification: count}, "replied"}].
+    `date_from` and `date_to` are ISO days; `date_to` is exclusive. The cost
+    depends on the number of days, not on the number of stored emails.
+    """
+    conditions = ["count > 0"]
+    params: list = []
+    if date_from:
+        conditions.append("day >= ?")
+        params.append(date_from[:10])
+    if date_to:
+        conditions.append("day < ?")
+        params.append(date_to[:10])
+    rows = get_connection().execute(
+        f"""
+        SELECT day, classification, response_sent, count FROM email_stats
+        WHERE {' AND '.join(conditions)} ORDER BY day
+        """,
+        params
+    ).fetchall()
+    days: dict[str, dict] = {}
+    for day, classification, response_sent, count in rows:
+        entry = days.setdefault(day, {"day": day, "total": 0, "by_classification": {}, "replied": 0})
+        entry["total"] += count
+        entry["by_classification"][classification] = entry["by_classification"].get(classification, 0) + count
+        if response_sent:
+            entry["replied"] += count
+    return list(days.values())
+
+SEARCH_FIELDS = ["id", "message_id", "subject", "sender", "classification", "response_sent", "timestamp"]
+
+@timed(DB_LATENCY, operation="search_emails")
+def search_emails(query: str, limit: int, after: Optional[Tuple[float, int]] = None, classification: Optional[str] = None,
+                  response_sent: Optional[bool] = None, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None) -> Tuple[list[dict], bool]:
+    """
+    Full-text search over subject, sender and body using FTS5 query syntax
+    (words, "phrases", prefix*, AND/OR/NOT, subject:word). Results are ordered
+    by relevance, best first, and paginated by keyset on (score, id): `after`
+    is the position of the last row of the previous page. Each row carries a
+    highlighted snippet of its best-matching column and its score (lower is
+    better). Changes other clients made to 'emails' are indexed first. Returns
+    the rows and whether more rows follow. Raises ValueError
+    for invalid queries.
+    """
+    sync_search_index()
+    conditions = ["emails_fts MATCH ?"]
+    params: list = [query]
+    if classification:
+        conditions.append("e.classification = ?")
+        params.append(classification)
+    if response_sent is not None:
+        conditions.append("e.response_sent = ?")
+        params.append(response_sent)
+    if date_from:
+        conditions.append("e.timestamp >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("e.timestamp < ?")
+        params.append(date_to)
+    if after:
+        conditions.append("(emails_fts.rank, emails_fts.rowid) > (?, ?)")
+        params.extend(after)
+
+    columns = ", ".join(f"e.{field}" for field in SEARCH_FIELDS)
+    try:
+        rows = get_connection().execute(
+            f"""
+            SELECT {columns}, snippet(emails_fts, -1, '[', ']', '...', 16), emails_fts.rank
+            FROM emails_fts JOIN emails e ON e.id = emails_fts.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY emails_fts.rank, emails_fts.rowid LIMIT ?
+            """,
+            params + [limit + 1] # One extra row tells whether another page exists
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        raise ValueError(f"Invalid search query '{query}': {e}") from e
+    has_more = len(rows) > limit
+    return [dict(zip(SEARCH_FIELDS + ["snippet", "score"], row)) for row in rows[:limit]], has_more
+
+@timed(DB_LATENCY, operation="get_max_email_id")
+def get_max_email_id() -> int:
+    """Returns the highest id in the 'emails' table, or 0 if it is empty."""
+    return get_connection().execute("SELECT COALESCE(MAX(id), 0) FROM emails").fetchone()[0]
+
+def iter_emails_for_export(since_id: int, until_id: int, fetch_size: int) -> Iterator[list[tuple]]:
+    """
+    Yields emails with since_id < id <= until_id in id order, `fetch_size` rows
+    at a time, from a cursor on a dedicated connection so memory use does not
+    grow with the table. Rows have the EMAIL_FIELDS columns.
+    """
+    conn = open_connection()
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(EMAIL_FIELDS)} FROM email_records WHERE id > ? AND id <= ? ORDER BY id",
+            (since_id, until_id)
+        )
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+@timed(DB_LATENCY, operation="get_all_emails")
 def get_all_emails() -> list[tuple]:
     """
     Retrieves all email records from the database, ordered by timestamp (descending).
     Returns a list of tuples, each representing an email row.
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM emails ORDER BY timestamp DESC")
-    emails = cursor.fetchall()
-    conn.close()
-    return emails
+    return get_connection().execute("SELECT * FROM email_records ORDER BY timestamp DESC").fetchall()
 
 if __name__ == "__main__":
     # Example usage for testing the database module
@@ -1,86 +1,697 @@
+import base64
+import hashlib
 import imaplib
+import itertools
 import email
+import quopri
 import smtplib
 from email.mime.text import MIMEText
 import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
 
 from app.config import settings
+from app.database import get_existing_message_ids, get_mailbox_state, save_mailbox_state
+from app.preprocess import html_to_text
+from app.metrics import IMAP_FETCH_LATENCY, SMTP_SEND_LATENCY
 
-def fetch_unseen_emails():
+def open_imap_connection() -> imaplib.IMAP4:
+    """Connects to the configured IMAP server (implicit TLS unless MAIL_USE_TLS is off)."""
+    if settings.MAIL_USE_TLS:
+        return imaplib.IMAP4_SSL(settings.IMAP_SERVER, settings.IMAP_PORT)
+    return imaplib.IMAP4(settings.IMAP_SERVER, settings.IMAP_PORT)
+
+class ImapSessionManager:
     """
-    Connects to the IMAP server and fetches all unseen emails from the inbox.
-    Returns a list of dictionaries, each representing an email.
+    Long-lived IMAP session shared by all fetch callers, so the TLS handshake,
+    LOGIN and SELECT are paid once per process instead of once per poll.
+    The connection is opened lazily, checked with NOOP when it has been idle,
+    re-selected when another mailbox is requested and reopened after errors.
+    One caller uses the session at a time.
     """
-    try:
-        mail = imaplib.IMAP4_SSL(settings.IMAP_SERVER, settings.IMAP_PORT)
-        mail.login(settings.EMAIL_ADDRESS, settings.EMAIL_APP_PASSWORD)
-        mail.select('inbox')
 
-        status, email_ids = mail.search(None, 'UNSEEN')
-        email_id_list = email_ids[0].split()
-        emails = []
-
-        for num in email_id_list:
-            status, data = mail.fetch(num, '(RFC822)')
-            raw_email = data[0][1]
-            msg = email.message_from_bytes(raw_email)
-
-            subject = msg['subject'] if msg['subject'] else "(No Subject)"
-            sender = msg['from'] if msg['from'] else "(Unknown Sender)"
-            message_id = msg['Message-ID'] if msg['Message-ID'] else f"<{num.decode()}@{settings.IMAP_SERVER}>" # Fallback ID
-
-            body = ""
-            if msg.is_multipart():
-                for part in msg.walk():
-                    ctype = part.get_content_type()
-                    cdisp = str(part.get('Content-Disposition'))
-
-                    # Prefer plain text over HTML, and avoid attachments
-                    if ctype == 'text/plain' and 'attachment' not in cdisp:
-                        try:
-                            body = part.get_payload(decode=True).decode('utf-8')
-                        except UnicodeDecodeError:
-                            body = part.get_payload(decode=True).decode('latin-1', errors='ignore')
-                        break # Take the first plain text part
-            else:
+    def __init__(self, healthcheck_interval: float):
+        self.healthcheck_interval = healthcheck_interval
+        self._lock = threading.Lock()
+        self._mail: Optional[imaplib.IMAP4] = None
+        self._selected: Optional[str] = None
+        self._last_used = 0.0
+
+    def acquire(self, mailbox: str = "inbox") -> imaplib.IMAP4:
+        """
+        Returns a logged-in connection with `mailbox` selected. Must be paired with release().
+        """
+        self._lock.acquire()
+        try:
+            if self._mail is not None and time.monotonic() - self._last_used > self.healthcheck_interval:
                 try:
-                    body = msg.get_payload(decode=True).decode('utf-8')
-                except UnicodeDecodeError:
-                    body = msg.get_payload(decode=True).decode('latin-1', errors='ignore')
-
-            emails.append({
-                "message_id": message_id,
-                "subject": subject,
-                "sender": sender,
-                "body": body
+                    self._mail.noop()
+                    # Drop untagged responses (EXISTS, RECENT, ...) accumulated while idle
+                    self._mail.untagged_responses.clear()
+                except Exception as e:
+                    print(f"IMAP session is no longer alive ({e}). Reconnecting.")
+                    self._disconnect()
+            if self._mail is None:
+                self._mail = open_imap_connection()
+                self._mail.login(settings.EMAIL_ADDRESS, settings.EMAIL_APP_PASSWORD)
+                self._selected = None
+            if self._selected != mailbox:
+                status, data = self._mail.select(mailbox)
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(f"Could not select mailbox '{mailbox}': {data}")
+                self._selected = mailbox
+            return self._mail
+        except Exception:
+            self._disconnect()
+            self._lock.release()
+            raise
+
+    def release(self, broken: bool = False):
+        """
+        Hands the session back. Pass broken=True after an error so the next caller reconnects.
+        """
+        if broken:
+            self._disconnect()
+        self._last_used = time.monotonic()
+        self._lock.release()
+
+    @contextmanager
+    def session(self, mailbox: str = "inbox") -> Iterator[imaplib.IMAP4]:
+        mail = self.acquire(mailbox)
+        broken = False
+        try:
+            yield mail
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(broken)
+
+    def _disconnect(self):
+        mail, self._mail = self._mail, None
+        self._selected = None
+        if mail is not None:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    def close(self):
+        """Logs out cleanly; called at application shutdown."""
+        with self._lock:
+            if self._mail is not None:
+                self._disconnect()
+                print("IMAP session closed.")
+
+# Shared session used by all fetch functions
+imap_sessions = ImapSessionManager(healthcheck_interval=settings.IMAP_HEALTHCHECK_INTERVAL_SECONDS)
+
+def _decode_payload(part) -> str:
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return payload.decode('latin-1', errors='ignore')
+
+def parse_email_message(raw_email: bytes) -> dict:
+    """
+    Parses a raw RFC822 message into the email dict used by the agent.
+    """
+    msg = email.message_from_bytes(raw_email)
+
+    subject = msg['subject'] if msg['subject'] else "(No Subject)"
+    sender = msg['from'] if msg['from'] else "(Unknown Sender)"
+    message_id = msg['Message-ID'] if msg['Message-ID'] else _fallback_message_id(msg)
+
+    body = ""
+    if msg.is_multipart():
+        html_part = None
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            cdisp = str(part.get('Content-Disposition'))
+
+            # Prefer plain text over HTML, and avoid attachments
+            if ctype == 'text/plain' and 'attachment' not in cdisp:
+                body = _decode_payload(part)
+                break # Take the first plain text part
+            if ctype == 'text/html' and 'attachment' not in cdisp and html_part is None:
+                html_part = part
+        else:
+            if html_part is not None:
+                # HTML-only mail: convert it rather than storing an empty body
+                body = html_to_text(_decode_payload(html_part))
+    else:
+        body = _decode_payload(msg)
+        if msg.get_content_type() == 'text/html':
+            body = html_to_text(body)
+
+    return {
+        "message_id": message_id,
+        "subject": subject,
+        "sender": sender,
+        "body": body
+    }
+
+def _fallback_message_id(msg: email.message.Message) -> str:
+    """
+    Stable id for a message without a Message-ID header, derived from its other
+    headers. Sequence numbers shift whenever mail is expunged, so an id built
+    from them could match a different, already stored message.
+    """
+    headers = "\n".join(f"{name}: {value}" for name, value in msg.items())
+    digest = hashlib.sha256(headers.encode("utf-8", errors="surrogateescape")).hexdigest()
+    return f"<{digest[:32]}@{settings.IMAP_SERVER}>"
+
+def _imap_fetch(mail: imaplib.IMAP4, message_set: bytes, parts: str, by_uid: bool):
+    with IMAP_FETCH_LATENCY.time():
+        if by_uid:
+            return mail.uid('FETCH', message_set, parts)
+        return mail.fetch(message_set, parts)
+
+def _fetch_response_key(response_line: bytes, by_uid: bool) -> Optional[bytes]:
+    """Extracts the UID (or sequence number) a FETCH response item belongs to."""
+    match = re.search(rb'UID (\d+)', response_line) if by_uid else re.match(rb'(\d+) ', response_line)
+    return match.group(1) if match else None
+
+def fetch_message_ids(mail: imaplib.IMAP4, nums: list[bytes], by_uid: bool = False) -> dict[bytes, str]:
+    """
+    Fetches only the Message-ID header of the given messages, one FETCH command
+    per IMAP_FETCH_CHUNK_SIZE messages. BODY.PEEK leaves the \\Seen flag untouched.
+    Returns a mapping of message sequence number (or UID) to Message-ID; messages
+    without a Message-ID header are left out.
+    """
+    message_ids = {}
+    chunk_size = settings.IMAP_FETCH_CHUNK_SIZE
+    for start in range(0, len(nums), chunk_size):
+        chunk = nums[start:start + chunk_size]
+        wanted = set(chunk)
+        status, data = _imap_fetch(mail, _message_set(chunk), '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])', by_uid)
+        if status != 'OK':
+            continue
+        for item in data:
+            if not isinstance(item, tuple):
+                continue # Closing b')' of each FETCH response
+            key = _fetch_response_key(item[0], by_uid)
+            if key not in wanted:
+                continue
+            headers = email.message_from_bytes(item[1])
+            if headers['Message-ID']:
+                message_ids[key] = headers['Message-ID']
+    return message_ids
+
+def _skip_already_stored(mail: imaplib.IMAP4, nums: list[bytes], by_uid: bool = False) -> list[bytes]:
+    """
+    Header-first check: returns only the messages whose Message-ID is not yet
+    stored in the database.
+    """
+    if not nums:
+        return nums
+    message_ids = fetch_message_ids(mail, nums, by_uid)
+    already_stored = get_existing_message_ids(list(message_ids.values()))
+    if not already_stored:
+        return nums
+    # Messages without a Message-ID are always downloaded: their id is derived from all headers
+    skipped = [num for num in nums if message_ids.get(num) in already_stored]
+    if not by_uid:
+        # Mark them as seen, as a full fetch would have, so they are not checked again
+        for start in range(0, len(skipped), settings.IMAP_FETCH_CHUNK_SIZE):
+            mail.store(_message_set(skipped[start:start + settings.IMAP_FETCH_CHUNK_SIZE]), '+FLAGS', '\\Seen')
+    print(f"Skipping {len(skipped)} emails already stored in the database.")
+    return [num for num in nums if message_ids.get(num) not in already_stored]
+
+def _message_set(nums: list[bytes]) -> bytes:
+    """Compresses message numbers into an IMAP sequence set, e.g. b'1:4,7,9:10'."""
+    ranges = []
+    for num in sorted(int(n) for n in nums):
+        if ranges and num == ranges[-1][1] + 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return b",".join(b"%d" % a if a == b else b"%d:%d" % (a, b) for a, b in ranges)
+
+_BODYSTRUCTURE_TOKEN_RE = re.compile(rb'\s*(\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+)')
+
+def parse_bodystructure(data: bytes) -> Optional[list]:
+    """
+    Parses the BODYSTRUCTURE item of a FETCH response into nested lists of
+    strings (NIL becomes None). Returns None if the response has no
+    BODYSTRUCTURE or contains a literal, which imaplib splits off.
+    """
+    start = data.find(b"BODYSTRUCTURE (")
+    if start == -1:
+        return None
+    stack = [[]]
+    pos = start + len(b"BODYSTRUCTURE ")
+    while pos < len(data):
+        match = _BODYSTRUCTURE_TOKEN_RE.match(data, pos)
+        if not match:
+            break
+        token = match.group(1)
+        pos = match.end()
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) == 1:
+                return None # Unbalanced
+            item = stack.pop()
+            stack[-1].append(item)
+            if len(stack) == 1:
+                return item
+        elif token.startswith(b"{"):
+            return None
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode("utf-8", errors="replace"))
+        else:
+            stack[-1].append(None if token.upper() == b"NIL" else token.decode("utf-8", errors="replace"))
+    return None
+
+def _is_attachment(part: list, disposition_index: int) -> bool:
+    disposition = part[disposition_index] if len(part) > disposition_index else None
+    return isinstance(disposition, list) and bool(disposition) and str(disposition[0]).lower() == "attachment"
+
+def find_text_section(structure: list, prefix: str = "") -> Optional[dict]:
+    """
+    Finds the body section to download from a parsed BODYSTRUCTURE: the first
+    inline text/plain part, or else the first inline text/html part. Attached
+    messages and attachments are never descended into. Returns
+    {"section", "subtype", "encoding", "charset"} or None if there is no text.
+    """
+    candidates = []
+
+    def walk(part: list, section: str):
+        if part and isinstance(part[0], list):
+            # Multipart: the child parts come first, followed by the subtype and extension data
+            children = itertools.takewhile(lambda p: isinstance(p, list), part)
+            for index, child in enumerate(children):
+                walk(child, f"{section}.{index + 1}" if section else str(index + 1))
+            return
+        if len(part) < 7 or str(part[0]).lower() != "text":
+            return
+        subtype = str(part[1]).lower()
+        # Text parts carry a line count before the extension data, so disposition is the 10th field
+        if subtype in ("plain", "html") and not _is_attachment(part, 9):
+            params = part[2] if isinstance(part[2], list) else []
+            charset = next((params[i + 1] for i in range(0, len(params) - 1, 2) if str(params[i]).lower() == "charset"), None)
+            candidates.append({
+                "section": section or "TEXT",
+                "subtype": subtype,
+                "encoding": str(part[5] or "7bit").lower(),
+                "charset": charset or "utf-8",
             })
-        mail.logout()
-        print(f"Successfully fetched {len(emails)} unseen emails.")
-        return emails
+
+    walk(structure, prefix)
+    plain = [c for c in candidates if c["subtype"] == "plain"]
+    return (plain or candidates or [None])[0]
+
+def _decode_section(data: bytes, text_part: dict) -> str:
+    encoding = text_part["encoding"]
+    if encoding == "base64":
+        data = base64.b64decode(data, validate=False)
+    elif encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    try:
+        text = data.decode(text_part["charset"])
+    except (LookupError, UnicodeDecodeError):
+        text = data.decode("latin-1", errors="ignore")
+    return html_to_text(text) if text_part["subtype"] == "html" else text
+
+def _iter_fetch_text_parts(mail: imaplib.IMAP4, chunk: list[bytes], by_uid: bool) -> Iterator[Tuple[bytes, dict]]:
+    """
+    Structure-first fetch of one chunk: reads every BODYSTRUCTURE in one FETCH,
+    then downloads only the headers and the chosen text section, one FETCH per
+    distinct section number. Attachments never leave the server. Messages whose
+    structure cannot be parsed, or whose response cannot be matched to them, are
+    fetched in full. Yields (key, email dict).
+    """
+    status, data = _imap_fetch(mail, _message_set(chunk), '(BODYSTRUCTURE)', by_uid)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"FETCH BODYSTRUCTURE failed for {len(chunk)} messages: {data}")
+    text_parts: dict[bytes, Optional[dict]] = {}
+    unparsed = set(chunk)
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        if not isinstance(line, bytes) or b"BODYSTRUCTURE" not in line:
+            continue
+        key = _fetch_response_key(line, by_uid)
+        structure = parse_bodystructure(line) if not isinstance(item, tuple) else None
+        if key in unparsed and structure is not None:
+            text_parts[key] = find_text_section(structure)
+            unparsed.discard(key)
+
+    # The UID sync does not rely on the \\Seen flag, so it leaves it untouched
+    peek = '.PEEK' if by_uid else ''
+    by_section: dict[Optional[str], list[bytes]] = {}
+    for key, text_part in text_parts.items():
+        by_section.setdefault(text_part["section"] if text_part else None, []).append(key)
+
+    results: dict[bytes, dict] = {}
+    for section, keys in by_section.items():
+        parts = f'(BODY{peek}[HEADER] BODY{peek}[{section}])' if section else f'(BODY{peek}[HEADER])'
+        status, data = _imap_fetch(mail, _message_set(keys), parts, by_uid)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"FETCH {parts} failed for {len(keys)} messages: {data}")
+        key = None
+        for item in data:
+            if not isinstance(item, tuple):
+                continue # Closing b')' of each FETCH response
+            if re.match(rb'\d+ \(', item[0]):
+                key = _fetch_response_key(item[0], by_uid) # First literal of a new message
+            if key not in text_parts:
+                continue
+            entry = results.setdefault(key, {"header": b"", "body": b""})
+            entry["header" if b"HEADER]" in item[0] else "body"] = item[1]
+
+    for key in chunk:
+        if key in results:
+            email_data = parse_email_message(results[key]["header"])
+            text_part = text_parts[key]
+            email_data["body"] = _decode_section(results[key]["body"], text_part) if text_part else ""
+            yield key, email_data
+        else:
+            # Unparsed structure, or a response the key could not be matched to
+            # (e.g. a server sending the UID after the first literal)
+            status, data = _imap_fetch(mail, key, '(BODY.PEEK[])' if by_uid else '(RFC822)', by_uid)
+            raw = next((item[1] for item in data if isinstance(item, tuple)), None) if status == 'OK' else None
+            if raw is None:
+                raise imaplib.IMAP4.error(f"FETCH of message {key.decode()} failed: {data}")
+            yield key, parse_email_message(raw)
+
+def iter_fetch_messages(mail: imaplib.IMAP4, nums: list[bytes], by_uid: bool = False, chunk_size: Optional[int] = None,
+                        raw: bool = False) -> Iterator[dict]:
+    """
+    Downloads full messages with one FETCH round trip per chunk of `chunk_size`
+    messages and yields them parsed, one by one. Only one chunk of raw messages
+    is held in memory at a time. With IMAP_FETCH_MODE="structure" only the
+    headers and the text part of each message are downloaded.
+    With raw=True full messages are yielded unparsed ({"raw": bytes, "uid"/"seq"})
+    so parsing can run elsewhere; see parse_fetched_message().
+    """
+    chunk_size = chunk_size or settings.IMAP_FETCH_CHUNK_SIZE
+    # The UID sync does not rely on the \\Seen flag, so it leaves it untouched
+    parts = '(BODY.PEEK[])' if by_uid else '(RFC822)'
+    for start in range(0, len(nums), chunk_size):
+        chunk = nums[start:start + chunk_size]
+        if settings.IMAP_FETCH_MODE == "structure":
+            for key, email_data in _iter_fetch_text_parts(mail, chunk, by_uid):
+                email_data["uid" if by_uid else "seq"] = int(key)
+                yield email_data
+            continue
+        status, data = _imap_fetch(mail, _message_set(chunk), parts, by_uid)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"FETCH failed for {len(chunk)} messages: {data}")
+        for item in data:
+            if not isinstance(item, tuple):
+                continue # Closing b')' of each FETCH response
+            key = _fetch_response_key(item[0], by_uid)
+            if raw:
+                yield {"raw": item[1], "uid" if by_uid else "seq": int(key)}
+                continue
+            email_data = parse_email_message(item[1])
+            email_data["uid" if by_uid else "seq"] = int(key)
+            yield email_data
+        del data
+
+def parse_fetched_message(item: dict) -> dict:
+    """
+    Parses a message yielded by iter_fetch_messages(raw=True). Messages fetched
+    in "structure" mode are parsed while fetching and are returned unchanged.
+    """
+    if "raw" not in item:
+        return item
+    key = item.get("uid", item.get("seq"))
+    email_data = parse_email_message(item["raw"])
+    email_data["uid" if "uid" in item else "seq"] = key
+    return email_data
+
+def _stream_and_release(mail: imaplib.IMAP4, nums: list[bytes], by_uid: bool = False, on_complete: Optional[Callable[[], None]] = None,
+                        raw: bool = False) -> Iterator[dict]:
+    """
+    Yields the fetched messages and hands the IMAP session back once the stream
+    is exhausted or closed. `on_complete` runs only if every message was delivered.
+    """
+    count = 0
+    broken = False
+    try:
+        for email_data in iter_fetch_messages(mail, nums, by_uid, raw=raw):
+            count += 1
+            yield email_data
+        if on_complete:
+            on_complete()
+        print(f"Successfully fetched {count} emails.")
+    except Exception as e:
+        broken = True
+        print(f"Error fetching emails after {count} messages: {e}")
+    finally:
+        imap_sessions.release(broken)
+
+def stream_unseen_emails(raw: bool = False) -> Iterator[dict]:
+    """
+    Generator version of fetch_unseen_emails: yields each unseen email as soon
+    as its chunk has been downloaded, so processing can start right away.
+    With raw=True messages are yielded unparsed (see iter_fetch_messages).
+    """
+    try:
+        mail = imap_sessions.acquire('inbox')
     except Exception as e:
         print(f"Error fetching emails: {e}")
-        return []
+        return
+    try:
+        status, email_ids = mail.search(None, 'UNSEEN')
+        email_id_list = _skip_already_stored(mail, email_ids[0].split())
+    except Exception as e:
+        imap_sessions.release(broken=True)
+        print(f"Error fetching emails: {e}")
+        return
+    yield from _stream_and_release(mail, email_id_list, raw=raw)
 
-def send_email_reply(to_address: str, subject: str, body_content: str) -> bool:
+def fetch_unseen_emails():
     """
-    Sends an email reply using the configured SMTP server.
-    Returns True on success, False on failure.
+    Connects to the IMAP server and fetches all unseen emails from the inbox.
+    Only the Message-ID headers are fetched first; full messages are downloaded
+    just for emails that are not already stored in the database.
+    Returns a list of dictionaries, each representing an email.
+    """
+    return list(stream_unseen_emails())
+
+def _select_response_code(mail: imaplib.IMAP4, mailbox: str, code: str) -> Optional[int]:
+    """Reads UIDVALIDITY/UIDNEXT from the SELECT response, falling back to STATUS."""
+    typ, data = mail.response(code)
+    if data and data[0]:
+        return int(data[0])
+    typ, data = mail.status(mailbox, f'({code})')
+    if typ == 'OK' and data and data[0]:
+        match = re.search(rb'%s (\d+)' % code.encode(), data[0])
+        if match:
+            return int(match.group(1))
+    return None
+
+def stream_new_emails(mailbox: str = "inbox", raw: bool = False) -> Tuple[Iterator[dict], dict]:
     """
+    Incremental, flag-independent sync: streams only messages with a UID above the
+    watermark stored for this mailbox. On the first run, or after the server
+    reset UIDVALIDITY, it falls back to the UNSEEN backlog once.
+    Returns a generator of emails (each with its 'uid') and the watermark to save
+    with save_sync_watermark() once they have been processed. The generator fills
+    the watermark in before its first email; it is only marked complete after
+    every message was delivered. Nothing touches the IMAP session until the
+    generator is first advanced, so a stream that is dropped unread holds nothing.
+    With raw=True messages are yielded unparsed (see iter_fetch_messages).
+    """
+    # uidvalidity stays None (and save_sync_watermark() a no-op) until the server answered
+    watermark = {"mailbox": mailbox, "uidvalidity": None, "last_uid": 0, "complete": False}
+    return _stream_new_uids(mailbox, watermark, raw), watermark
+
+def _stream_new_uids(mailbox: str, watermark: dict, raw: bool) -> Iterator[dict]:
     try:
-        msg = MIMEText(body_content)
-        msg['Subject'] = subject
-        msg['From'] = settings.EMAIL_ADDRESS
-        msg['To'] = to_address
+        mail = imap_sessions.acquire(mailbox)
+    except Exception as e:
+        print(f"Error fetching emails: {e}")
+        return
+    try:
+        uidvalidity = _select_response_code(mail, mailbox, 'UIDVALIDITY')
+        state = get_mailbox_state(mailbox)
+        if state and state[0] == uidvalidity:
+            last_uid = state[1]
+            status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+            # 'n:*' always matches the highest UID, even when it is below n
+            uids = [uid for uid in data[0].split() if int(uid) > last_uid]
+        else:
+            if state:
+                print(f"UIDVALIDITY of '{mailbox}' changed ({state[0]} -> {uidvalidity}). Resynchronizing.")
+            uidnext = _select_response_code(mail, mailbox, 'UIDNEXT')
+            last_uid = uidnext - 1 if uidnext else 0
+            status, data = mail.uid('SEARCH', None, 'UNSEEN')
+            uids = data[0].split()
+        new_uids = _skip_already_stored(mail, uids, by_uid=True)
+    except Exception as e:
+        imap_sessions.release(broken=True)
+        print(f"Error fetching emails: {e}")
+        return
+    watermark.update(uidvalidity=uidvalidity, last_uid=max([last_uid] + [int(uid) for uid in uids]))
+    print(f"Fetching {len(new_uids)} new emails from '{mailbox}' (UID watermark {watermark['last_uid']}).")
+    yield from _stream_and_release(mail, new_uids, by_uid=True, on_complete=lambda: watermark.update(complete=True), raw=raw)
 
-        with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-            server.starttls() # Secure the connection
+def fetch_new_emails(mailbox: str = "inbox") -> Tuple[list[dict], Optional[dict]]:
+    """
+    List version of stream_new_emails.
+    """
+    stream, watermark = stream_new_emails(mailbox)
+    return list(stream), watermark
+
+def save_sync_watermark(watermark: Optional[dict]):
+    """
+    Persists the watermark returned by stream_new_emails after processing succeeded.
+    Incomplete fetches are not saved; the next sync re-checks those UIDs and the
+    header-first check skips the ones that were already stored.
+    """
+    if watermark and watermark["complete"] and watermark["uidvalidity"] is not None:
+        save_mailbox_state(watermark["mailbox"], watermark["uidvalidity"], watermark["last_uid"])
+
+def defer_emails(emails: list[dict], watermark: Optional[dict]):
+    """
+    Makes sure deferred (unstored) emails are fetched again by the next run: in
+    UID mode the watermark is held just below the lowest deferred UID; in UNSEEN
+    mode their \\Seen flag is cleared again.
+    """
+    if not emails:
+        return
+    uids = [e["uid"] for e in emails if "uid" in e]
+    if watermark and uids:
+        watermark["last_uid"] = min(watermark["last_uid"], min(uids) - 1)
+    seqs = [str(e["seq"]).encode() for e in emails if "seq" in e]
+    if seqs:
+        try:
+            with imap_sessions.session('inbox') as mail:
+                mail.store(_message_set(seqs), '-FLAGS', '\\Seen')
+        except Exception as e:
+            print(f"Error clearing \\Seen on {len(seqs)} deferred emails: {e}")
+    print(f"Deferred {len(emails)} emails to the next run.")
+
+def build_reply_message(to_address: str, subject: str, body_content: str) -> MIMEText:
+    msg = MIMEText(body_content)
+    msg['Subject'] = subject
+    msg['From'] = settings.EMAIL_ADDRESS
+    msg['To'] = to_address
+    return msg
+
+class SmtpSender:
+    """
+    Persistent, authenticated SMTP session that sends many replies over one
+    connection instead of one STARTTLS + LOGIN per message. The session is
+    reconnected transparently when the server drops it, when it has been idle
+    for `idle_timeout` seconds, or after `max_messages_per_session` messages
+    (providers cap messages per connection).
+    """
+
+    def __init__(self, idle_timeout: float, max_messages_per_session: int):
+        self.idle_timeout = idle_timeout
+        self.max_messages_per_session = max_messages_per_session
+        self._lock = threading.Lock()
+        self._server: Optional[smtplib.SMTP] = None
+        self._sent_in_session = 0
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT, timeout=30)
+        try:
+            if settings.MAIL_USE_TLS:
+                server.starttls() # Secure the connection
             server.login(settings.EMAIL_ADDRESS, settings.EMAIL_APP_PASSWORD)
-            server.send_message(msg)
-        print(f"Reply sent to {to_address} with subject: '{subject}'")
-        return True
-    except Exception as e:
-        print(f"Error sending email reply to {to_address}: {e}")
-        return False
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._sent_in_session = 0
+
+    def _disconnect(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+    def _ensure_connected(self):
+        if self._server is not None:
+            if self._sent_in_session >= self.max_messages_per_session:
+                self._disconnect()
+            elif time.monotonic() - self._last_used > self.idle_timeout:
+                try:
+                    code, _ = self._server.noop()
+                    if code != 250:
+                        self._disconnect()
+                except Exception:
+                    self._disconnect()
+        if self._server is None:
+            self._connect()
+
+    def send_many(self, messages: list[Tuple[str, str, str]]) -> list[bool]:
+        """
+        Sends (to_address, subject, body) replies over the shared session.
+        Returns one success flag per message, in order.
+        """
+        results = []
+        with self._lock:
+            for to_address, subject, body_content in messages:
+                msg = build_reply_message(to_address, subject, body_content)
+                success = False
+                for attempt in range(2): # One transparent reconnect per message
+                    try:
+                        self._ensure_connected()
+                        with SMTP_SEND_LATENCY.time():
+                            self._server.send_message(msg)
+                        self._sent_in_session += 1
+                        success = True
+                        print(f"Reply sent to {to_address} with subject: '{subject}'")
+                        break
+                    except Exception as e:
+                        if self._is_connection_error(e):
+                            self._disconnect()
+                            if attempt == 0:
+                                print(f"SMTP connection lost while sending to {to_address} ({e}). Reconnecting.")
+                                continue
+                        # Refused recipient, message too large, ...: retrying will not help
+                        print(f"Error sending email reply to {to_address}: {e}")
+                        break
+                    finally:
+                        self._last_used = time.monotonic()
+                results.append(success)
+        return results
+
+    @staticmethod
+    def _is_connection_error(error: Exception) -> bool:
+        """True if the session is unusable and a fresh connection may succeed."""
+        if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+            return True
+        if isinstance(error, smtplib.SMTPResponseException) and error.smtp_code == 421:
+            return True # Service not available, closing transmission channel
+        # SMTPException derives from OSError, so only plain socket errors are left here
+        return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+    def send(self, to_address: str, subject: str, body_content: str) -> bool:
+        return self.send_many([(to_address, subject, body_content)])[0]
+
+    def close(self):
+        """Ends the SMTP session cleanly; called at application shutdown."""
+        with self._lock:
+            if self._server is not None:
+                self._disconnect()
+                print("SMTP session closed.")
+
+# Shared sender used for all replies
+smtp_sender = SmtpSender(
+    idle_timeout=settings.SMTP_IDLE_TIMEOUT_SECONDS,
+    max_messages_per_session=settings.SMTP_MAX_MESSAGES_PER_SESSION,
+)
+
+def send_email_reply(to_address: str, subject: str, body_content: str) -> bool:
+    """
+    Sends an email reply using the shared SMTP session.
+    Returns True on success, False on failure.
+    """
+    return smtp_sender.send(to_address, subject, body_content)
 
 if __name__ == "__main__":
     # Example usage for testing the email client
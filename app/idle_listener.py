@@ -0,0 +1,137 @@
+import imaplib
+import re
+import socket
+import threading
+from typing import Callable, Optional
+
+from app.config import settings
+from app.email_client import open_imap_connection
+
+_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS')
+
+class ImapIdleListener:
+    """
+    Keeps a dedicated IMAP connection in IDLE mode (RFC 2177) and calls
+    `on_new_mail` as soon as the server announces new messages, instead of
+    waiting for the next /check-mails poll. The IDLE command is re-issued every
+    `idle_timeout` seconds, well below the 29 minute server limit.
+    """
+
+    def __init__(self, on_new_mail: Callable[[], object], mailbox: str = "inbox", idle_timeout: Optional[int] = None):
+        self.on_new_mail = on_new_mail
+        self.mailbox = mailbox
+        self.idle_timeout = idle_timeout or settings.IMAP_IDLE_TIMEOUT_SECONDS
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._mail: Optional[imaplib.IMAP4] = None
+        self._buffer = b""
+        self._tag_counter = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="imap-idle", daemon=True)
+        self._thread.start()
+        print(f"IMAP IDLE listener started for '{self.mailbox}'.")
+
+    def stop(self):
+        self._stop_event.set()
+        mail = self._mail
+        if mail is not None:
+            try:
+                mail.shutdown() # Unblocks a pending read
+            except Exception:
+                pass
+        if self._thread:
+            self._thread.join(timeout=5)
+        print("IMAP IDLE listener stopped.")
+
+    def _run(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            try:
+                self._mail = open_imap_connection()
+                self._mail.login(settings.EMAIL_ADDRESS, settings.EMAIL_APP_PASSWORD)
+                self._mail.select(self.mailbox)
+                backoff = 1
+                self._process() # Catch up on anything that arrived while disconnected
+                while not self._stop_event.is_set():
+                    if self._idle():
+                        self._process()
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                print(f"IMAP IDLE connection error: {e}. Reconnecting in {backoff}s.")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 300)
+            finally:
+                self._close()
+
+    def _process(self):
+        try:
+            self.on_new_mail()
+        except Exception as e:
+            print(f"Error processing new mail from IDLE listener: {e}")
+
+    def _idle(self) -> bool:
+        """
+        Runs one IDLE cycle. Returns True if the server reported new messages,
+        False if the cycle timed out without activity.
+        """
+        self._tag_counter += 1
+        tag = b"IDLE%d" % self._tag_counter
+        sock = self._mail.socket()
+        sock.sendall(tag + b" IDLE\r\n")
+        line = self._readline(sock, timeout=30)
+        if line is None or not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"Server refused IDLE: {line!r}")
+
+        new_mail = False
+        while not new_mail and not self._stop_event.is_set():
+            line = self._readline(sock, timeout=self.idle_timeout)
+            if line is None:
+                break # Refresh the IDLE command
+            if _EXISTS_RE.match(line):
+                new_mail = True
+
+        sock.sendall(b"DONE\r\n")
+        while True:
+            line = self._readline(sock, timeout=30)
+            if line is None:
+                raise imaplib.IMAP4.abort("Timed out waiting for IDLE to complete")
+            if line.startswith(tag + b" "):
+                if not line.startswith(tag + b" OK"):
+                    raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+                return new_mail
+            if _EXISTS_RE.match(line):
+                new_mail = True
+
+    def _readline(self, sock: socket.socket, timeout: float) -> Optional[bytes]:
+        """
+        Reads one CRLF-terminated line straight from the socket. Returns None on
+        timeout. imaplib's own buffered reader is not used here because it cannot
+        be read again after a timeout.
+        """
+        sock.settimeout(timeout)
+        try:
+            while b"\r\n" not in self._buffer:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise imaplib.IMAP4.abort("Connection closed by server")
+                self._buffer += chunk
+        except (socket.timeout, TimeoutError):
+            return None
+        finally:
+            sock.settimeout(None)
+        line, self._buffer = self._buffer.split(b"\r\n", 1)
+        return line
+
+    def _close(self):
+        mail, self._mail = self._mail, None
+        self._buffer = b""
+        if mail is not None:
+            try:
+                mail.logout()
+            except Exception:
+                pass
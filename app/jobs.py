@@ -0,0 +1,125 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from app.config import settings
+
+class Job:
+    """
+    A mailbox check running in the background. The counters are updated by the
+    worker thread while the job runs and read by GET /jobs/{id}.
+    """
+
+    def __init__(self, key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.key = key # Jobs with the same key never run concurrently (e.g. the mailbox name)
+        self.status = "queued" # queued -> running -> completed | failed
+        self.fetched = 0
+        self.classified = 0
+        self.replied = 0 # Replies queued in the outbox
+        self.stored = 0
+        self.deferred = 0
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the job has finished. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def add(self, fetched: int = 0, classified: int = 0, replied: int = 0, stored: int = 0, deferred: int = 0):
+        with self._lock:
+            self.fetched += fetched
+            self.classified += classified
+            self.replied += replied
+            self.stored += stored
+            self.deferred += deferred
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "fetched": self.fetched,
+                "classified": self.classified,
+                "replied": self.replied,
+                "stored": self.stored,
+                "deferred": self.deferred,
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+class JobManager:
+    """
+    Runs jobs on a single background worker thread, so the blocking IMAP, LLM,
+    SMTP and SQLite work never runs on the event loop, and keeps the most recent
+    `history_size` jobs for status queries. Submitting with a `key` is
+    single-flight: while a job with that key is queued or running, callers get
+    that job back instead of starting another one.
+    """
+
+    def __init__(self, history_size: int):
+        self.history_size = history_size
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._active: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail-job")
+
+    def submit(self, target: Callable[[Job], object], key: Optional[str] = None) -> Job:
+        """
+        Queues `target(job)` and returns the job right away, or returns the job
+        already in progress for `key`.
+        """
+        with self._lock:
+            if key is not None and key in self._active:
+                return self._active[key]
+            job = Job(key)
+            if key is not None:
+                self._active[key] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history_size:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break # Never forget a job that is still in progress
+                self._jobs.popitem(last=False)
+        self._executor.submit(self._run, job, target)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, target: Callable[[Job], object]):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            result = target(job)
+            job.result = result.model_dump() if hasattr(result, "model_dump") else result
+            job.status = "completed"
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if job.key is not None and self._active.get(job.key) is job:
+                    del self._active[job.key]
+            job._done.set()
+
+    def shutdown(self):
+        """Lets the running job finish and drops queued ones."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+# Shared job manager used by POST /check-mails
+job_manager = JobManager(history_size=settings.JOB_HISTORY_SIZE)
@@ -1,51 +1,179 @@
-from typing import List
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Tuple
 from langchain_groq import ChatGroq # Changed from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
 from langgraph.graph import StateGraph, END
 
-from app.schemas import AgentState
-from app.email_client import send_email_reply
-from app.database import store_email_data, get_email_by_message_id
+from app.schemas import AgentState, ClassificationResult
+from app.outbox import outbox_dispatcher
+from app.database import store_emails_bulk
 from app.config import settings
+from app.classification_cache import classification_cache, content_hash
+from app.pre_classifier import pre_classify
+from app.preprocess import prompt_body
+from app.utils import estimate_tokens, iter_batches
+from app.llm_client import LLMUnavailableError, create_llm_client, run_on_llm_loop
+from app.metrics import CACHE_LOOKUPS, EMAILS_CLASSIFIED, PRECLASSIFIER_HITS, timed_node
+from app.cascade import LARGE_TIER, SMALL_TIER, cascade_stats, needs_escalation, parse_label_and_confidence
 import re
 
 # Initialize the LLM with the API key from settings
 # Changed ChatOpenAI to ChatGroq and parameter from openai_api_key to groq_api_key
-llm = ChatGroq(model="llama3-8b-8192", temperature=0, groq_api_key=settings.GROQ_API_KEY) # You can choose other Groq models like 'mixtral-8x7b-32768' or 'llama3-70b-8192'
+# Retries are handled by the rate-limited wrapper, so the Groq client's own are disabled
+llm = create_llm_client(ChatGroq(model=settings.LLM_MODEL, temperature=0, groq_api_key=settings.GROQ_API_KEY, max_retries=0)) # You can choose other Groq models like 'mixtral-8x7b-32768' or 'llama3-70b-8192'
+# Second tier of the classification cascade; only used when CASCADE_ENABLED is set
+large_llm = create_llm_client(ChatGroq(model=settings.LLM_LARGE_MODEL, temperature=0, groq_api_key=settings.GROQ_API_KEY, max_retries=0))
 
 # --- Nodes for the LangGraph Workflow ---
 
-def fetch_and_set_email(state: AgentState) -> AgentState:
+VALID_CLASSIFICATIONS = ["SPAM", "Unwanted", "Important"]
+# Marker for emails that could not be classified because the LLM is unavailable.
+# They are not stored, so a later run picks them up again.
+DEFERRED = "Deferred"
+
+def build_classification_prompt(subject: str, body: str, with_confidence: bool = False) -> str:
     """
-    Fetches the next email from the batch and sets it as the current_email in the state.
-    If no more emails, sets current_email to None and signals end.
+    Builds the single-email classification prompt sent to the LLM. With
+    `with_confidence` (first tier of the cascade) the model is also asked how
+    sure it is.
     """
-    emails = state.get("emails", [])
-    current_index = state.get("current_email_index", 0)
+    if with_confidence:
+        return f"""
+    Please classify the following email into one of these three categories:
+    - SPAM
+    - Unwanted (non-spam but irrelevant)
+    - Important for Business
 
-    if current_index < len(emails):
-        current_email = emails[current_index]
-        print(f"Processing email {current_index + 1}/{len(emails)}: '{current_email['subject']}'")
-        return {
-            "current_email": current_email,
-            "current_email_index": current_index + 1, # Increment for the next iteration
-            "classification": None,
-            "response_generated": False,
-            "response_sent": False
-        }
-    else:
-        print("No more emails to process in this batch.")
-        return {
-            "current_email": None, # Signal no more emails
-            "current_email_index": current_index,
-            "classification": None,
-            "response_generated": False,
-            "response_sent": False
-        }
+    Email Subject: {subject}
+    Email Body: {body}
+
+    Answer with the category (SPAM, Unwanted, or Important) followed by your confidence between 0 and 1, for example: SPAM 0.95
+    """
+    return f"""
+    Please classify the following email into one of these three categories:
+    - SPAM
+    - Unwanted (non-spam but irrelevant)
+    - Important for Business
+
+    Email Subject: {subject}
+    Email Body: {body}
+
+    Your classification should be a single word: SPAM, Unwanted, or Important.
+    """
+
+# Where a classification came from, stored with the email. Only "llm" labels
+# train and evaluate the pre-classifier, so it never learns from its own output.
+SOURCE_LLM = "llm"
+SOURCE_CACHE = "cache"
+SOURCE_PRECLASSIFIER = "preclassifier"
+SOURCE_FALLBACK = "fallback" # 'Unwanted' after an error or an unusable answer
+
+def parse_classification(content: str) -> str:
+    """
+    Validates the raw LLM output, falling back to 'Unwanted' for anything unexpected.
+    """
+    classification = content.strip()
+    # Basic sanitization/validation of LLM output
+    if classification not in VALID_CLASSIFICATIONS:
+        print(f"LLM returned unexpected classification: '{classification}'. Defaulting to Unwanted.")
+        classification = "Unwanted" # Fallback for unexpected LLM output
+    return classification
+
+def lookup_local_classification(email_data: dict) -> Optional[Tuple[str, str]]:
+    """
+    Tries to classify an email without calling the LLM: first from the cache of
+    earlier LLM answers, then with the local pre-classifier for clear SPAM/Unwanted
+    cases. Returns (classification, source) or None if the LLM is needed.
+    """
+    subject = email_data.get("subject", "")
+    body = email_data.get("body", "")
+    if settings.CLASSIFICATION_CACHE_ENABLED:
+        cached = classification_cache.get(subject, body)
+        CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+        if cached:
+            return cached, SOURCE_CACHE
+    if settings.PRECLASSIFIER_ENABLED:
+        predicted = pre_classify(subject, email_data.get("sender", ""), body)
+        if predicted:
+            PRECLASSIFIER_HITS.inc()
+            return predicted, SOURCE_PRECLASSIFIER
+    return None
+
+def is_llm_decision(raw_content: str, classification: str) -> bool:
+    """True when the LLM answered with a valid label rather than triggering the 'Unwanted' fallback."""
+    label, confidence = parse_label_and_confidence(raw_content)
+    return raw_content.strip() == classification or (label == classification and confidence is not None)
+
+def remember_classification(subject: str, body: str, raw_content: str, classification: str) -> str:
+    """
+    Caches a classification, but only when it was an LLM decision. Returns
+    the source to store with the email.
+    """
+    if not is_llm_decision(raw_content, classification):
+        return SOURCE_FALLBACK
+    if settings.CLASSIFICATION_CACHE_ENABLED:
+        classification_cache.put(subject, body, classification)
+    return SOURCE_LLM
+
+def _small_tier_verdict(subject: str, content: str, started: float) -> Optional[str]:
+    """
+    Records a first-tier answer and returns its label, or None if the email
+    has to be escalated to the large model.
+    """
+    label, confidence = parse_label_and_confidence(content)
+    if needs_escalation(label, confidence):
+        cascade_stats.record(SMALL_TIER, time.perf_counter() - started, escalated=1)
+        print(f"Escalating '{subject}' to the large model (small model answered {label} with confidence {confidence}).")
+        return None
+    cascade_stats.record(SMALL_TIER, time.perf_counter() - started, settled=1)
+    return label
+
+def classify_with_cascade(subject: str, body: str) -> Tuple[str, str]:
+    """
+    Classifies one email with the LLM. With CASCADE_ENABLED the small model
+    answers first and only unsure or 'Important' answers go to the large model.
+    Returns (classification, raw answer of the deciding model).
+    """
+    if not settings.CASCADE_ENABLED:
+        response = llm.invoke([HumanMessage(content=build_classification_prompt(subject, body))])
+        return parse_classification(response.content), response.content
+
+    started = time.perf_counter()
+    response = llm.invoke([HumanMessage(content=build_classification_prompt(subject, body, with_confidence=True))])
+    label = _small_tier_verdict(subject, response.content, started)
+    if label:
+        return label, response.content
+    started = time.perf_counter()
+    response = large_llm.invoke([HumanMessage(content=build_classification_prompt(subject, body))])
+    cascade_stats.record(LARGE_TIER, time.perf_counter() - started, settled=1)
+    return parse_classification(response.content), response.content
+
+async def aclassify_with_cascade(subject: str, body: str) -> Tuple[str, str]:
+    """Async counterpart of classify_with_cascade."""
+    if not settings.CASCADE_ENABLED:
+        response = await llm.ainvoke([HumanMessage(content=build_classification_prompt(subject, body))])
+        return parse_classification(response.content), response.content
+
+    started = time.perf_counter()
+    response = await llm.ainvoke([HumanMessage(content=build_classification_prompt(subject, body, with_confidence=True))])
+    label = _small_tier_verdict(subject, response.content, started)
+    if label:
+        return label, response.content
+    return await aclassify_large(subject, body)
+
+async def aclassify_large(subject: str, body: str) -> Tuple[str, str]:
+    """Classifies one email with the large model (second tier of the cascade)."""
+    started = time.perf_counter()
+    response = await large_llm.ainvoke([HumanMessage(content=build_classification_prompt(subject, body))])
+    cascade_stats.record(LARGE_TIER, time.perf_counter() - started, settled=1)
+    return parse_classification(response.content), response.content
 
 def classify_email(state: AgentState) -> AgentState:
     """
     Uses the LLM to classify the current email into SPAM, Unwanted, or Important.
+    If the email was already classified in parallel mode, that result is reused.
     """
     current_email = state["current_email"]
     if not current_email:
@@ -56,30 +184,260 @@ def classify_email(state: AgentState) -> AgentState:
     subject = current_email.get("subject", "")
     body = current_email.get("body", "")
 
-    prompt = f"""
-    Please classify the following email into one of these three categories:
-    - SPAM
-    - Unwanted (non-spam but irrelevant)
-    - Important for Business
+    if current_email.get("classification"):
+        # Classified ahead of time by classify_emails_concurrently
+        print(f"Email Classified: '{current_email['classification']}' for subject: '{subject}' (parallel mode)")
+        return {"classification": current_email["classification"]}
 
-    Email Subject: {subject}
-    Email Body: {body}
+    local = lookup_local_classification(current_email)
+    if local:
+        print(f"Email Classified: '{local[0]}' for subject: '{subject}' ({local[1]})")
+        current_email["classification_source"] = local[1]
+        return {"classification": local[0]}
 
-    Your classification should be a single word: SPAM, Unwanted, or Important.
-    """
     try:
-        response = llm.invoke([HumanMessage(content=prompt)])
-        classification = response.content.strip()
-        # Basic sanitization/validation of LLM output
-        if classification not in ["SPAM", "Unwanted", "Important"]:
-            print(f"LLM returned unexpected classification: '{classification}'. Defaulting to Unwanted.")
-            classification = "Unwanted" # Fallback for unexpected LLM output
+        classification, raw_content = classify_with_cascade(subject, prompt_body(current_email))
+        current_email["classification_source"] = remember_classification(subject, body, raw_content, classification)
         print(f"Email Classified: '{classification}' for subject: '{subject}'")
         return {"classification": classification}
+    except LLMUnavailableError as e:
+        print(f"LLM unavailable ({e}). Deferring email '{subject}' to a later run.")
+        return {"classification": DEFERRED}
     except Exception as e:
         print(f"Error classifying email with LLM: {e}. Defaulting to Unwanted.")
+        current_email["classification_source"] = SOURCE_FALLBACK
         return {"classification": "Unwanted"} # Handle LLM errors gracefully
 
+async def aclassify_email(email_data: dict, semaphore: asyncio.Semaphore) -> str:
+    """
+    Async counterpart of classify_email for a single email dict.
+    The semaphore bounds how many LLM requests are in flight at once.
+    """
+    local = lookup_local_classification(email_data)
+    if local:
+        print(f"Email Classified: '{local[0]}' for subject: '{email_data.get('subject', '')}' ({local[1]})")
+        email_data["classification_source"] = local[1]
+        return local[0]
+    return await allm_classify_email(email_data, semaphore)
+
+async def allm_classify_email(email_data: dict, semaphore: asyncio.Semaphore, large: bool = False) -> str:
+    """
+    Classifies one email with its own LLM request, skipping the local lookups.
+    `large` goes straight to the large model, for batch answers the cascade
+    escalated. Records the source of the result on `email_data`.
+    """
+    subject = email_data.get("subject", "")
+    body = email_data.get("body", "")
+    classify = aclassify_large if large else aclassify_with_cascade
+    async with semaphore:
+        try:
+            classification, raw_content = await classify(subject, prompt_body(email_data))
+            email_data["classification_source"] = remember_classification(subject, body, raw_content, classification)
+        except LLMUnavailableError as e:
+            print(f"LLM unavailable ({e}). Deferring email '{subject}' to a later run.")
+            return DEFERRED
+        except Exception as e:
+            print(f"Error classifying email with LLM: {e}. Defaulting to Unwanted.")
+            email_data["classification_source"] = SOURCE_FALLBACK
+            classification = "Unwanted"
+    print(f"Email Classified: '{classification}' for subject: '{subject}'")
+    return classification
+
+BATCH_PROMPT_OVERHEAD_TOKENS = 150 # Instructions shared by every email in a batch
+BATCH_EMAIL_OVERHEAD_TOKENS = 25 # JSON keys, message_id and the answer object per email
+
+def pack_classification_batches(emails: List[dict], token_budget: int, max_emails: int) -> List[List[dict]]:
+    """
+    Greedily groups emails, in order, into batches whose estimated prompt size
+    stays within `token_budget`. An email too large for the budget on its own
+    gets a batch of one. Message IDs are unique within a batch so the answers
+    can be matched back.
+    """
+    batches: List[List[dict]] = []
+    current: List[dict] = []
+    current_tokens = BATCH_PROMPT_OVERHEAD_TOKENS
+    for email_data in emails:
+        tokens = estimate_tokens(email_data.get("subject", "")) + estimate_tokens(prompt_body(email_data)) + BATCH_EMAIL_OVERHEAD_TOKENS
+        duplicate_id = any(e.get("message_id") == email_data.get("message_id") for e in current)
+        if current and (len(current) >= max_emails or current_tokens + tokens > token_budget or duplicate_id):
+            batches.append(current)
+            current, current_tokens = [], BATCH_PROMPT_OVERHEAD_TOKENS
+        current.append(email_data)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def build_batch_classification_prompt(emails: List[dict], with_confidence: bool = False) -> str:
+    """
+    Builds one prompt that classifies several emails and asks for a JSON array,
+    optionally with a confidence per email for the cascade.
+    """
+    items = json.dumps(
+        [{"message_id": e.get("message_id"), "subject": e.get("subject", ""), "body": prompt_body(e)} for e in emails],
+        ensure_ascii=False
+    )
+    confidence_example = ', "confidence": 0.95' if with_confidence else ""
+    confidence_rule = "\n    Each confidence is a number between 0 and 1 saying how sure you are." if with_confidence else ""
+    return f"""
+    Please classify each of the following emails into one of these three categories:
+    - SPAM
+    - Unwanted (non-spam but irrelevant)
+    - Important for Business
+
+    Emails (JSON): {items}
+
+    Respond with only a JSON array containing one object per email, for example:
+    [{{"message_id": "<message_id of the email>", "classification": "SPAM"{confidence_example}}}]
+    Each classification must be a single word: SPAM, Unwanted, or Important.{confidence_rule}
+    """
+
+def parse_batch_classification(content: str, message_ids: List[str]) -> Dict[str, ClassificationResult]:
+    """
+    Extracts the JSON array from a batched LLM answer and validates each item
+    against ClassificationResult. Returns {message_id: result} for the valid
+    items that belong to the batch; anything else is left out so the caller
+    can classify those emails individually.
+    """
+    start, end = content.find("["), content.rfind("]")
+    if start == -1 or end < start:
+        print("Batched classification response contained no JSON array.")
+        return {}
+    try:
+        items = json.loads(content[start:end + 1])
+    except json.JSONDecodeError as e:
+        print(f"Batched classification response is not valid JSON: {e}")
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    expected = set(message_ids)
+    results = {}
+    for item in items:
+        try:
+            result = ClassificationResult.model_validate(item)
+        except Exception:
+            continue
+        if result.message_id in expected:
+            results[result.message_id] = result
+    return results
+
+async def aclassify_batch(emails: List[dict], semaphore: asyncio.Semaphore) -> List[str]:
+    """
+    Classifies a packed batch with a single LLM request. Emails whose answer is
+    missing or invalid are retried with their own single-email prompt.
+    """
+    if len(emails) == 1:
+        return [await allm_classify_email(emails[0], semaphore)]
+
+    cascade = settings.CASCADE_ENABLED
+    prompt = build_batch_classification_prompt(emails, with_confidence=cascade)
+    message_ids = [e.get("message_id") for e in emails]
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            response = await llm.ainvoke([HumanMessage(content=prompt)])
+            parsed = parse_batch_classification(response.content, message_ids)
+        except LLMUnavailableError as e:
+            print(f"LLM unavailable ({e}). Deferring {len(emails)} emails to a later run.")
+            return [DEFERRED] * len(emails)
+        except Exception as e:
+            print(f"Error classifying batch of {len(emails)} emails with LLM: {e}. Falling back to single prompts.")
+            parsed = {}
+        latency = time.perf_counter() - started
+    results = {message_id: result.classification for message_id, result in parsed.items()}
+
+    escalate = []
+    if cascade and parsed:
+        escalate = [e for e in emails if e.get("message_id") in parsed
+                    and needs_escalation(parsed[e.get("message_id")].classification, parsed[e.get("message_id")].confidence)]
+        cascade_stats.record(SMALL_TIER, latency, settled=len(parsed) - len(escalate), escalated=len(escalate))
+        escalated = await asyncio.gather(*(allm_classify_email(e, semaphore, large=True) for e in escalate))
+        results.update(zip((e.get("message_id") for e in escalate), escalated))
+
+    missing = [e for e in emails if e.get("message_id") not in results]
+    missing_ids = {id(e) for e in missing + escalate}
+    fallback = await asyncio.gather(*(allm_classify_email(e, semaphore) for e in missing))
+    results.update(zip((e.get("message_id") for e in missing), fallback))
+
+    classifications = []
+    for email_data in emails:
+        classification = results[email_data.get("message_id")]
+        if id(email_data) not in missing_ids:
+            email_data["classification_source"] = SOURCE_LLM
+            if settings.CLASSIFICATION_CACHE_ENABLED:
+                classification_cache.put(email_data.get("subject", ""), email_data.get("body", ""), classification)
+            print(f"Email Classified: '{classification}' for subject: '{email_data.get('subject', '')}' (batched)")
+        classifications.append(classification)
+    print(f"Batch-classified {len(emails)} emails in one request ({len(missing)} needed a single prompt, {len(escalate)} escalated).")
+    return classifications
+
+async def classify_emails_concurrently(emails: List[dict], max_concurrency: Optional[int] = None) -> List[dict]:
+    """
+    Classifies a whole batch with the async LLM interface, at most `max_concurrency`
+    requests at a time. Emails that the cache or pre-classifier cannot settle are
+    packed several to a prompt (see CLASSIFICATION_BATCH_MAX_EMAILS). Each email
+    dict gets a 'classification' key, which classify_email then picks up, so the
+    graph still applies and stores results in batch order.
+    """
+    limit = max_concurrency or settings.LLM_MAX_CONCURRENCY
+    semaphore = asyncio.Semaphore(max(1, limit))
+    # With the cache on, near-identical emails within one batch share a single
+    # classification; without it only repeats of the same message do
+    def batch_key(email_data: dict) -> str:
+        if settings.CLASSIFICATION_CACHE_ENABLED:
+            return content_hash(email_data.get("subject", ""), email_data.get("body", ""))
+        return email_data.get("message_id") or str(id(email_data))
+
+    unique_emails = {}
+    for email_data in emails:
+        unique_emails.setdefault(batch_key(email_data), email_data)
+
+    by_key = {}
+    needs_llm = []
+    for key, email_data in unique_emails.items():
+        local = lookup_local_classification(email_data)
+        if local:
+            print(f"Email Classified: '{local[0]}' for subject: '{email_data.get('subject', '')}' ({local[1]})")
+            email_data["classification_source"] = local[1]
+            by_key[key] = local[0]
+        else:
+            needs_llm.append(email_data)
+
+    batches = pack_classification_batches(
+        needs_llm, settings.CLASSIFICATION_BATCH_TOKEN_BUDGET, max(1, settings.CLASSIFICATION_BATCH_MAX_EMAILS)
+    )
+    # gather() returns results in input order regardless of completion order
+    batch_results = await asyncio.gather(*(aclassify_batch(batch, semaphore) for batch in batches))
+    for batch, classifications in zip(batches, batch_results):
+        for email_data, classification in zip(batch, classifications):
+            by_key[batch_key(email_data)] = classification
+
+    for email_data in emails:
+        key = batch_key(email_data)
+        first = unique_emails[key]
+        email_data["classification"] = by_key[key]
+        source = first.get("classification_source")
+        if source == SOURCE_LLM and email_data.get("message_id") != first.get("message_id"):
+            source = SOURCE_CACHE # Another email's answer, not an LLM decision about this one
+        email_data["classification_source"] = source
+    print(f"Classified {len(emails)} emails concurrently with {len(batches)} LLM requests (max {limit} in flight).")
+    return emails
+
+def classify_emails(emails: List[dict], max_concurrency: Optional[int] = None) -> List[dict]:
+    """
+    Blocking entry point to classify_emails_concurrently for synchronous callers.
+    Runs on the shared LLM event loop (see run_on_llm_loop), never on a new one.
+    """
+    return run_on_llm_loop(classify_emails_concurrently(emails, max_concurrency))
+
+def classify_email_node(state: AgentState) -> AgentState:
+    """Graph node around classify_email that counts the outcome per classification."""
+    result = classify_email(state)
+    if state["current_email"]:
+        EMAILS_CLASSIFIED.inc(classification=result["classification"])
+    return result
+
 def generate_response(state: AgentState) -> AgentState:
     """
     Generates a fixed response for 'Important for Business' emails.
@@ -96,7 +454,10 @@ def generate_response(state: AgentState) -> AgentState:
 
 def send_email_response(state: AgentState) -> AgentState:
     """
-    Sends the generated email reply. Includes a check to prevent duplicate sends.
+    Prepares the reply for the outbox. It is written in the same transaction as
+    the email itself by store_email_results and sent by the background outbox
+    dispatcher, so SMTP never blocks the graph run. The outbox's unique
+    message_id prevents duplicate replies, even across overlapping runs.
     """
     current_email = state["current_email"]
     response_generated = state["response_generated"]
@@ -110,49 +471,80 @@ def send_email_response(state: AgentState) -> AgentState:
         subject = "Appointment Confirmed"
         body = "Thank you for your email. Your request has been noted, and the appointment has been fixed. Looking forward to connecting with you."
 
-        # Check if a reply has already been sent for this message_id
-        # This acts as a simple rate-limiting/duplicate avoidance mechanism
-        message_id = current_email.get("message_id")
-        db_email_data = get_email_by_message_id(message_id)
-        if db_email_data and db_email_data[6]: # Assuming index 6 is response_sent (boolean)
-            print(f"Reply already sent for message ID: '{message_id}'. Skipping send.")
-            return {"response_sent": True} # Mark as sent even if skipped to update DB
-
-        success = send_email_reply(to_address, subject, body)
-        return {"response_sent": success}
+        # response_sent is set by the dispatcher once the reply has actually gone out
+        return {
+            "pending_reply": {"to_address": to_address, "subject": subject, "body": body},
+            "response_sent": False
+        }
     print("No response generated or no current email to send reply for.")
-    return {"response_sent": False}
+    return {"pending_reply": None, "response_sent": False}
 
-def store_email_data_node(state: AgentState) -> AgentState:
+def flush_email_records(records: List[dict]):
     """
-    Stores the current email's details, classification, and response status in the database.
+    Writes buffered email records (and their queued replies) in one transaction.
     """
-    current_email = state["current_email"]
-    classification = state["classification"]
-    response_sent = state["response_sent"]
-
-    if current_email:
-        message_id = current_email.get("message_id")
-        subject = current_email.get("subject")
-        sender = current_email.get("sender")
-        body = current_email.get("body")
-        # Ensure classification is not None before storing
-        final_classification = classification if classification else "Unclassified"
-        store_email_data(message_id, subject, sender, body, final_classification, response_sent)
-        print(f"Email '{subject}' (ID: {message_id}) stored with classification '{final_classification}' and response_sent={response_sent}")
-    else:
-        print("No current email data to store.")
-    return {} # No state change needed after storing, just side effect
+    try:
+        queued = store_emails_bulk(records)
+    except Exception as e:
+        print(f"Error storing batch of {len(records)} emails: {e}")
+        raise
+    if queued:
+        outbox_dispatcher.wake()
+
+def new_email_state(email_data: dict) -> AgentState:
+    """Initial state of a per-email sub-run."""
+    return {
+        "current_email": email_data,
+        "classification": None,
+        "response_generated": False,
+        "response_sent": False,
+        "pending_reply": None,
+    }
 
-# --- Conditional Edges (Routing Logic) ---
+def email_outcome(result: AgentState) -> dict:
+    """
+    Outcome of a finished per-email sub-run (classify, generate and prepare the
+    reply): the email, its classification and the pending reply.
+    """
+    return {
+        "email": result["current_email"],
+        "classification": result["classification"],
+        "response_sent": result["response_sent"],
+        "reply": result.get("pending_reply"),
+    }
 
-def should_continue_processing(state: AgentState) -> str:
+def store_email_results(results: List[dict]) -> int:
     """
-    Determines if there are more emails in the batch to process.
+    Writes sub-run outcomes to the database in the given order,
+    DB_WRITE_BATCH_SIZE emails per transaction. Deferred emails are flagged
+    for check_mailbox and not stored. Returns the number of stored emails.
     """
-    if state["current_email"] is None:
-        return "end_batch"
-    return "process_email"
+    records = []
+    for result in results:
+        current_email = result["email"]
+        if result["classification"] == DEFERRED:
+            current_email["deferred"] = True # Picked up by check_mailbox so the email is fetched again later
+            print(f"Email '{current_email.get('subject')}' (ID: {current_email.get('message_id')}) deferred; not stored.")
+            continue
+        # Ensure classification is not None before storing
+        final_classification = result["classification"] if result["classification"] else "Unclassified"
+        records.append({
+            "message_id": current_email.get("message_id"),
+            "subject": current_email.get("subject"),
+            "sender": current_email.get("sender"),
+            "body": current_email.get("body"),
+            "classification": final_classification,
+            "classification_source": current_email.get("classification_source"),
+            "response_sent": result["response_sent"],
+            "reply": result["reply"],
+        })
+
+    for chunk in iter_batches(records, max(1, settings.DB_WRITE_BATCH_SIZE)):
+        flush_email_records(chunk)
+    print(f"Stored {len(records)} emails ({len(results) - len(records)} deferred).")
+    return len(records)
+
+# --- Conditional Edges (Routing Logic) ---
 
 def route_classification(state: AgentState) -> str:
     """
@@ -160,103 +552,32 @@ def route_classification(state: AgentState) -> str:
     """
     if state["classification"] == "Important":
         return "generate_response"
+    elif state["classification"] == DEFERRED:
+        return "done" # Not stored; store_email_results flags it for the next run
     elif state["classification"] in ["SPAM", "Unwanted"]:
-        return "store_email"
+        return "done"
     else: # Fallback for unexpected classifications
-        print(f"Unexpected classification: {state['classification']}. Routing to store.")
-        return "store_email"
-
-def route_after_response(state: AgentState) -> str:
-    """
-    Determines if there are more emails to process after storing the current one.
-    """
-    emails = state.get("emails", [])
-    current_index = state.get("current_email_index", 0) # This is already incremented for the NEXT email
-
-    if current_index < len(emails):
-        return "next_email"
-    else:
-        return "end_batch"
+        print(f"Unexpected classification: {state['classification']}. Storing as is.")
+        return "done"
 
 # --- Build the LangGraph Workflow ---
 
-workflow = StateGraph(AgentState)
-
-# Add nodes to the workflow
-workflow.add_node("fetch_and_set_email", fetch_and_set_email)
-workflow.add_node("classify_email", classify_email)
-workflow.add_node("generate_response", generate_response)
-workflow.add_node("send_email_response", send_email_response)
-workflow.add_node("store_email_data", store_email_data_node)
-
-# Set the entry point for the graph
-workflow.set_entry_point("fetch_and_set_email")
-
-# Define the edges (transitions) between nodes
-workflow.add_conditional_edges(
-    "fetch_and_set_email",
-    should_continue_processing,
-    {
-        "process_email": "classify_email", # If there's an email, classify it
-        "end_batch": END                     # If no more emails, end the graph run
-    }
-)
-
-workflow.add_conditional_edges(
+# Per-email graph: works on a single email and never sees the rest of the batch.
+# The ingest pipeline's reply stage runs it over each chunk with email_agent.batch()
+# and stores the outcomes itself. Every node is timed for the /metrics endpoint.
+email_workflow = StateGraph(AgentState)
+email_workflow.add_node("classify_email", timed_node("classify_email", classify_email_node))
+email_workflow.add_node("generate_response", timed_node("generate_response", generate_response))
+email_workflow.add_node("send_email_response", timed_node("send_email_response", send_email_response))
+email_workflow.set_entry_point("classify_email")
+email_workflow.add_conditional_edges(
     "classify_email",
     route_classification,
     {
         "generate_response": "generate_response", # If Important, generate response
-        "store_email": "store_email_data"         # If SPAM/Unwanted, just store
-    }
-)
-
-workflow.add_edge("generate_response", "send_email_response") # After generating, send the response
-workflow.add_edge("send_email_response", "store_email_data") # After sending (or skipping), store the data
-
-# After storing data, decide whether to process the next email or end the batch
-workflow.add_conditional_edges(
-    "store_email_data",
-    route_after_response,
-    {
-        "next_email": "fetch_and_set_email", # Loop back to fetch the next email in the batch
-        "end_batch": END                     # If no more emails in the batch, end
+        "done": END                               # If SPAM/Unwanted (or deferred), nothing more to do
     }
 )
-
-# Compile the workflow into a runnable agent
-app_agent = workflow.compile()
-
-if __name__ == "__main__":
-    # This block is for direct testing of the agent workflow
-    print("--- LangGraph Agent Test ---")
-    from app.email_client import fetch_unseen_emails
-    from app.database import init_db, get_all_emails
-
-    init_db() # Ensure DB is initialized for testing
-
-    print("Fetching unseen emails for agent test run...")
-    unseen_emails = fetch_unseen_emails()
-
-    if unseen_emails:
-        print(f"Starting agent to process {len(unseen_emails)} emails...")
-        initial_state = {
-            "emails": unseen_emails,
-            "current_email_index": 0,
-            "current_email": None, # Will be set by fetch_and_set_email
-            "classification": None,
-            "response_generated": False,
-            "response_sent": False
-        }
-        # Stream the execution to see intermediate steps
-        for s in app_agent.stream(initial_state):
-            print(s)
-            print("-" * 20)
-        print("Agent processing complete.")
-    else:
-        print("No unseen emails to process for this test run.")
-
-    print("\n--- All Emails in DB After Agent Test ---")
-    for email_entry in get_all_emails():
-        print(email_entry)
-    print("--- LangGraph Agent Test Complete ---")
\ No newline at end of file
+email_workflow.add_edge("generate_response", "send_email_response")
+email_workflow.add_edge("send_email_response", END)
+email_agent = email_workflow.compile()
@@ -0,0 +1,279 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+
+import groq
+
+from app.config import settings
+from app.metrics import LLM_ERRORS, LLM_LATENCY
+from app.utils import estimate_tokens
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when the LLM cannot be used right now (circuit open, rate limits or
+    outages persisting through all retries, rejected credentials). Callers
+    defer the email to a later run instead of guessing a label.
+    """
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`, holding at most one
+    minute's worth. `reserve` takes the amount immediately, letting the balance
+    go negative, and returns how long the caller must wait before using it, so
+    concurrent callers are spaced out fairly without polling.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_minute / 60)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * 60 / self.rate_per_minute
+
+    def adjust(self, amount: float):
+        """Takes (or gives back) tokens after the fact, e.g. when actual usage differs from the estimate."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds. Then a single trial call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"LLM circuit breaker opened after {self.failures} consecutive failures.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Reads the server's Retry-After hint (seconds or HTTP date) from an API error."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def is_transient(error: Exception) -> bool:
+    """Rate limits, timeouts, connection problems and server errors are worth retrying."""
+    if isinstance(error, (groq.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status = _status_code(error)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+def is_auth_error(error: Exception) -> bool:
+    return _status_code(error) in (401, 403)
+
+class RateLimitedLLM:
+    """
+    Wraps a LangChain chat model with client-side request and token budgets,
+    retries with jittered exponential backoff that honour Retry-After, and a
+    circuit breaker. The request rate adapts: it is cut on every 429 and crawls
+    back up to `requests_per_minute` on success, so throughput stays near the
+    provider limit without a retry storm.
+    Errors that are not worth retrying (e.g. a malformed request) are raised
+    unchanged; persistent unavailability raises LLMUnavailableError.
+    """
+
+    def __init__(self, llm: Any, requests_per_minute: float, tokens_per_minute: float, max_retries: int,
+                 base_backoff: float, max_backoff: float, breaker: CircuitBreaker, completion_tokens: int = 50):
+        self.llm = llm
+        self.max_requests_per_minute = requests_per_minute
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.completion_tokens = completion_tokens
+        self.rate_limited = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def _estimate(self, messages: list) -> int:
+        return sum(estimate_tokens(str(getattr(m, "content", m))) for m in messages) + self.completion_tokens
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            LLM_ERRORS.inc(kind="circuit_open")
+            raise LLMUnavailableError("LLM circuit breaker is open")
+
+    def _on_success(self, response: Any, estimated_tokens: int):
+        self.breaker.record_success()
+        # Additive increase back towards the configured request rate
+        bucket = self.requests
+        bucket.rate_per_minute = min(self.max_requests_per_minute, bucket.rate_per_minute + self.max_requests_per_minute * 0.02)
+        usage = getattr(response, "usage_metadata", None) or {}
+        if isinstance(usage, dict) and usage.get("total_tokens"):
+            self.tokens.adjust(usage["total_tokens"] - estimated_tokens)
+
+    def _on_error(self, error: Exception, attempt: int) -> float:
+        """
+        Decides what to do after a failed attempt: returns the delay before the
+        next attempt, or raises.
+        """
+        if is_auth_error(error):
+            LLM_ERRORS.inc(kind="auth")
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"LLM rejected the credentials: {error}") from error
+        if not is_transient(error):
+            LLM_ERRORS.inc(kind="rejected")
+            self.breaker.record_success() # The API answered, so it is reachable
+            raise error
+        LLM_ERRORS.inc(kind="rate_limited" if _status_code(error) == 429 else "transient")
+        if _status_code(error) == 429:
+            self.rate_limited += 1
+            # Multiplicative decrease of the request rate
+            bucket = self.requests
+            bucket.rate_per_minute = max(self.max_requests_per_minute * 0.1, bucket.rate_per_minute * 0.7)
+        if attempt >= self.max_retries:
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"LLM still unavailable after {attempt + 1} attempts: {error}") from error
+        self.retries += 1
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        print(f"LLM request failed ({error}). Retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries}).")
+        return delay
+
+    def invoke(self, messages: list, **kwargs) -> Any:
+        estimated = self._estimate(messages)
+        attempt = 0
+        self._check_breaker()
+        while True:
+            time.sleep(self._reserve(estimated))
+            try:
+                with LLM_LATENCY.time():
+                    response = self.llm.invoke(messages, **kwargs)
+            except Exception as e:
+                time.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+            self._on_success(response, estimated)
+            return response
+
+    async def ainvoke(self, messages: list, **kwargs) -> Any:
+        estimated = self._estimate(messages)
+        attempt = 0
+        self._check_breaker()
+        while True:
+            await asyncio.sleep(self._reserve(estimated))
+            try:
+                with LLM_LATENCY.time():
+                    response = await self.llm.ainvoke(messages, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+            self._on_success(response, estimated)
+            return response
+
+    def stats(self) -> dict:
+        return {
+            "circuit_state": self.breaker.state,
+            "requests_per_minute": round(self.requests.rate_per_minute, 2),
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "rejected_by_breaker": self.rejected,
+        }
+
+# Event loop shared by every async LLM call, running on its own daemon thread.
+# The chat models' async HTTP clients stay bound to the loop they were first
+# used on, so a fresh asyncio.run() loop per batch would find them closed.
+_llm_loop: Optional[asyncio.AbstractEventLoop] = None
+_llm_loop_lock = threading.Lock()
+
+def run_on_llm_loop(coro) -> Any:
+    """Runs a coroutine on the shared LLM event loop and blocks until it returns."""
+    global _llm_loop
+    with _llm_loop_lock:
+        if _llm_loop is None:
+            _llm_loop = asyncio.new_event_loop()
+            threading.Thread(target=_llm_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _llm_loop).result()
+
+def create_llm_client(llm: Any) -> RateLimitedLLM:
+    """Wraps a chat model with the limits from settings."""
+    return RateLimitedLLM(
+        llm=llm,
+        requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+        max_retries=settings.LLM_MAX_RETRIES,
+        base_backoff=settings.LLM_RETRY_BASE_SECONDS,
+        max_backoff=settings.LLM_RETRY_MAX_SECONDS,
+        breaker=CircuitBreaker(settings.LLM_BREAKER_FAILURE_THRESHOLD, settings.LLM_BREAKER_RESET_SECONDS),
+    )
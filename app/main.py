@@ -1,11 +1,26 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Header 
-from typing import List, Optional, Annotated 
+import csv
+import io
+import json
+import threading
+from fastapi import FastAPI, HTTPException, Depends, status, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Iterator, List, Optional, Annotated 
 
-from app.schemas import MailProcessResponse, EmailEntry
-from app.langgraph_agent import app_agent, AgentState
-from app.email_client import fetch_unseen_emails
-from app.database import init_db, get_all_emails, store_email_data
+from app.schemas import MailProcessResponse, EmailEntry, DashboardPage, EmailStats, JobStatus, SearchHit, SearchPage, StatsResponse
+from app import langgraph_agent, preprocess
+from app.langgraph_agent import email_agent, classify_emails, email_outcome, new_email_state, store_email_results
+from app.email_client import stream_unseen_emails, stream_new_emails, parse_fetched_message, save_sync_watermark, defer_emails, imap_sessions, smtp_sender
+from app.idle_listener import ImapIdleListener
+from app.outbox import outbox_dispatcher
+from app.jobs import Job, job_manager
+from app.pipeline import StagedPipeline
+from app.poller import MailboxPoller, create_poller
+from app.cascade import cascade_stats
+from app.metrics import registry, timed_node
+from app.database import init_db, query_emails, search_emails, get_email_stats, close_all_connections, close_thread_connection, get_max_email_id, iter_emails_for_export, EMAIL_FIELDS
 from app.config import settings
+from app.utils import encode_cursor, decode_cursor
 
 app = FastAPI(
     title="SmartMail AI Agent",
@@ -13,11 +28,60 @@ app = FastAPI(
     version="1.0.0"
 )
 
+_mail_check_lock = threading.Lock()
+
+def _llm_clients() -> dict:
+    return {"small": langgraph_agent.llm, "large": langgraph_agent.large_llm}
+
+# Statistics kept by other modules, read when /metrics is scraped
+registry.callback(
+    "smartmail_llm_requests_per_minute", "Current adaptive LLM request rate, by model tier.",
+    lambda: {(tier,): client.stats()["requests_per_minute"] for tier, client in _llm_clients().items()}, ["tier"]
+)
+registry.callback(
+    "smartmail_llm_circuit_open", "1 while the LLM circuit breaker is open or half-open, by model tier.",
+    lambda: {(tier,): int(client.stats()["circuit_state"] != "closed") for tier, client in _llm_clients().items()}, ["tier"]
+)
+registry.callback(
+    "smartmail_cascade_settled_total", "Emails whose classification was settled by each cascade tier.",
+    lambda: {(tier,): stats["settled"] for tier, stats in cascade_stats.summary().items()}, ["tier"], type="counter"
+)
+registry.callback(
+    "smartmail_cascade_escalated_total", "Emails the small model escalated to the large model.",
+    lambda: {(): cascade_stats.summary()["small"]["escalated"]}, type="counter"
+)
+registry.callback(
+    "smartmail_prompt_tokens_saved_total", "Estimated prompt tokens saved by cleaning email bodies.",
+    lambda: {(): preprocess.stats()["tokens_saved"]}, type="counter"
+)
+idle_listener: Optional[ImapIdleListener] = None
+mailbox_poller: Optional[MailboxPoller] = None
+
 # Initialize the database on startup
 @app.on_event("startup")
 async def startup_event():
+    global idle_listener, mailbox_poller
     init_db()
     print("Database initialized on startup.")
+    outbox_dispatcher.start()
+    if settings.POLLER_ENABLED:
+        mailbox_poller = create_poller(start_mailbox_job)
+        mailbox_poller.start()
+    if settings.IMAP_IDLE_ENABLED:
+        idle_listener = ImapIdleListener(on_new_mail=start_mailbox_job, mailbox=settings.IMAP_MAILBOX)
+        idle_listener.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if idle_listener:
+        idle_listener.stop()
+    if mailbox_poller:
+        mailbox_poller.stop()
+    job_manager.shutdown()
+    outbox_dispatcher.stop()
+    imap_sessions.close()
+    smtp_sender.close()
+    close_all_connections()
 
 # --- API Key Authentication ---
 # Removed: api_key_header = APIKeyHeader(name="X-API-Key")
@@ -37,71 +101,283 @@ def get_api_key(x_api_key: Annotated[str, Header(alias="X-API-Key")]):
 
 # --- Endpoints ---
 
-@app.post("/check-mails", response_model=MailProcessResponse, summary="Trigger email processing")
-async def check_mails(api_key_dep: str = Depends(get_api_key)): 
+def run_ingest_pipeline(email_stream, job: Optional[Job] = None) -> dict:
     """
-    Fetches unseen emails, classifies them using the LangGraph agent,
-    and sends automatic replies for 'Important for Business' emails.
+    Streams the fetched mail through the staged pipeline
+    fetch -> parse -> classify -> reply -> store, each stage on its own thread
+    behind a bounded queue of PIPELINE_QUEUE_SIZE emails. A slow stage blocks
+    the ones before it down to the IMAP fetch, so memory stays fixed whatever
+    the backlog. Stops fetching once the LLM is unavailable for a whole batch.
+    Returns the fetched, processed and deferred emails and the stage statistics.
     """
-    print("API call received: POST /check-mails")
-    unseen_emails = fetch_unseen_emails()
-    if not unseen_emails:
-        print("No new unseen emails to process.")
+    run = {"processed": 0, "deferred": []}
+    chunk_size = max(1, settings.IMAP_FETCH_CHUNK_SIZE)
+    config = {"max_concurrency": max(1, settings.LLM_MAX_CONCURRENCY)}
+    # Stage threads live for one run, so each closes its pooled database connection when done
+    pipeline = StagedPipeline(email_stream, settings.PIPELINE_QUEUE_SIZE, on_thread_exit=close_thread_connection)
+
+    def parse(items: List[dict]) -> List[dict]:
+        emails = [parse_fetched_message(item) for item in items]
+        if job:
+            job.add(fetched=len(emails))
+        return emails
+
+    def classify(emails: List[dict]) -> List[dict]:
+        if settings.PARALLEL_CLASSIFICATION:
+            # Otherwise the classify_email node of each sub-run asks the LLM itself
+            classify_emails(emails)
+        return emails
+
+    def reply(emails: List[dict]) -> List[dict]:
+        # Each email runs its own sub-run; max_concurrency bounds how many run at once
+        results = [email_outcome(state) for state in email_agent.batch([new_email_state(e) for e in emails], config)]
+        if job:
+            job.add(classified=len(results), replied=sum(1 for r in results if r["reply"]))
+        return results
+
+    # Timed like the store_email_data node it replaces, so node latencies stay comparable
+    store_results = timed_node("store_email_data", store_email_results)
+
+    def store(results: List[dict]):
+        stored = store_results(results)
+        batch_deferred = [r["email"] for r in results if r["email"].get("deferred")]
+        run["processed"] += stored
+        run["deferred"].extend(batch_deferred)
+        if job:
+            job.add(stored=stored, deferred=len(batch_deferred))
+        if batch_deferred and len(batch_deferred) == len(results):
+            # The LLM is unavailable; leave the rest of the mailbox for a later run
+            print("LLM unavailable for a whole batch. Stopping this run early.")
+            pipeline.stop_source()
+
+    pipeline.add_stage("parse", parse, batch_size=chunk_size)
+    pipeline.add_stage("classify", classify, batch_size=chunk_size)
+    pipeline.add_stage("reply", reply, batch_size=chunk_size)
+    pipeline.add_stage("store", store, batch_size=max(1, settings.DB_WRITE_BATCH_SIZE))
+    stages = pipeline.run()
+    for stage in stages:
+        print(f"Pipeline stage {stage['stage']}: {stage['processed']} items, {stage['throughput_per_second']} items/s, "
+              f"busy {stage['busy_seconds']}s, max queue depth {stage['max_queue_depth']}")
+    run["fetched"] = stages[0]["processed"]
+    run["stages"] = stages
+    return run
+
+def check_mailbox(job: Optional[Job] = None) -> MailProcessResponse:
+    """
+    Fetches new emails and processes them in the staged ingest pipeline while
+    the rest are still being downloaded. Normally run through
+    start_mailbox_job(); the lock also guards direct callers against processing
+    the same mail twice.
+    """
+    with _mail_check_lock:
+        watermark = None
+        # Messages are parsed by the pipeline's parse stage, not while fetching
+        if settings.MAIL_SYNC_MODE == "uid":
+            email_stream, watermark = stream_new_emails(settings.IMAP_MAILBOX, raw=True)
+        else:
+            email_stream = stream_unseen_emails(raw=True)
+
+        # The pipeline closes the stream, handing the IMAP session back, even if processing fails midway
+        run = run_ingest_pipeline(email_stream, job)
+        deferred = run["deferred"]
+        # Emails the LLM could not classify are fetched again by the next run
+        defer_emails(deferred, watermark)
+        # Only advance the UID watermark once everything has been processed
+        save_sync_watermark(watermark)
+
+        if not run["fetched"]:
+            print("No new unseen emails to process.")
+            return MailProcessResponse(
+                message="No new unseen emails to process.",
+                processed_count=0,
+                new_emails_fetched=0
+            )
+        print(f"Finished processing {run['processed']} emails.")
+        if settings.CASCADE_ENABLED:
+            print(f"Classification cascade: {cascade_stats.summary()}")
         return MailProcessResponse(
-            message="No new unseen emails to process.",
-            processed_count=0,
-            new_emails_fetched=0
+            message="Email processing initiated successfully." if not deferred else f"Email processing completed; {len(deferred)} emails deferred because the LLM is unavailable.",
+            processed_count=run["processed"],
+            new_emails_fetched=run["fetched"],
+            deferred_count=len(deferred),
+            stages=run["stages"]
         )
 
-    initial_state = {
-        "emails": unseen_emails,
-        "current_email_index": 0,
-        "current_email": None,
-        "classification": None,
-        "response_generated": False,
-        "response_sent": False
-    }
+def start_mailbox_job() -> Job:
+    """
+    Starts a background check of the configured mailbox, or returns the check
+    already queued or running for it. The poller, the IDLE listener and
+    POST /check-mails all go through here, so only one run per mailbox is ever
+    in flight.
+    """
+    return job_manager.submit(check_mailbox, key=settings.IMAP_MAILBOX)
+
+@app.post("/check-mails", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED, summary="Trigger email processing")
+async def check_mails(api_key_dep: str = Depends(get_api_key)): 
+    """
+    Starts a background job that fetches unseen emails, classifies them using
+    the LangGraph agent and queues automatic replies for 'Important for Business'
+    emails. Returns the job right away; poll GET /jobs/{job_id} for progress.
+    If a check of the mailbox is already queued or running, that job is returned
+    instead of starting another one.
+    """
+    print("API call received: POST /check-mails")
+    job = start_mailbox_job()
+    return JobStatus(**job.snapshot())
+
+@app.get("/jobs/{job_id}", response_model=JobStatus, summary="Get the progress of an email processing job")
+async def get_job(job_id: str, api_key_dep: str = Depends(get_api_key)):
+    """
+    Returns the live status and fetched/classified/replied/stored counts of a
+    job started by POST /check-mails.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found")
+    return JobStatus(**job.snapshot())
 
-    processed_count = 0
+@app.get("/dashboard", response_model=DashboardPage, response_model_exclude_unset=True, summary="View classified emails dashboard")
+async def dashboard(
+    api_key_dep: str = Depends(get_api_key),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of emails per page."),
+    cursor: Optional[str] = Query(None, description="'next_cursor' from the previous page."),
+    classification: Optional[str] = Query(None, description="Only emails with this classification."),
+    sender: Optional[str] = Query(None, description="Only emails from this exact sender."),
+    date_from: Optional[str] = Query(None, description="Only emails stored at or after this ISO date/time."),
+    date_to: Optional[str] = Query(None, description="Only emails stored before this ISO date/time."),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. 'id,subject,classification'."),
+):
+    """
+    Returns one page of classified emails, ordered by most recent. Follow
+    'next_cursor' to page through the rest.
+    """
+    print("API call received: GET /dashboard")
     try:
-        for s in app_agent.stream(initial_state):
-            pass
-        processed_count = len(unseen_emails)
-        print(f"Finished processing {processed_count} emails.")
-        return MailProcessResponse(
-            message="Email processing initiated successfully.",
-            processed_count=processed_count,
-            new_emails_fetched=len(unseen_emails)
+        after = decode_cursor(cursor) if cursor else None
+        field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        rows, has_more = await run_in_threadpool(
+            query_emails, limit, after, classification, sender, date_from, date_to, field_list
         )
-    except Exception as e:
-        print(f"An error occurred during email processing: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"An error occurred during email processing: {e}"
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    items = []
+    for row in rows:
+        last_position = (row["timestamp"], row["id"])
+        if field_list:
+            # Drop the cursor columns the client did not ask for
+            row = {k: v for k, v in row.items() if k in field_list or k == "id"}
+        if row.get("response_sent") is not None:
+            row["response_sent"] = bool(row["response_sent"])
+        items.append(EmailEntry(**row))
+    next_cursor = encode_cursor(*last_position) if has_more else None
+    print(f"Returning {len(items)} classified emails for dashboard.")
+    return DashboardPage(items=items, next_cursor=next_cursor)
+
+@app.get("/search", response_model=SearchPage, summary="Full-text search over stored emails")
+async def search(
+    api_key_dep: str = Depends(get_api_key),
+    q: str = Query(..., min_length=1, description="FTS5 query: words, \"phrases\", prefix*, AND/OR/NOT, or a column such as subject:invoice."),
+    limit: int = Query(20, ge=1, le=200, description="Maximum number of results per page."),
+    cursor: Optional[str] = Query(None, description="'next_cursor' from the previous page."),
+    classification: Optional[str] = Query(None, description="Only emails with this classification."),
+    response_sent: Optional[bool] = Query(None, description="Only emails that were (true) or were not (false) replied to."),
+    date_from: Optional[str] = Query(None, description="Only emails stored at or after this ISO date/time."),
+    date_to: Optional[str] = Query(None, description="Only emails stored before this ISO date/time."),
+):
+    """
+    Searches the subject, sender and body of stored emails, best matches
+    first. Follow 'next_cursor' to page through the rest.
+    """
+    print("API call received: GET /search")
+    try:
+        after = None
+        if cursor:
+            score, row_id = decode_cursor(cursor)
+            after = (float(score), row_id)
+        rows, has_more = await run_in_threadpool(
+            search_emails, q, limit, after, classification, response_sent, date_from, date_to
         )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    items = [SearchHit(**{**row, "response_sent": bool(row["response_sent"])}) for row in rows]
+    next_cursor = encode_cursor(rows[-1]["score"], rows[-1]["id"]) if has_more else None
+    print(f"Returning {len(items)} search results.")
+    return SearchPage(items=items, next_cursor=next_cursor)
 
-@app.get("/dashboard", response_model=List[EmailEntry], summary="View classified emails dashboard")
-async def dashboard(api_key_dep: str = Depends(get_api_key)): 
+def _with_reply_rate(entry: dict) -> EmailStats:
+    important = entry["by_classification"].get("Important", 0)
+    return EmailStats(**entry, reply_rate=round(entry["replied"] / important, 4) if important else None)
+
+@app.get("/stats", response_model=StatsResponse, summary="Per-day classification and reply statistics")
+async def stats(
+    api_key_dep: str = Depends(get_api_key),
+    date_from: Optional[str] = Query(None, description="First day to include (ISO date)."),
+    date_to: Optional[str] = Query(None, description="Day to stop before (ISO date, exclusive)."),
+):
     """
-    Returns a list of all classified emails stored in the database,
-    ordered by most recent.
+    Returns the number of stored emails per day and classification, the
+    replies delivered and the reply rate, plus totals over the range. Read
+    from a summary table kept up to date on every write, so the cost does not
+    grow with the number of emails.
     """
-    print("API call received: GET /dashboard")
-    emails_data = get_all_emails()
-    formatted_emails = []
-    for email_tuple in emails_data:
-        formatted_emails.append(EmailEntry(
-            id=email_tuple[0],
-            message_id=email_tuple[1],
-            subject=email_tuple[2],
-            sender=email_tuple[3],
-            body=email_tuple[4],
-            classification=email_tuple[5],
-            response_sent=bool(email_tuple[6]),
-            timestamp=email_tuple[7]
-        ))
-    print(f"Returning {len(formatted_emails)} classified emails for dashboard.")
-    return formatted_emails
+    print("API call received: GET /stats")
+    days = await run_in_threadpool(get_email_stats, date_from, date_to)
+    totals = {"total": 0, "by_classification": {}, "replied": 0}
+    for entry in days:
+        totals["total"] += entry["total"]
+        totals["replied"] += entry["replied"]
+        for classification, count in entry["by_classification"].items():
+            totals["by_classification"][classification] = totals["by_classification"].get(classification, 0) + count
+    return StatsResponse(days=[_with_reply_rate(entry) for entry in days], totals=_with_reply_rate(totals))
+
+def _export_ndjson(chunks: Iterator[list[tuple]]) -> Iterator[str]:
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(EMAIL_FIELDS, row))) + "\n" for row in rows)
+
+def _export_csv(chunks: Iterator[list[tuple]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EMAIL_FIELDS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue() # Header only, when there are no rows
+
+@app.get("/export", summary="Stream the email audit log as NDJSON or CSV")
+async def export_emails(
+    api_key_dep: str = Depends(get_api_key),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="'ndjson' or 'csv'."),
+    since: int = Query(0, ge=0, description="Only export emails with an id greater than this watermark."),
+):
+    """
+    Streams every stored email with an id above `since`, in id order, without
+    loading the table into memory. The `X-Export-Watermark` response header holds
+    the highest id included; pass it as `since` on the next run to export only
+    new emails.
+    """
+    print(f"API call received: GET /export (format={format}, since={since})")
+    # Fix the upper bound up front so rows inserted mid-export are left for the next run
+    watermark = await run_in_threadpool(get_max_email_id)
+    chunks = iter_emails_for_export(since, watermark, settings.EXPORT_FETCH_SIZE)
+    if format == "csv":
+        body, media_type = _export_csv(chunks), "text/csv"
+    else:
+        body, media_type = _export_ndjson(chunks), "application/x-ndjson"
+    # Starlette iterates sync generators in its threadpool, so reads never block the event loop
+    return StreamingResponse(body, media_type=media_type, headers={"X-Export-Watermark": str(watermark)})
+
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics")
+async def metrics(api_key_dep: str = Depends(get_api_key)):
+    """
+    Latency histograms (graph nodes, IMAP fetches, SMTP sends, database calls)
+    and counters in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/", include_in_schema=False)
 async def root():
@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+from typing import Optional
+
+from app.config import settings
+from app.database import claim_due_replies, mark_reply_failed, mark_reply_sent
+from app.email_client import SmtpSender, smtp_sender
+
+class OutboxDispatcher:
+    """
+    Background thread that drains the 'outbox' table over the shared SMTP
+    session. Replies are queued by the agent in the same transaction as the
+    classification, so the request path never waits for SMTP. Failed sends are
+    retried with jittered exponential backoff until `max_attempts`.
+    """
+
+    def __init__(self, sender: SmtpSender, poll_interval: float, batch_size: int, max_attempts: int,
+                 base_backoff: float, max_backoff: float, lease_seconds: float):
+        self.sender = sender
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+        print("Outbox dispatcher started.")
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+        print("Outbox dispatcher stopped.")
+
+    def wake(self):
+        """Signals that new replies were queued, so they go out without waiting for the next poll."""
+        self._wake_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                # Keep draining while full batches come back
+                while self.drain_once() == self.batch_size and not self._stop_event.is_set():
+                    pass
+            except Exception as e:
+                print(f"Error dispatching outbox: {e}")
+            self._wake_event.wait(self.poll_interval)
+            self._wake_event.clear()
+
+    def backoff_seconds(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def drain_once(self) -> int:
+        """
+        Sends one batch of due replies. Returns the number of replies attempted.
+        """
+        rows = claim_due_replies(self.batch_size, self.lease_seconds)
+        if not rows:
+            return 0
+        results = self.sender.send_many([(to_address, subject, body) for _, _, to_address, subject, body, _ in rows])
+        for (outbox_id, message_id, to_address, _, _, attempts), success in zip(rows, results):
+            if success:
+                mark_reply_sent(outbox_id, message_id)
+            elif attempts >= self.max_attempts:
+                print(f"Giving up on reply to {to_address} for message ID '{message_id}' after {attempts} attempts.")
+                mark_reply_failed(outbox_id, "send failed", retry_at=None)
+            else:
+                delay = self.backoff_seconds(attempts)
+                print(f"Reply to {to_address} failed (attempt {attempts}). Retrying in {delay:.0f}s.")
+                mark_reply_failed(outbox_id, "send failed", retry_at=time.time() + delay)
+        return len(rows)
+
+# Shared dispatcher, started by the FastAPI startup hook
+outbox_dispatcher = OutboxDispatcher(
+    sender=smtp_sender,
+    poll_interval=settings.OUTBOX_POLL_INTERVAL_SECONDS,
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    base_backoff=settings.OUTBOX_BASE_BACKOFF_SECONDS,
+    max_backoff=settings.OUTBOX_MAX_BACKOFF_SECONDS,
+    lease_seconds=settings.OUTBOX_LEASE_SECONDS,
+)
+
+if __name__ == "__main__":
+    # Drain the outbox once, e.g. after replies were queued by a direct agent run
+    from app.database import init_db
+    init_db()
+    total = 0
+    while True:
+        attempted = outbox_dispatcher.drain_once()
+        total += attempted
+        if attempted < outbox_dispatcher.batch_size:
+            break
+    print(f"Outbox drained: {total} replies attempted.")
+    smtp_sender.close()
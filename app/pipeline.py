@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from app.metrics import PIPELINE_BUSY, PIPELINE_ITEMS, registry
+
+_DONE = object() # End-of-stream marker passed down the queues
+_POLL_SECONDS = 0.1 # How often blocked stages check whether the pipeline was aborted
+
+class StageStats:
+    """Counters of one pipeline stage, updated by its worker thread."""
+
+    def __init__(self, name: str, inbox: Optional[queue.Queue] = None):
+        self.name = name
+        self.inbox = inbox # Queue in front of the stage; None for the source
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def queue_depth(self) -> int:
+        return self.inbox.qsize() if self.inbox is not None else 0
+
+    def throughput(self) -> Optional[float]:
+        """Items per second over the stage's lifetime (so far, while it runs)."""
+        if self.started_at is None:
+            return None
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.processed / elapsed if elapsed > 0 else None
+
+    def snapshot(self) -> dict:
+        throughput = self.throughput()
+        return {
+            "stage": self.name,
+            "processed": self.processed,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "throughput_per_second": round(throughput, 1) if throughput is not None else None,
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+class StagedPipeline:
+    """
+    Chain of stages, each on its own thread, connected by bounded queues. A full
+    queue blocks the stage that feeds it, so the slowest stage throttles every
+    stage before it, down to the source (backpressure): at most `queue_size`
+    items wait between two stages, whatever the size of the backlog.
+
+    Stage functions receive a list of up to `batch_size` items (whatever is
+    already queued, they never wait to fill a batch) and return the items for
+    the next stage. The first exception aborts the pipeline and is re-raised
+    by run(). `on_thread_exit` runs on every stage thread as it finishes, e.g.
+    to release per-thread resources.
+    """
+
+    def __init__(self, source: Iterator, queue_size: int, source_name: str = "fetch",
+                 on_thread_exit: Optional[Callable[[], None]] = None):
+        self.source = iter(source)
+        self.queue_size = max(1, queue_size)
+        self.stats: List[StageStats] = [StageStats(source_name)]
+        self._stages: List[tuple] = [] # (fn, batch_size)
+        self._stop_source = threading.Event()
+        self._abort = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._error_lock = threading.Lock()
+        self._on_thread_exit = on_thread_exit
+
+    def add_stage(self, name: str, fn: Callable[[list], Optional[Iterable]], batch_size: int = 1) -> "StagedPipeline":
+        self.stats.append(StageStats(name, queue.Queue(maxsize=self.queue_size)))
+        self._stages.append((fn, max(1, batch_size)))
+        return self
+
+    def stop_source(self):
+        """Stops reading from the source; items already in the pipeline are still processed."""
+        self._stop_source.set()
+
+    def run(self) -> List[dict]:
+        """Runs the pipeline to completion and returns the statistics of every stage."""
+        threads = [threading.Thread(target=self._guard, args=(self._run_source,), name=f"pipeline-{self.stats[0].name}", daemon=True)]
+        for index in range(len(self._stages)):
+            threads.append(threading.Thread(target=self._guard, args=(self._run_stage, index), name=f"pipeline-{self.stats[index + 1].name}", daemon=True))
+        _running.add(self)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            _running.discard(self)
+        if self._error is not None:
+            raise self._error
+        return [stats.snapshot() for stats in self.stats]
+
+    def _guard(self, target: Callable, *args):
+        stats = self.stats[args[0] + 1] if args else self.stats[0]
+        stats.started_at = time.monotonic()
+        try:
+            target(*args)
+        except BaseException as e:
+            with self._error_lock:
+                if self._error is None:
+                    self._error = e
+            self._abort.set()
+        finally:
+            stats.finished_at = time.monotonic()
+            if self._on_thread_exit:
+                self._on_thread_exit()
+
+    def _outbox(self, index: int) -> Optional[queue.Queue]:
+        """Queue after stage `index` (0 is the source); None after the last stage."""
+        return self.stats[index + 1].inbox if index + 1 < len(self.stats) else None
+
+    def _put(self, index: int, item) -> bool:
+        outbox = self._outbox(index)
+        if outbox is None:
+            return True
+        while not self._abort.is_set():
+            try:
+                outbox.put(item, timeout=_POLL_SECONDS)
+            except queue.Full:
+                continue
+            consumer = self.stats[index + 1]
+            consumer.max_queue_depth = max(consumer.max_queue_depth, outbox.qsize())
+            return True
+        return False
+
+    def _get(self, inbox: queue.Queue):
+        while not self._abort.is_set():
+            try:
+                return inbox.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _record(self, stats: StageStats, count: int, seconds: float):
+        stats.processed += count
+        stats.busy_seconds += seconds
+        PIPELINE_ITEMS.inc(count, stage=stats.name)
+        PIPELINE_BUSY.inc(seconds, stage=stats.name)
+
+    def _run_source(self):
+        stats = self.stats[0]
+        try:
+            while not self._stop_source.is_set() and not self._abort.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(self.source)
+                except StopIteration:
+                    break
+                self._record(stats, 1, time.perf_counter() - started)
+                if not self._put(0, item):
+                    return
+        finally:
+            close = getattr(self.source, "close", None)
+            if close:
+                close() # Generators hand back what they hold (e.g. the IMAP session)
+            self._put(0, _DONE)
+
+    def _run_stage(self, index: int):
+        fn, batch_size = self._stages[index]
+        stats = self.stats[index + 1]
+        done = False
+        while not done:
+            item = self._get(stats.inbox)
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < batch_size:
+                try:
+                    item = stats.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            started = time.perf_counter()
+            outputs = list(fn(batch) or ())
+            self._record(stats, len(batch), time.perf_counter() - started)
+            for output in outputs:
+                if not self._put(index + 1, output):
+                    return
+        self._put(index + 1, _DONE)
+
+# Pipelines currently running; their queue depths are read when /metrics is scraped
+_running: set = set()
+
+registry.callback(
+    "smartmail_pipeline_queue_depth", "Items waiting in front of each stage of the running ingest pipeline.",
+    lambda: {(stats.name,): stats.queue_depth() for pipeline in list(_running) for stats in pipeline.stats[1:]}, ["stage"]
+)
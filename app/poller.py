@@ -0,0 +1,70 @@
+import threading
+from typing import Callable, Optional
+
+from app.config import settings
+from app.jobs import Job
+
+class MailboxPoller:
+    """
+    Background thread that checks the mailbox on an adaptive schedule: after a
+    run that fetched mail it polls again after `min_interval`, and every idle or
+    failed run multiplies the interval by `backoff_factor` up to `max_interval`.
+    `submit` must start (or join) a single-flight mailbox job, so polls never
+    overlap with manual /check-mails calls or the IDLE listener.
+    """
+
+    def __init__(self, submit: Callable[[], Job], min_interval: float, max_interval: float, backoff_factor: float):
+        self.submit = submit
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.interval = min_interval
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="mailbox-poller", daemon=True)
+        self._thread.start()
+        print(f"Mailbox poller started (interval {self.min_interval:.0f}-{self.max_interval:.0f}s).")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        print("Mailbox poller stopped.")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"Error polling mailbox: {e}")
+                self.interval = self.next_interval(fetched=0)
+            self._stop_event.wait(self.interval)
+
+    def poll_once(self) -> Job:
+        """Runs (or joins) one mailbox check, waits for it and adapts the interval."""
+        job = self.submit()
+        while not job.wait(timeout=1):
+            if self._stop_event.is_set():
+                return job
+        # Deferred emails come back every run while the LLM is down; they do not count as flowing mail
+        fetched = job.fetched - job.deferred if job.status == "completed" else 0
+        self.interval = self.next_interval(fetched)
+        return job
+
+    def next_interval(self, fetched: int) -> float:
+        if fetched:
+            return self.min_interval
+        return min(self.max_interval, self.interval * self.backoff_factor)
+
+def create_poller(submit: Callable[[], Job]) -> MailboxPoller:
+    return MailboxPoller(
+        submit=submit,
+        min_interval=settings.POLL_MIN_INTERVAL_SECONDS,
+        max_interval=settings.POLL_MAX_INTERVAL_SECONDS,
+        backoff_factor=settings.POLL_BACKOFF_FACTOR,
+    )
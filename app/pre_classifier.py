@@ -0,0 +1,226 @@
+import argparse
+import os
+import re
+import threading
+import zlib
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app import database
+from app.config import settings
+
+CLASSES = ["SPAM", "Unwanted", "Important"]
+# Only these labels may be settled locally. 'Important' triggers an auto-reply,
+# so it is always confirmed by the LLM.
+LOCAL_CLASSES = {"SPAM", "Unwanted"}
+N_FEATURES = 1 << 18
+ALPHA = 1.0 # Laplace smoothing
+
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+def extract_features(subject: str, sender: str, body: str) -> np.ndarray:
+    """
+    Maps an email to hashed feature indices: word unigrams and bigrams of the
+    subject and body (subject tokens are prefixed so they weigh separately)
+    plus the sender's domain.
+    """
+    tokens = []
+    subject_words = _TOKEN_RE.findall((subject or "").lower())
+    body_words = _TOKEN_RE.findall((body or "").lower())
+    tokens.extend("s:" + w for w in subject_words)
+    tokens.extend(body_words)
+    tokens.extend(a + " " + b for a, b in zip(body_words, body_words[1:]))
+    match = re.search(r'@([\w.-]+)', sender or "")
+    if match:
+        tokens.append("domain:" + match.group(1).lower())
+    if not tokens:
+        return np.zeros(0, dtype=np.int64)
+    return np.fromiter((zlib.crc32(t.encode("utf-8")) % N_FEATURES for t in tokens), dtype=np.int64, count=len(tokens))
+
+class PreClassifier:
+    """
+    Multinomial naive Bayes over hashed n-gram features, trained from the labels
+    the LLM has already assigned in the 'emails' table. Training only adds counts,
+    so the model can be updated incrementally from `last_trained_id` onwards.
+    """
+
+    def __init__(self):
+        self.feature_counts = np.zeros((len(CLASSES), N_FEATURES), dtype=np.float32)
+        self.class_counts = np.zeros(len(CLASSES), dtype=np.float64)
+        self.last_trained_id = 0
+        self._log_probs = None
+        self._log_priors = None
+
+    @property
+    def trained_emails(self) -> int:
+        return int(self.class_counts.sum())
+
+    def partial_fit(self, rows: list[Tuple[str, str, str, str]]):
+        """Adds (subject, sender, body, classification) rows to the model."""
+        for subject, sender, body, classification in rows:
+            if classification not in CLASSES:
+                continue
+            class_index = CLASSES.index(classification)
+            np.add.at(self.feature_counts[class_index], extract_features(subject, sender, body), 1)
+            self.class_counts[class_index] += 1
+        self._log_probs = None
+
+    def _ensure_log_probs(self):
+        if self._log_probs is None:
+            smoothed = self.feature_counts + ALPHA
+            self._log_probs = np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+            self._log_priors = np.log((self.class_counts + ALPHA) / (self.class_counts.sum() + ALPHA * len(CLASSES)))
+
+    def predict_proba(self, subject: str, sender: str, body: str) -> np.ndarray:
+        """Returns class probabilities in CLASSES order."""
+        self._ensure_log_probs()
+        features = extract_features(subject, sender, body)
+        scores = self._log_priors + self._log_probs[:, features].sum(axis=1)
+        scores -= scores.max()
+        probs = np.exp(scores)
+        return probs / probs.sum()
+
+    def predict(self, subject: str, sender: str, body: str) -> Tuple[str, float]:
+        probs = self.predict_proba(subject, sender, body)
+        best = int(np.argmax(probs))
+        return CLASSES[best], float(probs[best])
+
+    def save(self, path: str):
+        # Write to a temp file first so a running server never loads a half-written model
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            feature_counts=self.feature_counts,
+            class_counts=self.class_counts,
+            last_trained_id=np.array(self.last_trained_id),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PreClassifier":
+        model = cls()
+        if os.path.exists(path):
+            with np.load(path) as data:
+                model.feature_counts = data["feature_counts"]
+                model.class_counts = data["class_counts"]
+                model.last_trained_id = int(data["last_trained_id"])
+        return model
+
+_model: Optional[PreClassifier] = None
+_model_mtime: Optional[float] = None
+_model_lock = threading.Lock()
+
+def get_pre_classifier() -> PreClassifier:
+    """
+    Returns the shared model, reloading it when the CLI has retrained it on disk.
+    """
+    global _model, _model_mtime
+    path = settings.PRECLASSIFIER_MODEL_PATH
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    with _model_lock:
+        if _model is None or mtime != _model_mtime:
+            _model = PreClassifier.load(path)
+            _model_mtime = mtime
+        return _model
+
+def pre_classify(subject: str, sender: str, body: str) -> Optional[str]:
+    """
+    Returns a SPAM/Unwanted label when the local model is confident enough to
+    skip the LLM, otherwise None.
+    """
+    model = get_pre_classifier()
+    if model.trained_emails < settings.PRECLASSIFIER_MIN_TRAINING_EMAILS:
+        return None
+    label, confidence = model.predict(subject, sender, body)
+    if label in LOCAL_CLASSES and confidence >= settings.PRECLASSIFIER_THRESHOLD:
+        return label
+    return None
+
+def _load_labeled_rows(after_id: int = 0) -> list[tuple]:
+    """
+    Emails labeled by the LLM itself. Labels from the cache, from this model
+    and the 'Unwanted' fallback are left out so the model never learns from
+    (or is evaluated against) its own output.
+    """
+    return database.get_connection().execute(
+        """
+        SELECT id, subject, sender, body, classification FROM email_records
+        WHERE id > ? AND classification IN (?, ?, ?) AND classification_source = 'llm' ORDER BY id
+        """,
+        (after_id, *CLASSES)
+    ).fetchall()
+
+def train(full: bool = False) -> PreClassifier:
+    """
+    Trains the model on emails stored since the last run (or on everything when
+    `full` is set) and saves it to PRECLASSIFIER_MODEL_PATH.
+    """
+    path = settings.PRECLASSIFIER_MODEL_PATH
+    model = PreClassifier() if full else PreClassifier.load(path)
+    rows = _load_labeled_rows(model.last_trained_id)
+    model.partial_fit([row[1:] for row in rows])
+    if rows:
+        model.last_trained_id = rows[-1][0]
+    model.save(path)
+    print(f"Pre-classifier trained on {len(rows)} new emails ({model.trained_emails} total). Saved to '{path}'.")
+    return model
+
+def report(holdout: float = 0.0) -> dict:
+    """
+    Compares model predictions with the stored LLM labels. With `holdout` > 0 a
+    fresh model is trained on the older emails and evaluated on the newest
+    fraction; otherwise the saved model is evaluated on all stored emails.
+    """
+    rows = _load_labeled_rows()
+    if holdout > 0:
+        split = int(len(rows) * (1 - holdout))
+        model = PreClassifier()
+        model.partial_fit([row[1:] for row in rows[:split]])
+        rows = rows[split:]
+    else:
+        model = PreClassifier.load(settings.PRECLASSIFIER_MODEL_PATH)
+
+    total = agree = confident = confident_agree = 0
+    per_class = {c: {"support": 0, "correct": 0} for c in CLASSES}
+    for _, subject, sender, body, label in rows:
+        predicted, confidence = model.predict(subject, sender, body)
+        total += 1
+        per_class[label]["support"] += 1
+        if predicted == label:
+            agree += 1
+            per_class[label]["correct"] += 1
+        if predicted in LOCAL_CLASSES and confidence >= settings.PRECLASSIFIER_THRESHOLD:
+            confident += 1
+            confident_agree += predicted == label
+
+    result = {
+        "evaluated": total,
+        "agreement": agree / total if total else 0.0,
+        "per_class_recall": {c: (v["correct"] / v["support"] if v["support"] else None) for c, v in per_class.items()},
+        "llm_calls_skipped": confident / total if total else 0.0,
+        "agreement_when_skipped": confident_agree / confident if confident else None,
+    }
+    print(f"Evaluated {total} emails: agreement with stored labels {result['agreement']:.1%}.")
+    for c, recall in result["per_class_recall"].items():
+        print(f"  {c}: recall {recall:.1%}" if recall is not None else f"  {c}: no samples")
+    print(f"At threshold {settings.PRECLASSIFIER_THRESHOLD}: {result['llm_calls_skipped']:.1%} of emails skip the LLM", end="")
+    if result["agreement_when_skipped"] is not None:
+        print(f", agreeing with the LLM on {result['agreement_when_skipped']:.1%} of them.")
+    else:
+        print(".")
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local email pre-classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Train incrementally on newly stored emails.")
+    train_parser.add_argument("--full", action="store_true", help="Retrain from scratch on all stored emails.")
+    report_parser = subparsers.add_parser("report", help="Report agreement with the stored LLM labels.")
+    report_parser.add_argument("--holdout", type=float, default=0.0, help="Evaluate on the newest fraction of emails using a model trained on the rest.")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train(full=args.full)
+    else:
+        report(holdout=args.holdout)
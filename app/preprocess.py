@@ -0,0 +1,146 @@
+import re
+import threading
+from html import unescape
+from html.parser import HTMLParser
+from typing import Tuple
+
+from app.config import settings
+from app.utils import estimate_tokens
+
+# Cut-off markers for the quoted part of a reply (Gmail/Apple Mail and Outlook styles)
+_REPLY_HEADER_RE = re.compile(r'^On\b.{0,300}\bwrote:\s*$', re.IGNORECASE | re.DOTALL)
+_ORIGINAL_MESSAGE_RE = re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}', re.IGNORECASE)
+_OUTLOOK_FROM_RE = re.compile(r'^\s*\*?From:\*?\s', re.IGNORECASE)
+_OUTLOOK_HEADER_RE = re.compile(r'^\s*\*?(Sent|Date|To|Subject):\*?\s', re.IGNORECASE)
+# "-- " is the standard signature delimiter (RFC 3676); mobile clients add their own footer
+_SIGNATURE_RE = re.compile(r'^(-- ?|Sent from my .*|Get Outlook for .*)$', re.IGNORECASE)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_SPACES_RE = re.compile(r'[ \t\r\f\v]+')
+
+TRUNCATION_MARKER = "\n[...]\n"
+HEAD_RATIO = 0.75 # Share of the token budget kept from the start of the body; the rest comes from the end
+
+class _TextExtractor(HTMLParser):
+    _SKIP_TAGS = {"script", "style", "head", "title"}
+    _BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "blockquote", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+def html_to_text(html: str) -> str:
+    """
+    Converts an HTML email body to plain text: drops scripts, styles and tags,
+    decodes entities and keeps block elements on separate lines.
+    """
+    parser = _TextExtractor()
+    try:
+        parser.feed(html or "")
+        parser.close()
+        text = "".join(parser.parts)
+    except Exception:
+        # Malformed markup: fall back to stripping anything that looks like a tag
+        text = unescape(re.sub(r'<[^>]+>', ' ', html or ""))
+    lines = (_SPACES_RE.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+def strip_quoted_reply(text: str) -> str:
+    """
+    Removes the quoted earlier messages of a reply: everything after an
+    "On ... wrote:" line or an Outlook "Original Message"/"From: ... Sent:" header,
+    and any remaining lines quoted with '>'. Returns the text unchanged if
+    nothing would be left.
+    """
+    lines = (text or "").split("\n")
+    cut = len(lines)
+    for i, line in enumerate(lines):
+        # Long "On <date>, <name> wrote:" lines are often wrapped onto two lines
+        joined = line + " " + lines[i + 1] if i + 1 < len(lines) else line
+        if (
+            _REPLY_HEADER_RE.match(line.strip()) or _REPLY_HEADER_RE.match(joined.strip())
+            or _ORIGINAL_MESSAGE_RE.match(line)
+            or (_OUTLOOK_FROM_RE.match(line) and any(_OUTLOOK_HEADER_RE.match(l) for l in lines[i + 1:i + 4]))
+        ):
+            cut = i
+            break
+    kept = [line for line in lines[:cut] if not line.lstrip().startswith(">")]
+    stripped = "\n".join(kept).strip()
+    return stripped or (text or "")
+
+def strip_signature(text: str) -> str:
+    """
+    Removes the signature block starting at a "-- " delimiter or a mobile client
+    footer. Returns the text unchanged if nothing would be left.
+    """
+    lines = (text or "").split("\n")
+    for i, line in enumerate(lines):
+        if i and _SIGNATURE_RE.match(line.strip()):
+            return "\n".join(lines[:i]).strip() or (text or "")
+    return text or ""
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Shortens text to about `max_tokens`, keeping the beginning (greeting and
+    request) and the end (closing ask) and dropping the middle.
+    """
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+    budget_chars = max(0, (max_tokens - 1) * 4 - len(TRUNCATION_MARKER))
+    head_chars = int(budget_chars * HEAD_RATIO)
+    tail_chars = budget_chars - head_chars
+    return text[:head_chars].rstrip() + TRUNCATION_MARKER + text[len(text) - tail_chars:].lstrip()
+
+_lock = threading.Lock()
+_emails_processed = 0
+_tokens_saved = 0
+
+def prepare_body(body: str) -> Tuple[str, int]:
+    """
+    Cleans an email body for the classification prompt. The stored body is not
+    changed. Returns (prompt_body, tokens_saved).
+    """
+    global _emails_processed, _tokens_saved
+    text = body or ""
+    if "<" in text and re.search(r'<(html|body|div|p|br|table)\b', text, re.IGNORECASE):
+        text = html_to_text(text)
+    if settings.PROMPT_STRIP_QUOTES:
+        text = strip_signature(strip_quoted_reply(text))
+    text = truncate_tokens(text.strip(), settings.PROMPT_BODY_MAX_TOKENS)
+    saved = max(0, estimate_tokens(body) - estimate_tokens(text))
+    with _lock:
+        _emails_processed += 1
+        _tokens_saved += saved
+    return text, saved
+
+def prompt_body(email_data: dict) -> str:
+    """
+    Returns the prompt-ready body of an email dict, preparing it once and keeping
+    the result and the tokens saved on the dict ('prompt_body', 'tokens_saved').
+    """
+    if "prompt_body" not in email_data:
+        email_data["prompt_body"], email_data["tokens_saved"] = prepare_body(email_data.get("body", ""))
+        if email_data["tokens_saved"]:
+            print(f"Prompt body for '{email_data.get('subject', '')}' trimmed by ~{email_data['tokens_saved']} tokens.")
+    return email_data["prompt_body"]
+
+def stats() -> dict:
+    """Returns preprocessing totals for this process."""
+    with _lock:
+        return {"emails_processed": _emails_processed, "tokens_saved": _tokens_saved}
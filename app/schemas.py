@@ -1,28 +1,88 @@
-from typing import TypedDict, Annotated, List, Optional
+from typing import TypedDict, Annotated, Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 import operator
 
-# LangGraph Agent State
+# LangGraph Agent State: one email, processed by its own sub-run
 class AgentState(TypedDict):
-    emails: List[dict] # List of emails to process in the current run
-    current_email_index: int
     current_email: Optional[dict]
     classification: Optional[str]
     response_generated: bool
     response_sent: bool
+    pending_reply: Optional[dict] # Reply queued in the outbox together with the email
+
+# Structured LLM output for batched classification
+class ClassificationResult(BaseModel):
+    message_id: str
+    classification: Literal["SPAM", "Unwanted", "Important"]
+    confidence: Optional[float] = Field(None, ge=0, le=1) # Only requested while the model cascade is enabled
 
 # FastAPI Response Models
+class PipelineStageStats(BaseModel):
+    stage: str
+    processed: int
+    busy_seconds: float = Field(..., description="Time spent working, excluding waits on the stage's queues.")
+    throughput_per_second: Optional[float] = None
+    queue_depth: int = 0
+    max_queue_depth: int = Field(0, description="Most items seen waiting in front of the stage during the run.")
+
 class MailProcessResponse(BaseModel):
     message: str
     processed_count: int
     new_emails_fetched: int
+    deferred_count: int = 0 # Left for a later run because the LLM was unavailable
+    stages: List[PipelineStageStats] = []
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str = Field(..., description="'queued', 'running', 'completed' or 'failed'.")
+    fetched: int = 0
+    classified: int = 0
+    replied: int = Field(0, description="Replies queued in the outbox for delivery.")
+    stored: int = 0
+    deferred: int = Field(0, description="Emails left for a later run because the LLM was unavailable.")
+    result: Optional[MailProcessResponse] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
 
 class EmailEntry(BaseModel):
+    # Fields other than id are optional so the dashboard can return projections (fields=...)
     id: int
-    message_id: str = Field(..., description="Unique identifier for the email message.")
-    subject: str
-    sender: str
-    body: str
-    classification: str
-    response_sent: bool
-    timestamp: str
\ No newline at end of file
+    message_id: Optional[str] = Field(None, description="Unique identifier for the email message.")
+    subject: Optional[str] = None
+    sender: Optional[str] = None
+    body: Optional[str] = None
+    classification: Optional[str] = None
+    response_sent: Optional[bool] = None
+    timestamp: Optional[str] = None
+
+class DashboardPage(BaseModel):
+    items: List[EmailEntry]
+    next_cursor: Optional[str] = Field(None, description="Pass as 'cursor' to fetch the next page; null on the last page.")
+
+class SearchHit(BaseModel):
+    id: int
+    message_id: Optional[str] = None
+    subject: Optional[str] = None
+    sender: Optional[str] = None
+    classification: Optional[str] = None
+    response_sent: Optional[bool] = None
+    timestamp: Optional[str] = None
+    snippet: Optional[str] = Field(None, description="Matching text with the matched terms in [brackets].")
+    score: float = Field(..., description="BM25 relevance; lower is a better match.")
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = Field(None, description="Pass as 'cursor' to fetch the next page; null on the last page.")
+
+class EmailStats(BaseModel):
+    day: Optional[str] = Field(None, description="ISO day the emails were stored; null for the totals.")
+    total: int
+    by_classification: Dict[str, int]
+    replied: int = Field(..., description="Emails whose automatic reply was delivered.")
+    reply_rate: Optional[float] = Field(None, description="Share of 'Important' emails that were replied to.")
+
+class StatsResponse(BaseModel):
+    days: List[EmailStats]
+    totals: EmailStats
@@ -1,9 +1,43 @@
 # This file is for general utility functions that don't fit into other modules.
 # Currently, it's empty, but it's good practice to have it for future expansion.
 
+import base64
+import itertools
+import json
+from typing import Iterable, Iterator, Tuple, Union
+
 # Example of a potential utility function:
 def format_email_address(full_address: str) -> str:
     """Extracts just the email address from a 'Name <email@example.com>' string."""
     import re
     match = re.search(r'<([^>]+)>', full_address)
-    return match.group(1) if match else full_address
\ No newline at end of file
+    return match.group(1) if match else full_address
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    """Groups any iterable (including generators) into lists of at most `size` items."""
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def encode_cursor(timestamp: Union[str, float], row_id: int) -> str:
+    """
+    Encodes a (timestamp, id) keyset position as an opaque URL-safe cursor.
+    Search results use the (score, id) of the last hit instead.
+    """
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Decodes a cursor produced by encode_cursor. Raises ValueError if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return str(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count for budgeting (about four characters per token)."""
+    return len(text or "") // 4 + 1
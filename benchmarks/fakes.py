@@ -0,0 +1,325 @@
+"""
+Local stand-ins for the external services, used by the benchmark harness:
+an in-process IMAP server, an SMTP sink and a fake chat model. They speak just
+enough of each protocol for imaplib, smtplib and the LangChain call sites in
+the app, without TLS.
+"""
+import asyncio
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from email.message import EmailMessage
+from typing import Optional, Tuple
+
+from langchain_core.messages import AIMessage
+
+# --- Synthetic mailbox ---
+
+_SPAM_SUBJECTS = ["You are a lottery winner", "Cheap pills, no prescription", "Claim your free prize"]
+_UNWANTED_SUBJECTS = ["Weekly newsletter", "Webinar invitation", "Survey about our service"]
+_IMPORTANT_SUBJECTS = ["Invoice for the last order", "Contract renewal", "Meeting request about the project"]
+
+def _vocabulary(size: int, seed: int) -> list[str]:
+    # A large pseudo-word vocabulary keeps the bodies far apart for the near-duplicate cache
+    rng = random.Random(seed)
+    return ["".join(rng.choice("bcdfghjklmnprstvwz") + rng.choice("aeiou") for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+def build_mailbox(count: int, seed: int = 42, body_words: int = 120) -> list[bytes]:
+    """
+    Returns `count` raw RFC822 messages: roughly a third each of SPAM, Unwanted
+    and Important mail, with random filler so that bodies are distinct.
+    """
+    rng = random.Random(seed)
+    words = _vocabulary(5000, seed)
+    messages = []
+    for i in range(count):
+        subjects = (_SPAM_SUBJECTS, _UNWANTED_SUBJECTS, _IMPORTANT_SUBJECTS)[i % 3]
+        msg = EmailMessage()
+        msg["Message-ID"] = f"<bench-{i}@example.com>"
+        msg["From"] = f"sender{i % 97}@example.com"
+        msg["To"] = "me@example.com"
+        msg["Subject"] = f"{rng.choice(subjects)} #{i}"
+        msg.set_content(" ".join(rng.choice(words) for _ in range(body_words)))
+        messages.append(msg.as_bytes())
+    return messages
+
+# --- IMAP ---
+
+class _Mailbox:
+    def __init__(self, messages: list[bytes]):
+        self.lock = threading.Lock()
+        self.uidvalidity = 1
+        self.messages = [{"uid": i + 1, "raw": raw, "seen": False} for i, raw in enumerate(messages)]
+
+    def resolve(self, message_set: str, by_uid: bool) -> list[dict]:
+        """Turns an IMAP sequence set ('1:4,7,9:*') into the matching messages."""
+        if not self.messages:
+            return []
+        highest = self.messages[-1]["uid"] if by_uid else len(self.messages)
+        wanted = set()
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            first = highest if start == "*" else int(start)
+            last = first if not end else (highest if end == "*" else int(end))
+            wanted.update(range(min(first, last), max(first, last) + 1))
+        if by_uid:
+            return [m for m in self.messages if m["uid"] in wanted]
+        return [m for n, m in enumerate(self.messages, start=1) if n in wanted]
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        mailbox: _Mailbox = self.server.mailbox
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE UIDPLUS] Fake IMAP server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode(errors="replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            by_uid = command == "UID"
+            if by_uid:
+                command, _, args = args.partition(" ")
+                command = command.upper()
+            try:
+                if command == "LOGOUT":
+                    self.send("* BYE Logging out")
+                    self.send(f"{tag} OK LOGOUT completed")
+                    return
+                self.dispatch(tag, command, args, by_uid, mailbox)
+            except Exception as e:
+                self.send(f"{tag} BAD {e}")
+
+    def dispatch(self, tag: str, command: str, args: str, by_uid: bool, mailbox: _Mailbox):
+        if command == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 IDLE UIDPLUS")
+        elif command in ("LOGIN", "NOOP", "CHECK", "CLOSE"):
+            pass
+        elif command in ("SELECT", "EXAMINE"):
+            with mailbox.lock:
+                uidnext = (mailbox.messages[-1]["uid"] if mailbox.messages else 0) + 1
+                self.send(f"* {len(mailbox.messages)} EXISTS")
+            self.send("* 0 RECENT")
+            self.send("* FLAGS (\\Seen)")
+            self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+            self.send(f"* OK [UIDNEXT {uidnext}] Predicted next UID")
+            self.send(f"{tag} OK [READ-WRITE] {command} completed")
+            return
+        elif command == "SEARCH":
+            self.search(args, by_uid, mailbox)
+        elif command == "FETCH":
+            self.fetch(args, by_uid, mailbox)
+        elif command == "STORE":
+            message_set, _, change = args.partition(" ")
+            with mailbox.lock:
+                for message in mailbox.resolve(message_set, by_uid):
+                    if "\\Seen" in change:
+                        message["seen"] = change.startswith("+")
+        else:
+            self.send(f"{tag} BAD Unsupported command {command}")
+            return
+        self.send(f"{tag} OK {command} completed")
+
+    def search(self, args: str, by_uid: bool, mailbox: _Mailbox):
+        criteria = args.upper().split()
+        with mailbox.lock:
+            numbered = list(enumerate(mailbox.messages, start=1))
+            if "UNSEEN" in criteria:
+                numbered = [(n, m) for n, m in numbered if not m["seen"]]
+            if "UID" in criteria:
+                message_set = args.split()[criteria.index("UID") + 1]
+                selected = {m["uid"] for m in mailbox.resolve(message_set, by_uid=True)}
+                numbered = [(n, m) for n, m in numbered if m["uid"] in selected]
+            hits = [str(m["uid"] if by_uid else n) for n, m in numbered]
+        self.send("* SEARCH" + ("".join(" " + hit for hit in hits)))
+
+    def fetch(self, args: str, by_uid: bool, mailbox: _Mailbox):
+        message_set, _, items = args.partition(" ")
+        items = items.upper()
+        headers_only = "HEADER.FIELDS" in items
+        marks_seen = not headers_only and ("RFC822" in items or "BODY[]" in items)
+        with mailbox.lock:
+            numbers = {id(m): n for n, m in enumerate(mailbox.messages, start=1)}
+            selected = mailbox.resolve(message_set, by_uid)
+        out = []
+        for message in selected:
+            raw = message["raw"]
+            if headers_only:
+                match = re.search(rb"^Message-ID:.*?\r?\n", raw, re.IGNORECASE | re.MULTILINE)
+                data, item = (match.group(0) if match else b"") + b"\r\n", "BODY[HEADER.FIELDS (MESSAGE-ID)]"
+            else:
+                data, item = raw, "RFC822" if "RFC822" in items else "BODY[]"
+            if marks_seen:
+                message["seen"] = True
+            prefix = f"* {numbers[id(message)]} FETCH (UID {message['uid']} {item} {{{len(data)}}}\r\n"
+            out.append(prefix.encode() + data + b")\r\n")
+        self.wfile.write(b"".join(out))
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    Plain-text IMAP4rev1 server on 127.0.0.1 serving one in-memory mailbox.
+    Supports what the app uses in "full" fetch mode: LOGIN, SELECT, SEARCH
+    (UNSEEN, UID ranges), FETCH of whole messages or the Message-ID header,
+    STORE of \\Seen, in both sequence-number and UID form.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: list[bytes], port: int = 0):
+        super().__init__(("127.0.0.1", port), _ImapHandler)
+        self.mailbox = _Mailbox(messages)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "FakeImapServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# --- SMTP ---
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def send(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.send("220 fake-smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.send("250-fake-smtp")
+                self.send("250-AUTH PLAIN")
+                self.send("250 8BITMIME")
+            elif command == "HELO":
+                self.send("250 fake-smtp")
+            elif command == "AUTH":
+                self.send("235 2.7.0 Authentication successful")
+            elif command == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    size += len(data_line)
+                self.server.record(size)
+                self.send("250 2.0.0 Queued")
+            elif command == "QUIT":
+                self.send("221 Bye")
+                return
+            else: # MAIL, RCPT, RSET, NOOP
+                self.send("250 OK")
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """Plain-text SMTP server on 127.0.0.1 that accepts any login and counts delivered messages."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _SmtpHandler)
+        self.received = 0
+        self.received_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def record(self, size: int):
+        with self._lock:
+            self.received += 1
+            self.received_bytes += size
+
+    def start(self) -> "SmtpSink":
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# --- LLM ---
+
+_BATCH_RE = re.compile(r"Emails \(JSON\): (\[.*\])\s*$", re.MULTILINE)
+_SUBJECT_RE = re.compile(r"Email Subject: (.*)")
+
+def expected_classification(text: str) -> str:
+    """Label the fake model gives, decided by the keywords in the synthetic subjects."""
+    lowered = text.lower()
+    if any(word in lowered for word in ("lottery", "pills", "prize")):
+        return "SPAM"
+    if any(word in lowered for word in ("invoice", "contract", "meeting")):
+        return "Important"
+    return "Unwanted"
+
+class FakeChatModel:
+    """
+    Chat model stand-in with the invoke/ainvoke interface the app calls.
+    Each call sleeps for `latency` seconds (±`jitter`), fails with a transient
+    ConnectionError with probability `error_rate`, and otherwise answers
+    single and batched classification prompts deterministically.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.2, error_rate: float = 0.0, seed: int = 7):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _delay_and_maybe_fail(self) -> Tuple[float, bool]:
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def _answer(self, prompt: str) -> AIMessage:
+        with_confidence = "confidence" in prompt.lower()
+        batch = _BATCH_RE.search(prompt)
+        if batch:
+            items = json.loads(batch.group(1))
+            answer = []
+            for item in items:
+                entry = {"message_id": item["message_id"], "classification": expected_classification(item["subject"])}
+                if with_confidence:
+                    entry["confidence"] = 0.95
+                answer.append(entry)
+            return AIMessage(content=json.dumps(answer))
+        subject = _SUBJECT_RE.search(prompt)
+        label = expected_classification(subject.group(1) if subject else prompt)
+        return AIMessage(content=f"{label} 0.95" if with_confidence else label)
+
+    def invoke(self, messages: list, **kwargs) -> AIMessage:
+        delay, fail = self._delay_and_maybe_fail()
+        time.sleep(delay)
+        if fail:
+            raise ConnectionError("fake LLM connection reset")
+        return self._answer(messages[-1].content)
+
+    async def ainvoke(self, messages: list, **kwargs) -> AIMessage:
+        delay, fail = self._delay_and_maybe_fail()
+        await asyncio.sleep(delay)
+        if fail:
+            raise ConnectionError("fake LLM connection reset")
+        return self._answer(messages[-1].content)
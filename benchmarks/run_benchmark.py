@@ -0,0 +1,170 @@
+"""
+Offline end-to-end benchmark of the mail pipeline: the staged ingest pipeline
+(fetch, parse, classify, reply, store) -> outbox -> SMTP, against the local
+stand-ins in benchmarks/fakes.py. Each mailbox size runs in a fresh worker
+process, so peak RSS and the latency histograms belong to that run alone.
+
+Usage:
+    python -m benchmarks.run_benchmark --sizes 100 1000 10000 --llm-latency 0.05 --llm-error-rate 0.01
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import FakeChatModel, FakeImapServer, SmtpSink, build_mailbox
+
+def worker_environment(imap_port: int, smtp_port: int, workdir: str, sync_mode: str) -> dict:
+    """Settings for a worker process that talks only to the stand-ins."""
+    env = dict(os.environ)
+    env.update({
+        "GROQ_API_KEY": "benchmark",
+        "API_KEY": "benchmark",
+        "EMAIL_ADDRESS": "me@example.com",
+        "EMAIL_APP_PASSWORD": "benchmark",
+        "IMAP_SERVER": "127.0.0.1",
+        "IMAP_PORT": str(imap_port),
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "MAIL_USE_TLS": "false",
+        "MAIL_SYNC_MODE": sync_mode,
+        "PRECLASSIFIER_MODEL_PATH": os.path.join(workdir, "preclassifier.npz"),
+        # The fake model has no provider limits; keep the client-side pacing out of the measurement
+        "LLM_REQUESTS_PER_MINUTE": "1000000",
+        "LLM_TOKENS_PER_MINUTE": "1000000000",
+        "LLM_RETRY_BASE_SECONDS": "0.01",
+        "LLM_RETRY_MAX_SECONDS": "0.1",
+    })
+    return env
+
+def stage_latencies() -> dict:
+    """p50/p99 per pipeline stage in milliseconds, estimated from the /metrics histograms."""
+    from app.metrics import DB_LATENCY, IMAP_FETCH_LATENCY, LLM_LATENCY, NODE_LATENCY, SMTP_SEND_LATENCY
+
+    stages = {"imap_fetch": (IMAP_FETCH_LATENCY, {}), "llm_request": (LLM_LATENCY, {}), "smtp_send": (SMTP_SEND_LATENCY, {})}
+    for labels in NODE_LATENCY.label_sets():
+        stages[f"node:{labels['node']}"] = (NODE_LATENCY, labels)
+    for labels in DB_LATENCY.label_sets():
+        stages[f"db:{labels['operation']}"] = (DB_LATENCY, labels)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        name: {"count": histogram.count(**labels), "p50_ms": ms(histogram.quantile(0.5, **labels)), "p99_ms": ms(histogram.quantile(0.99, **labels))}
+        for name, (histogram, labels) in stages.items()
+    }
+
+def run_pipeline() -> dict:
+    """
+    Processes the whole mailbox once and drains the outbox, in this process.
+    Settings must already point at the stand-ins and the LLM must be replaced.
+    """
+    from app.database import init_db
+    from app.email_client import imap_sessions, smtp_sender
+    from app.main import check_mailbox
+    from app.outbox import outbox_dispatcher
+
+    init_db()
+    started = time.perf_counter()
+    result = check_mailbox()
+    replies = 0
+    while True:
+        attempted = outbox_dispatcher.drain_once()
+        replies += attempted
+        if attempted < outbox_dispatcher.batch_size:
+            break
+    elapsed = time.perf_counter() - started
+    imap_sessions.close()
+    smtp_sender.close()
+    return {
+        "fetched": result.new_emails_fetched,
+        "processed": result.processed_count,
+        "deferred": result.deferred_count,
+        "replies": replies,
+        "seconds": round(elapsed, 3),
+        "emails_per_second": round(result.processed_count / elapsed, 1) if elapsed else None,
+        "stages": stage_latencies(),
+        "pipeline": [stage.model_dump() for stage in result.stages],
+    }
+
+def run_worker(args):
+    from app import database, langgraph_agent
+    from app.llm_client import create_llm_client
+
+    database.DATABASE_FILE = os.path.join(args.workdir, "emails.db")
+    chat_model = FakeChatModel(latency=args.llm_latency, error_rate=args.llm_error_rate)
+    langgraph_agent.llm = create_llm_client(chat_model)
+    langgraph_agent.large_llm = create_llm_client(chat_model)
+    result = run_pipeline()
+    result["llm_calls"] = chat_model.calls
+    result["llm_errors"] = chat_model.errors
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # KiB on Linux
+    with open(args.output, "w") as f:
+        json.dump(result, f)
+
+def benchmark_size(size: int, args) -> dict:
+    imap_server = FakeImapServer(build_mailbox(size)).start()
+    smtp_sink = SmtpSink().start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, "result.json")
+            command = [
+                sys.executable, "-m", "benchmarks.run_benchmark", "--worker", "--workdir", workdir, "--output", output,
+                "--llm-latency", str(args.llm_latency), "--llm-error-rate", str(args.llm_error_rate),
+            ]
+            env = worker_environment(imap_server.port, smtp_sink.port, workdir, args.sync_mode)
+            stdout = None if args.verbose else subprocess.DEVNULL
+            subprocess.run(command, env=env, stdout=stdout, check=True)
+            with open(output) as f:
+                result = json.load(f)
+    finally:
+        imap_server.stop()
+        smtp_sink.stop()
+    result["size"] = size
+    result["smtp_received"] = smtp_sink.received
+    return result
+
+def print_report(results: list[dict]):
+    print(f"{'emails':>8} {'emails/s':>10} {'seconds':>9} {'peak RSS MB':>12} {'replies':>8} {'deferred':>9} {'LLM calls':>10}")
+    for r in results:
+        print(f"{r['size']:>8} {r['emails_per_second']:>10} {r['seconds']:>9} {r['peak_rss_mb']:>12} {r['smtp_received']:>8} {r['deferred']:>9} {r['llm_calls']:>10}")
+    for r in results:
+        print(f"\nStage latencies at {r['size']} emails (ms, estimated from histogram buckets):")
+        print(f"  {'stage':<40} {'count':>8} {'p50':>10} {'p99':>10}")
+        for name, stage in sorted(r["stages"].items()):
+            if stage["count"]:
+                print(f"  {name:<40} {stage['count']:>8} {stage['p50_ms']:>10} {stage['p99_ms']:>10}")
+        print(f"\nIngest pipeline at {r['size']} emails:")
+        print(f"  {'stage':<10} {'items':>8} {'items/s':>10} {'busy s':>9} {'max queue':>10}")
+        for stage in r["pipeline"]:
+            print(f"  {stage['stage']:<10} {stage['processed']:>8} {stage['throughput_per_second']!s:>10} {stage['busy_seconds']:>9} {stage['max_queue_depth']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the SmartMail pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Mailbox sizes to benchmark.")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per fake LLM request.")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of fake LLM requests that fail transiently.")
+    parser.add_argument("--sync-mode", choices=["unseen", "uid"], default="unseen", help="MAIL_SYNC_MODE of the run.")
+    parser.add_argument("--json", help="Also write the full results to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the application's log output.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+    results = [benchmark_size(size, args) for size in args.sizes]
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def isolated_database(tmp_path, monkeypatch):
+    """Points every database access at a throwaway SQLite file instead of emails.db."""
+    db_file = str(tmp_path / "emails.db")
+    monkeypatch.setattr('app.database.DATABASE_FILE', db_file)
+    monkeypatch.setattr('app.config.settings.PRECLASSIFIER_MODEL_PATH', str(tmp_path / "preclassifier.npz"))
+    yield db_file
@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+import time
+from fastapi.testclient import TestClient
+from app.config import settings
+from app.database import init_db, store_emails_bulk
+from app.main import app
+from app.schemas import MailProcessResponse
+
+client = TestClient(app)
+HEADERS = {"X-API-Key": settings.API_KEY}
+
+def store_sample_emails(start: int, count: int):
+    store_emails_bulk([
+        {"message_id": f"<m{i}@example.com>", "subject": f"Subject, {i}", "sender": "a@example.com",
+         "body": "Line one\nLine two", "classification": "SPAM", "response_sent": False}
+        for i in range(start, start + count)
+    ])
+
+def test_export_streams_ndjson_incrementally(monkeypatch):
+    """Test that /export streams all rows in small chunks and resumes from the watermark."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.EXPORT_FETCH_SIZE', 2)
+    store_sample_emails(0, 5)
+
+    response = client.get("/export", headers=HEADERS)
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == [1, 2, 3, 4, 5]
+    assert rows[0]["body"] == "Line one\nLine two"
+    watermark = response.headers["X-Export-Watermark"]
+    assert watermark == "5"
+
+    store_sample_emails(5, 2)
+    response = client.get(f"/export?since={watermark}", headers=HEADERS)
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [6, 7]
+
+def test_export_csv_quotes_fields():
+    """Test that /export?format=csv writes a header and properly quoted rows."""
+    init_db()
+    store_sample_emails(0, 3)
+    response = client.get("/export?format=csv", headers=HEADERS)
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0][:3] == ["id", "message_id", "subject"]
+    assert len(rows) == 4
+    assert rows[1][2] == "Subject, 0"
+
+    empty = client.get("/export?format=csv&since=3", headers=HEADERS)
+    assert list(csv.reader(io.StringIO(empty.text))) == [rows[0]]
+
+def test_check_mails_returns_job_and_reports_progress(monkeypatch):
+    """Test that /check-mails answers immediately with a job whose progress is visible at /jobs/{id}."""
+    def fake_check_mailbox(job):
+        job.add(fetched=2, classified=2, stored=2)
+        return MailProcessResponse(message="done", processed_count=2, new_emails_fetched=2)
+    monkeypatch.setattr('app.main.check_mailbox', fake_check_mailbox)
+
+    response = client.post("/check-mails", headers=HEADERS)
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    for _ in range(500):
+        job = client.get(f"/jobs/{job_id}", headers=HEADERS).json()
+        if job["status"] == "completed":
+            break
+        time.sleep(0.01)
+    assert job["status"] == "completed"
+    assert (job["fetched"], job["classified"], job["stored"]) == (2, 2, 2)
+    assert job["result"]["processed_count"] == 2
+    assert client.get("/jobs/unknown", headers=HEADERS).status_code == 404
+
+def test_metrics_exposes_db_latency_in_prometheus_format():
+    """Test that /metrics requires the API key and reports database call timings."""
+    init_db()
+    store_sample_emails(0, 1)
+    assert client.get("/metrics").status_code in (401, 422)
+
+    response = client.get("/metrics", headers=HEADERS)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE smartmail_db_duration_seconds histogram" in response.text
+    assert 'smartmail_db_duration_seconds_bucket{operation="store_emails_bulk",le="+Inf"}' in response.text
+    assert "smartmail_llm_requests_per_minute{tier=\"small\"}" in response.text
+
+def test_search_returns_ranked_pages_and_rejects_bad_queries():
+    """Test that /search pages through matches with filters and reports invalid queries as 400."""
+    init_db()
+    store_sample_emails(0, 5)
+    store_emails_bulk([{"message_id": "<r@example.com>", "subject": "Refund request", "sender": "b@example.com",
+                        "body": "Line one", "classification": "Important", "response_sent": True}])
+
+    response = client.get("/search", params={"q": "line", "limit": 4}, headers=HEADERS)
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["items"]) == 4 and page["next_cursor"]
+    rest = client.get("/search", params={"q": "line", "limit": 4, "cursor": page["next_cursor"]}, headers=HEADERS).json()
+    assert len(rest["items"]) == 2 and rest["next_cursor"] is None
+
+    replied = client.get("/search", params={"q": "refund", "response_sent": "true"}, headers=HEADERS).json()["items"]
+    assert [hit["message_id"] for hit in replied] == ["<r@example.com>"]
+    assert replied[0]["snippet"] == "[Refund] request"
+    assert client.get("/search", params={"q": "refund", "classification": "SPAM"}, headers=HEADERS).json()["items"] == []
+    assert client.get("/search", params={"q": "AND"}, headers=HEADERS).status_code == 400
+
+def test_stats_reports_per_day_counts_and_reply_rate():
+    """Test that /stats reports per-day counts by classification, the reply rate of Important emails and date filters."""
+    init_db()
+    store_sample_emails(0, 3)
+    store_emails_bulk([
+        {"message_id": f"<i{i}@example.com>", "subject": "Order", "sender": "b@example.com", "body": "Hi",
+         "classification": "Important", "response_sent": i == 0}
+        for i in range(4)
+    ])
+    response = client.get("/stats", headers=HEADERS)
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["days"]) == 1
+    assert body["totals"]["total"] == 7
+    assert body["totals"]["by_classification"] == {"SPAM": 3, "Important": 4}
+    assert body["totals"]["replied"] == 1 and body["totals"]["reply_rate"] == 0.25
+    assert client.get("/stats", params={"date_from": "2999-01-01"}, headers=HEADERS).json()["days"] == []
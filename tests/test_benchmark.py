@@ -0,0 +1,47 @@
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from app import database
+from app.config import settings
+from app.llm_client import create_llm_client
+from benchmarks.fakes import FakeChatModel, FakeImapServer, SmtpSink, build_mailbox
+from benchmarks.run_benchmark import run_pipeline
+
+@pytest.fixture
+def stand_ins(monkeypatch):
+    """Points the app at a fake IMAP server with 30 synthetic emails and a local SMTP sink."""
+    imap_server = FakeImapServer(build_mailbox(30)).start()
+    smtp_sink = SmtpSink().start()
+    monkeypatch.setattr(settings, "IMAP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(settings, "IMAP_PORT", imap_server.port)
+    monkeypatch.setattr(settings, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(settings, "SMTP_PORT", smtp_sink.port)
+    monkeypatch.setattr(settings, "MAIL_USE_TLS", False)
+    monkeypatch.setattr(settings, "MAIL_SYNC_MODE", "unseen")
+    yield imap_server, smtp_sink
+    imap_server.stop()
+    smtp_sink.stop()
+
+@pytest.mark.parametrize("error_rate", [0.0, 0.3])
+def test_pipeline_end_to_end_against_stand_ins(stand_ins, monkeypatch, error_rate):
+    """Test that the benchmark pipeline fetches, classifies, replies and stores every email."""
+    imap_server, smtp_sink = stand_ins
+    monkeypatch.setattr(settings, "LLM_RETRY_BASE_SECONDS", 0.001)
+    chat_model = FakeChatModel(latency=0.001, error_rate=error_rate)
+    with patch('app.langgraph_agent.llm', create_llm_client(chat_model)):
+        result = run_pipeline()
+
+    assert result["processed"] == 30 and result["deferred"] == 0
+    assert result["replies"] == 10
+    assert smtp_sink.received == 10
+    assert all(m["seen"] for m in imap_server.mailbox.messages) # RFC822 fetches mark mail as read
+    assert result["stages"]["node:classify_email"]["count"] >= 30
+    assert result["stages"]["imap_fetch"]["p99_ms"] is not None
+    assert [s["stage"] for s in result["pipeline"]] == ["fetch", "parse", "classify", "reply", "store"]
+    assert all(s["processed"] == 30 for s in result["pipeline"])
+
+    with sqlite3.connect(database.DATABASE_FILE) as conn:
+        counts = dict(conn.execute("SELECT classification, COUNT(*) FROM emails GROUP BY classification").fetchall())
+    assert counts == {"SPAM": 10, "Unwanted": 10, "Important": 10}
@@ -0,0 +1,93 @@
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.cascade import CascadeStats, needs_escalation, parse_label_and_confidence
+from app.config import settings
+from app.langgraph_agent import classify_email, classify_emails_concurrently
+
+@pytest.fixture
+def cascade(monkeypatch):
+    """Enables the cascade with fresh statistics and mocked small and large models."""
+    monkeypatch.setattr(settings, "CASCADE_ENABLED", True)
+    monkeypatch.setattr(settings, "CASCADE_CONFIDENCE_THRESHOLD", 0.8)
+    stats = CascadeStats()
+    with patch('app.langgraph_agent.llm') as small, patch('app.langgraph_agent.large_llm') as large, \
+            patch('app.langgraph_agent.cascade_stats', stats):
+        yield small, large, stats
+
+def _state(subject, body):
+    return {
+        "current_email": {"message_id": subject, "subject": subject, "sender": "a@example.com", "body": body},
+        "classification": None,
+        "response_generated": False,
+        "response_sent": False
+    }
+
+def test_parse_label_and_confidence():
+    """Test that labels and confidences are read from plain, parenthesized and JSON answers."""
+    assert parse_label_and_confidence("SPAM 0.93") == ("SPAM", 0.93)
+    assert parse_label_and_confidence("Important (confidence: .6)") == ("Important", 0.6)
+    assert parse_label_and_confidence('{"classification": "unwanted", "confidence": 1}') == ("Unwanted", 1.0)
+    assert parse_label_and_confidence("SPAM") == ("SPAM", None)
+    assert parse_label_and_confidence("no idea") == (None, None)
+
+def test_needs_escalation(monkeypatch):
+    """Test that unsure, unparseable and Important answers go to the large model."""
+    monkeypatch.setattr(settings, "CASCADE_CONFIDENCE_THRESHOLD", 0.8)
+    assert not needs_escalation("SPAM", 0.9)
+    assert needs_escalation("SPAM", 0.5)
+    assert needs_escalation("Important", 0.99) # Triggers a reply, so always confirmed
+    assert needs_escalation("Unwanted", None)
+    assert needs_escalation(None, 0.99)
+
+def test_confident_small_answer_is_not_escalated(cascade):
+    """Test that a confident small-model answer settles the email without the large model."""
+    small, large, stats = cascade
+    small.invoke.return_value.content = "SPAM 0.97"
+    result = classify_email(_state("Cheap pills now", "Buy cheap pills"))
+    assert result["classification"] == "SPAM"
+    large.invoke.assert_not_called()
+    summary = stats.summary()
+    assert summary["small"]["settled"] == 1 and summary["large"]["requests"] == 0
+
+def test_unsure_or_important_answers_are_escalated(cascade):
+    """Test that low-confidence and Important answers are confirmed by the large model."""
+    small, large, stats = cascade
+    small.invoke.side_effect = [MagicMock(content="Unwanted 0.55"), MagicMock(content="Important 0.99")]
+    large.invoke.side_effect = [MagicMock(content="SPAM"), MagicMock(content="Important")]
+    assert classify_email(_state("Quarterly webinar", "Join our webinar"))["classification"] == "SPAM"
+    assert classify_email(_state("Contract renewal", "Please sign the contract"))["classification"] == "Important"
+    assert large.invoke.call_count == 2
+    summary = stats.summary()
+    assert summary["small"]["escalated"] == 2 and summary["large"]["settled"] == 2
+
+def test_batched_cascade_escalates_only_unsure_items(cascade):
+    """Test that a batched prompt escalates only the items the small model is unsure about."""
+    small, large, stats = cascade
+
+    async def small_answer(messages):
+        return MagicMock(content=json.dumps([
+            {"message_id": "b-0", "classification": "SPAM", "confidence": 0.95},
+            {"message_id": "b-1", "classification": "Unwanted", "confidence": 0.4},
+            {"message_id": "b-2", "classification": "Important", "confidence": 0.9},
+        ]))
+
+    async def large_answer(messages):
+        return MagicMock(content="Important" if "Invoice" in messages[0].content else "Unwanted")
+
+    small.ainvoke.side_effect = small_answer
+    large.ainvoke.side_effect = large_answer
+    emails = [
+        {"message_id": f"b-{i}", "subject": subject, "sender": "a@example.com", "body": f"About the {subject.lower()}"}
+        for i, subject in enumerate(["Lottery", "Digest", "Invoice"])
+    ]
+    asyncio.run(classify_emails_concurrently(emails))
+
+    assert [e["classification"] for e in emails] == ["SPAM", "Unwanted", "Important"]
+    assert small.ainvoke.call_count == 1
+    assert large.ainvoke.call_count == 2
+    summary = stats.summary()
+    assert summary["small"]["settled"] == 1 and summary["small"]["escalated"] == 2
@@ -1,21 +1,22 @@
+import asyncio
 import pytest
-from unittest.mock import MagicMock, patch
-from app.langgraph_agent import classify_email, AgentState
+from unittest.mock import AsyncMock, MagicMock, patch
+import json
+from app.langgraph_agent import classify_email, classify_emails, classify_emails_concurrently, pack_classification_batches, AgentState
 from app.schemas import AgentState as AgentStateType # Use alias to avoid conflict
 
 # Mock the LLM for testing classification without actual API calls
 @pytest.fixture
 def mock_llm_invoke():
     """Fixture to mock the LLM's invoke method."""
-    with patch('app.langgraph_agent.llm.invoke') as mock_invoke:
-        yield mock_invoke
+    # ChatGroq is a pydantic model, so patch the module-level instance instead of its method
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        yield mock_llm.invoke
 
 def test_classify_email_important(mock_llm_invoke):
     """Test classification of an 'Important' email."""
     mock_llm_invoke.return_value.content = "Important"
     initial_state: AgentStateType = {
-        "emails": [], # Not used in this node
-        "current_email_index": 0,
         "current_email": {
             "message_id": "test-1",
             "subject": "Meeting Confirmation",
@@ -28,14 +29,13 @@ def test_classify_email_important(mock_llm_invoke):
     }
     result_state = classify_email(initial_state)
     assert result_state["classification"] == "Important"
+    assert initial_state["current_email"]["classification_source"] == "llm"
     mock_llm_invoke.assert_called_once()
 
 def test_classify_email_spam(mock_llm_invoke):
     """Test classification of a 'SPAM' email."""
     mock_llm_invoke.return_value.content = "SPAM"
     initial_state: AgentStateType = {
-        "emails": [],
-        "current_email_index": 0,
         "current_email": {
             "message_id": "test-2",
             "subject": "Free V1agra",
@@ -54,8 +54,6 @@ def test_classify_email_unwanted(mock_llm_invoke):
     """Test classification of an 'Unwanted' email."""
     mock_llm_invoke.return_value.content = "Unwanted"
     initial_state: AgentStateType = {
-        "emails": [],
-        "current_email_index": 0,
         "current_email": {
             "message_id": "test-3",
             "subject": "Newsletter Update",
@@ -73,8 +71,6 @@ def test_classify_email_unwanted(mock_llm_invoke):
 def test_classify_email_no_current_email():
     """Test classification when no current email is present."""
     initial_state: AgentStateType = {
-        "emails": [],
-        "current_email_index": 0,
         "current_email": None, # No email to classify
         "classification": None,
         "response_generated": False,
@@ -90,8 +86,6 @@ def test_classify_email_llm_error(mock_llm_invoke):
     """Test handling of LLM errors during classification."""
     mock_llm_invoke.side_effect = Exception("LLM API error")
     initial_state: AgentStateType = {
-        "emails": [],
-        "current_email_index": 0,
         "current_email": {
             "message_id": "test-4",
             "subject": "Error Test",
@@ -104,14 +98,13 @@ def test_classify_email_llm_error(mock_llm_invoke):
     }
     result_state = classify_email(initial_state)
     assert result_state["classification"] == "Unwanted" # Expect fallback to 'Unwanted'
+    assert initial_state["current_email"]["classification_source"] == "fallback" # Never used for training
     mock_llm_invoke.assert_called_once()
 
 def test_classify_email_unexpected_llm_output(mock_llm_invoke):
     """Test handling of unexpected LLM classification output."""
     mock_llm_invoke.return_value.content = "UnexpectedCategory"
     initial_state: AgentStateType = {
-        "emails": [],
-        "current_email_index": 0,
         "current_email": {
             "message_id": "test-5",
             "subject": "Unexpected Output",
@@ -124,4 +117,126 @@ def test_classify_email_unexpected_llm_output(mock_llm_invoke):
     }
     result_state = classify_email(initial_state)
     assert result_state["classification"] == "Unwanted" # Expect fallback to 'Unwanted'
-    mock_llm_invoke.assert_called_once()
\ No newline at end of file
+    assert initial_state["current_email"]["classification_source"] == "fallback" # Never used for training
+    mock_llm_invoke.assert_called_once()
+
+def test_classify_email_uses_precomputed_classification(mock_llm_invoke):
+    """Test that an email classified in parallel mode is not sent to the LLM again."""
+    initial_state: AgentStateType = {
+        "current_email": {
+            "message_id": "test-6",
+            "subject": "Quarterly Review",
+            "sender": "cfo@example.com",
+            "body": "Please review the attached figures.",
+            "classification": "Important"
+        },
+        "classification": None,
+        "response_generated": False,
+        "response_sent": False
+    }
+    result_state = classify_email(initial_state)
+    assert result_state["classification"] == "Important"
+    mock_llm_invoke.assert_not_called()
+
+def test_classify_emails_concurrently_bounded_and_ordered():
+    """Test that parallel classification respects the concurrency limit and keeps batch order."""
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_ainvoke(messages):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        prompt = messages[0].content
+        # Finish later emails first to make sure ordering does not depend on completion order
+        await asyncio.sleep(0.01 if "cheap offer" in prompt else 0.02)
+        in_flight -= 1
+        return MagicMock(content="SPAM" if "cheap offer" in prompt else "Important")
+
+    emails = [
+        {"message_id": f"id-{i}", "subject": f"Subject {i}", "sender": "a@example.com",
+         "body": "cheap offer" if i % 2 else "meeting request"}
+        for i in range(10)
+    ]
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        mock_llm.ainvoke.side_effect = fake_ainvoke
+        asyncio.run(classify_emails_concurrently(emails, max_concurrency=3))
+
+    assert max_in_flight <= 3
+    assert [e["classification"] for e in emails] == ["Important", "SPAM"] * 5
+
+def test_consecutive_batches_share_one_event_loop():
+    """Test that batch after batch reuses the loop the async client is bound to, as httpx clients require."""
+    bound = {}
+
+    async def loop_bound_ainvoke(messages):
+        loop = bound.setdefault("loop", asyncio.get_running_loop())
+        if loop is not asyncio.get_running_loop():
+            raise RuntimeError("Event loop is closed")
+        return MagicMock(content="SPAM")
+
+    batches = [
+        [{"message_id": "loop-1", "subject": "Claim your lottery prize", "sender": "a@example.com", "body": "You won"}],
+        [{"message_id": "loop-2", "subject": "Cheap watches", "sender": "b@example.com", "body": "Replica sale today"}],
+    ]
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        mock_llm.ainvoke.side_effect = loop_bound_ainvoke
+        for emails in batches:
+            classify_emails(emails)
+
+    assert [(e["classification"], e["classification_source"]) for batch in batches for e in batch] == [("SPAM", "llm")] * 2
+
+def test_batch_dedup_follows_the_cache_setting(monkeypatch):
+    """Test that emails differing only in numbers share a label only with the cache on, and copies are marked as cached."""
+    def invoice(i: int, amount: int) -> dict:
+        return {"message_id": f"inv-{i}", "subject": f"Invoice {amount}", "sender": "a@example.com", "body": f"Amount due: {amount} EUR"}
+
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        mock_llm.ainvoke = AsyncMock(side_effect=lambda messages: MagicMock(content="Important"))
+        monkeypatch.setattr('app.config.settings.CLASSIFICATION_CACHE_ENABLED', False)
+        emails = [invoice(1, 120), invoice(2, 99000), invoice(1, 120)]
+        classify_emails(emails)
+        prompts = [call.args[0][0].content for call in mock_llm.ainvoke.call_args_list]
+        assert any("99000" in prompt for prompt in prompts) # Asked about, not copied from inv-1
+        assert [e["classification_source"] for e in emails] == ["llm", "llm", "llm"]
+
+        monkeypatch.setattr('app.config.settings.CLASSIFICATION_CACHE_ENABLED', True)
+        emails = [invoice(3, 7), invoice(4, 8)]
+        classify_emails(emails)
+        assert [e["classification_source"] for e in emails] == ["llm", "cache"]
+
+def test_batched_classification_with_per_email_fallback():
+    """Test that one prompt classifies a packed batch and only invalid answers fall back to single prompts."""
+    prompts = []
+
+    async def fake_ainvoke(messages):
+        prompt = messages[0].content
+        prompts.append(prompt)
+        if "Emails (JSON)" in prompt:
+            # id-2 gets an invalid label, id-3 is missing from the answer
+            return MagicMock(content="Here you go:\n" + json.dumps([
+                {"message_id": "id-0", "classification": "Important"},
+                {"message_id": "id-1", "classification": "SPAM"},
+                {"message_id": "id-2", "classification": "Maybe"},
+            ]))
+        return MagicMock(content="Unwanted")
+
+    emails = [
+        {"message_id": f"id-{i}", "subject": subject, "sender": "a@example.com", "body": f"About the {subject.lower()}"}
+        for i, subject in enumerate(["Contract", "Lottery", "Newsletter", "Survey"])
+    ]
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        mock_llm.ainvoke.side_effect = fake_ainvoke
+        asyncio.run(classify_emails_concurrently(emails))
+
+    assert [e["classification"] for e in emails] == ["Important", "SPAM", "Unwanted", "Unwanted"]
+    assert len(prompts) == 3 # One batch prompt plus two single-email fallbacks
+
+def test_pack_classification_batches_respects_budget():
+    """Test that batches respect the email cap and token budget, and oversized emails go alone."""
+    emails = [{"message_id": f"id-{i}", "subject": "s", "body": "x" * 400} for i in range(5)]
+    emails.append({"message_id": "big", "subject": "s", "body": "x" * 40000})
+    batches = pack_classification_batches(emails, token_budget=500, max_emails=3)
+    assert [len(b) for b in batches] == [2, 2, 1, 1]
+    assert batches[-1][0]["message_id"] == "big"
+    assert [len(b) for b in pack_classification_batches(emails[:5], token_budget=10000, max_emails=3)] == [3, 2]
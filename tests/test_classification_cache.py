@@ -0,0 +1,55 @@
+import pytest
+from app.classification_cache import ClassificationCache, content_hash, hamming_distance, simhash
+
+NEWSLETTER_BODY = (
+    "Hello there, this week in our newsletter we cover the latest product updates, "
+    "upcoming webinars and a special discount for loyal readers. Visit https://example.com/?u=123 "
+    "to read more. You are receiving this email because you subscribed on 2024-01-02."
+)
+
+@pytest.fixture
+def cache():
+    return ClassificationCache(max_entries=3, ttl_seconds=3600, max_distance=3)
+
+def test_content_hash_ignores_case_whitespace_urls_and_numbers():
+    """Test that trivially different copies of a campaign share one cache key."""
+    assert content_hash("Weekly  News", NEWSLETTER_BODY) == content_hash(
+        "weekly news", NEWSLETTER_BODY.replace("?u=123", "?u=987").replace("2024-01-02", "2025-06-30")
+    )
+
+def test_simhash_near_duplicates_are_close():
+    """Test that a small edit keeps the SimHash fingerprints within a few bits."""
+    original = simhash(NEWSLETTER_BODY)
+    edited = simhash(NEWSLETTER_BODY.replace("Hello there", "Hi there"))
+    unrelated = simhash("Please confirm the meeting with the board about the quarterly budget review.")
+    assert hamming_distance(original, edited) < hamming_distance(original, unrelated)
+
+def test_exact_hit_and_miss_counters(cache):
+    """Test exact lookups and the hit/miss counters."""
+    assert cache.get("Weekly News", NEWSLETTER_BODY) is None
+    cache.put("Weekly News", NEWSLETTER_BODY, "Unwanted")
+    assert cache.get("WEEKLY NEWS", NEWSLETTER_BODY) == "Unwanted"
+    stats = cache.stats()
+    assert stats["exact_hits"] == 1
+    assert stats["misses"] == 1
+
+def test_near_duplicate_hit(cache):
+    """Test that an almost identical email is matched through the SimHash index."""
+    cache.put("Weekly News", NEWSLETTER_BODY, "Unwanted")
+    assert cache.get("Weekly News", NEWSLETTER_BODY + " Unsubscribe here.") == "Unwanted"
+    assert cache.stats()["near_hits"] == 1
+
+def test_lru_eviction(cache):
+    """Test that the least recently used entry is evicted beyond max_entries."""
+    for i in range(3):
+        cache.put(f"Subject {i}", f"unique body number {'x' * i}", "SPAM")
+    cache.get("Subject 0", "unique body number ") # Refresh the oldest entry
+    cache.put("Subject 3", "another unique body", "SPAM")
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("Subject 0", "unique body number ") == "SPAM"
+
+def test_ttl_expiry():
+    """Test that expired entries are not returned."""
+    cache = ClassificationCache(max_entries=10, ttl_seconds=0, max_distance=3)
+    cache.put("Weekly News", NEWSLETTER_BODY, "Unwanted")
+    assert cache.get("Weekly News", NEWSLETTER_BODY) is None
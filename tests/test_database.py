@@ -0,0 +1,283 @@
+import sqlite3
+import threading
+from unittest.mock import patch
+from app import database
+import pytest
+from app.database import get_connection, get_email_stats, get_emails_by_message_ids, get_existing_message_ids, init_db, query_emails, search_emails, store_bodies, store_emails_bulk
+from app.main import run_ingest_pipeline
+
+def make_record(i: int, classification: str = "Unwanted", response_sent: bool = False) -> dict:
+    return {"message_id": f"<m{i}@example.com>", "subject": f"Subject {i}", "sender": "a@example.com",
+            "body": "Body", "classification": classification, "response_sent": response_sent}
+
+def test_connection_is_reused_per_thread_and_uses_wal():
+    """Test that each thread keeps one tuned connection."""
+    conn = get_connection()
+    assert get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+def test_connections_of_exited_threads_are_closed():
+    """Test that short-lived threads do not leave pooled connections (and file descriptors) behind."""
+    get_connection()
+
+    def run_threads():
+        threads = [threading.Thread(target=lambda: get_connection().execute("SELECT 1")) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    run_threads()
+    pooled = len(database._connections)
+    for _ in range(5):
+        run_threads()
+    assert len(database._connections) <= pooled
+
+    opened = []
+
+    def exiting_thread():
+        opened.append(get_connection())
+        database.close_thread_connection()
+
+    thread = threading.Thread(target=exiting_thread)
+    thread.start()
+    thread.join()
+    assert opened[0] not in database._connections
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute("SELECT 1")
+
+def test_bulk_upsert_inserts_and_updates():
+    """Test that a batch is upserted and a sent reply is never reset."""
+    init_db()
+    store_emails_bulk([make_record(1, response_sent=True), make_record(2)])
+    store_emails_bulk([make_record(1, classification="SPAM", response_sent=False), make_record(3)])
+
+    rows = get_emails_by_message_ids(["<m1@example.com>", "<m2@example.com>", "<m3@example.com>", "<missing>"])
+    assert sorted(rows) == ["<m1@example.com>", "<m2@example.com>", "<m3@example.com>"]
+    assert rows["<m1@example.com>"][5] == "SPAM"
+    assert rows["<m1@example.com>"][6] == 1
+    assert get_existing_message_ids(["<m2@example.com>", "<missing>"]) == {"<m2@example.com>"}
+
+def test_pipeline_writes_in_batches(monkeypatch):
+    """Test that the store stage writes at most DB_WRITE_BATCH_SIZE emails per transaction."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.PARALLEL_CLASSIFICATION', False)
+    monkeypatch.setattr('app.config.settings.DB_WRITE_BATCH_SIZE', 2)
+    emails = [dict(make_record(i), classification="SPAM") for i in range(5)]
+    with patch('app.langgraph_agent.store_emails_bulk', wraps=database.store_emails_bulk) as bulk:
+        run_ingest_pipeline(iter(emails))
+    sizes = [len(call.args[0]) for call in bulk.call_args_list]
+    assert sum(sizes) == 5 and max(sizes) <= 2
+    assert len(get_existing_message_ids([e["message_id"] for e in emails])) == 5
+
+def test_pipeline_stores_a_large_batch_in_order(monkeypatch):
+    """Test that a large backlog is processed chunk by chunk and stored, with its replies, in fetch order."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.PARALLEL_CLASSIFICATION', False)
+    emails = [dict(make_record(i), classification="Important" if i % 3 == 0 else "SPAM") for i in range(1000)]
+    run = run_ingest_pipeline(iter(emails))
+    assert run["processed"] == 1000 and run["fetched"] == 1000
+    rows = get_connection().execute("SELECT message_id FROM emails ORDER BY id").fetchall()
+    assert [row[0] for row in rows] == [e["message_id"] for e in emails]
+    assert get_connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 334
+
+def test_query_emails_pages_with_keyset_cursor():
+    """Test that pages follow (timestamp, id) order without gaps or repeats, and that filters and projections apply."""
+    init_db()
+    store_emails_bulk([make_record(i, classification="SPAM" if i % 2 else "Unwanted") for i in range(7)])
+    # Give two rows the same timestamp so the id tie-breaker is exercised
+    get_connection().execute("UPDATE emails SET timestamp = '2024-01-01 00:00:00' WHERE id IN (3, 4)")
+
+    seen, after = [], None
+    while True:
+        rows, has_more = query_emails(3, after=after, fields=["subject"])
+        seen.extend(row["id"] for row in rows)
+        assert all(set(row) == {"id", "timestamp", "subject"} for row in rows)
+        if not has_more:
+            break
+        after = (rows[-1]["timestamp"], rows[-1]["id"])
+    assert sorted(seen) == list(range(1, 8))
+    assert len(seen) == len(set(seen))
+    assert seen[-2:] == [4, 3]
+
+    spam, _ = query_emails(10, classification="SPAM")
+    assert {row["classification"] for row in spam} == {"SPAM"}
+    assert len(spam) == 3
+    old, _ = query_emails(10, date_to="2024-01-02")
+    assert [row["id"] for row in old] == [4, 3]
+
+    with pytest.raises(ValueError):
+        query_emails(10, fields=["password"])
+
+def test_search_index_follows_stored_emails_and_outside_writes_work():
+    """Test that the index follows stored emails and changes from plain SQLite clients, and subject hits rank first."""
+    init_db()
+    store_emails_bulk([
+        {**make_record(1), "subject": "Lunch", "body": "About the invoice you sent"},
+        {**make_record(2, classification="Important"), "subject": "Invoice 42 overdue", "body": "Please pay"},
+        {**make_record(3), "subject": "Hello", "body": "Nothing here"},
+    ])
+    rows, has_more = search_emails("invoice", 10)
+    assert [row["id"] for row in rows] == [2, 1] and not has_more
+    assert "[Invoice]" in rows[0]["snippet"]
+    assert [row["id"] for row in search_emails("invoice", 10, classification="Important")[0]] == [2]
+
+    # A re-run only reclassifies; the text (and the index) stay as they are
+    store_emails_bulk([{**make_record(3, classification="SPAM"), "subject": "Hello", "body": "Nothing here"}])
+    assert [row["id"] for row in search_emails("nothing", 10)[0]] == [3]
+
+    # Like the sqlite3 shell: no inflate() registered
+    outside = sqlite3.connect(database.DATABASE_FILE)
+    with outside:
+        outside.execute("UPDATE emails SET subject = 'Refund for the invoice' WHERE id = 3")
+        outside.execute("DELETE FROM emails WHERE id = 1")
+        outside.execute("INSERT INTO emails (message_id, subject, sender, classification) VALUES ('<cli@example.com>', 'Invoice copy', 'a@example.com', 'SPAM')")
+    assert sorted(row["subject"] for row in search_emails("invoice", 10)[0]) == ["Invoice 42 overdue", "Invoice copy", "Refund for the invoice"]
+    assert search_emails("lunch", 10)[0] == []
+    assert [row["id"] for row in search_emails("nothing", 10)[0]] == [3] # The body was not changed
+
+    # A reused id must not keep the deleted email's terms
+    with outside:
+        outside.execute("DELETE FROM emails WHERE id = 2")
+        outside.execute("INSERT INTO emails (id, message_id, subject, sender, classification) VALUES (2, '<reused@example.com>', 'Weather', 'b@example.com', 'SPAM')")
+    outside.close()
+    assert search_emails("overdue", 10)[0] == []
+    assert [row["message_id"] for row in search_emails("weather", 10)[0]] == ["<reused@example.com>"]
+    # The index matches one rebuilt from scratch
+    get_connection().execute("INSERT INTO emails_fts (emails_fts, rank) VALUES ('integrity-check', 1)")
+    with pytest.raises(ValueError):
+        search_emails('"unbalanced', 10)
+
+def test_search_index_is_backfilled_once_and_pages_by_score():
+    """Test that a database from before the index is backfilled and that pages neither gap nor repeat."""
+    init_db()
+    conn = get_connection()
+    with conn:
+        conn.execute("DROP TABLE emails_fts")
+        conn.execute("DROP TABLE emails_fts_pending")
+        for trigger in ("emails_fts_log_insert", "emails_fts_log_delete", "emails_fts_log_update"):
+            conn.execute(f"DROP TRIGGER {trigger}")
+    store_emails_bulk([{**make_record(i), "body": "report " * (i % 4 + 1)} for i in range(9)])
+
+    init_db()
+    seen, after = [], None
+    while True:
+        rows, has_more = search_emails("report", 4, after=after)
+        seen.extend(row["id"] for row in rows)
+        if not has_more:
+            break
+        after = (rows[-1]["score"], rows[-1]["id"])
+    assert sorted(seen) == list(range(1, 10)) and len(seen) == len(set(seen))
+
+def test_email_stats_follow_inserts_reclassifications_and_replies():
+    """Test that the summary table moves emails between keys as they are reclassified and replied to."""
+    init_db()
+    store_emails_bulk([make_record(1, "SPAM"), make_record(2, "Important"), make_record(3, "Important")])
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE emails SET timestamp = '2024-03-01 10:00:00' WHERE id = 3")
+    store_emails_bulk([make_record(1, "Unwanted")]) # A re-run reclassifies (and re-dates) email 1
+    with conn:
+        conn.execute("UPDATE emails SET response_sent = 1 WHERE id = 2") # What mark_reply_sent does
+        conn.execute("DELETE FROM emails WHERE id = 3")
+
+    days = get_email_stats()
+    assert len(days) == 1
+    assert days[0]["total"] == 2 and days[0]["replied"] == 1
+    assert days[0]["by_classification"] == {"Unwanted": 1, "Important": 1}
+    # Matches a full scan of the emails
+    scanned = dict(conn.execute("SELECT classification, COUNT(*) FROM emails GROUP BY classification").fetchall())
+    assert days[0]["by_classification"] == scanned
+
+def test_email_stats_are_backfilled_once():
+    init_db()
+    conn = get_connection()
+    with conn:
+        conn.execute("DROP TABLE email_stats")
+        for trigger in ("email_stats_insert", "email_stats_delete", "email_stats_update"):
+            conn.execute(f"DROP TRIGGER {trigger}")
+    store_emails_bulk([make_record(i, "SPAM" if i % 3 else "Important", response_sent=not i % 3) for i in range(9)])
+    with conn:
+        conn.execute("UPDATE emails SET timestamp = '2024-03-01 10:00:00' WHERE id <= 3")
+
+    init_db()
+    days = get_email_stats()
+    assert [d["day"] for d in days][0] == "2024-03-01"
+    assert sum(d["total"] for d in days) == 9 and sum(d["replied"] for d in days) == 3
+    assert [d["day"] for d in get_email_stats(date_from="2024-03-02")] == [d["day"] for d in days[1:]]
+
+def test_bodies_are_compressed_deduplicated_and_read_lazily():
+    """Test that identical bodies are stored once, compressed, and only decompressed when asked for."""
+    init_db()
+    newsletter = "Our weekly newsletter. " * 200
+    store_emails_bulk([{**make_record(i), "body": newsletter} for i in range(5)] + [{**make_record(5), "body": "Short"}])
+    conn = get_connection()
+    bodies = conn.execute("SELECT hash, length(data), size FROM email_bodies").fetchall()
+    assert len(bodies) == 2
+    assert all(stored < size for _, stored, size in bodies if size > 100)
+    assert conn.execute("SELECT COUNT(*) FROM emails WHERE body IS NOT NULL").fetchone()[0] == 0
+    assert get_emails_by_message_ids(["<m3@example.com>"])["<m3@example.com>"][4] == newsletter
+
+    # Corrupt the stored blob: only reads that select the body may touch it
+    with conn:
+        conn.execute("UPDATE email_bodies SET data = x'00' WHERE size > 100")
+    rows, _ = query_emails(10, fields=["subject", "classification"])
+    assert len(rows) == 6
+    assert search_emails("short", 10)[0][0]["id"] == 6
+    with pytest.raises(Exception):
+        query_emails(10, fields=["body"])
+
+def test_inline_bodies_are_migrated_once():
+    """Test that a database from before compressed storage is migrated and stays searchable."""
+    conn = get_connection()
+    with conn:
+        conn.execute("""
+            CREATE TABLE emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT UNIQUE, subject TEXT, sender TEXT, body TEXT,
+                classification TEXT, response_sent BOOLEAN DEFAULT FALSE, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE VIRTUAL TABLE emails_fts USING fts5(subject, sender, body, content = 'emails', content_rowid = 'id')")
+        conn.executemany(
+            "INSERT INTO emails (message_id, subject, sender, body, classification) VALUES (?, ?, ?, ?, 'SPAM')",
+            [(f"<m{i}@example.com>", f"Subject {i}", "a@example.com", f"Quarterly report {i % 2}. " * 300) for i in range(40)]
+        )
+    pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+
+    init_db()
+    assert conn.execute("SELECT COUNT(*) FROM emails WHERE body IS NOT NULL").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM email_bodies").fetchone()[0] == 2
+    assert conn.execute("PRAGMA page_count").fetchone()[0] < pages_before
+    assert get_emails_by_message_ids(["<m1@example.com>"])["<m1@example.com>"][4] == "Quarterly report 1. " * 300
+    assert len(search_emails("quarterly", 100)[0]) == 40
+
+    init_db() # Nothing left to migrate
+    assert conn.execute("SELECT COUNT(*) FROM email_bodies").fetchone()[0] == 2
+
+def test_bodies_of_stored_emails_are_not_rewritten_and_unused_bodies_go():
+    """Test that re-storing an email writes no new body and that bodies no email refers to are removed."""
+    init_db()
+    store_emails_bulk([{**make_record(1), "body": "Shared"}, {**make_record(2), "body": "Shared"}, {**make_record(3), "body": "Own"}])
+    store_emails_bulk([{**make_record(3, "SPAM"), "body": "Own, fetched again with a new footer"}])
+    conn = get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM email_bodies").fetchone()[0] == 2
+    assert get_emails_by_message_ids(["<m3@example.com>"])["<m3@example.com>"][4] == "Own"
+
+    # Deletes from any client release bodies no longer used
+    outside = sqlite3.connect(database.DATABASE_FILE)
+    with outside:
+        outside.execute("DELETE FROM emails WHERE id IN (1, 3)")
+    outside.close()
+    assert [row[0] for row in conn.execute("SELECT size FROM email_bodies")] == [len("Shared")]
+
+    # Orphans left by earlier versions are removed on startup
+    with conn:
+        store_bodies(conn.cursor(), ["Orphan"])
+    init_db()
+    assert conn.execute("SELECT COUNT(*) FROM email_bodies").fetchone()[0] == 1
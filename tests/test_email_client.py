@@ -0,0 +1,355 @@
+import email
+import pytest
+from unittest.mock import patch
+from app.database import init_db, store_email_data
+from app.email_client import imap_sessions, fetch_unseen_emails, fetch_new_emails, find_text_section, parse_bodystructure, save_sync_watermark, stream_new_emails, stream_unseen_emails
+
+def make_message(message_id: str, subject: str, body: str) -> bytes:
+    return (
+        f"Message-ID: {message_id}\r\nSubject: {subject}\r\nFrom: Sender <sender@example.com>\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n\r\n{body}\r\n"
+    ).encode()
+
+class FakeIMAP:
+    """Minimal stand-in for imaplib.IMAP4_SSL serving an in-memory inbox."""
+
+    def __init__(self, messages: dict[bytes, bytes], uidvalidity: int = 1):
+        self.messages = messages # Keyed by sequence number, which doubles as the UID
+        self.uidvalidity = uidvalidity
+        self.seen = set()
+        self.commands = []
+        self.untagged_responses = {}
+
+    def login(self, user, password):
+        self.commands.append(("LOGIN",))
+        return 'OK', [b'Logged in']
+
+    def noop(self):
+        self.commands.append(("NOOP",))
+        return 'OK', [b'NOOP completed']
+
+    def select(self, mailbox):
+        self.commands.append(("SELECT", mailbox))
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def search(self, charset, criterion):
+        unseen = [num for num in self.messages if num not in self.seen]
+        return 'OK', [b" ".join(unseen)]
+
+    def fetch(self, message_set, parts):
+        self.commands.append(("FETCH", message_set, parts))
+        data = []
+        for num in self._expand(message_set):
+            raw = self.messages[num]
+            if 'HEADER.FIELDS' in parts:
+                header = raw.split(b"\r\n")[0] + b"\r\n\r\n"
+                data.append((num + b" (BODY[HEADER.FIELDS (MESSAGE-ID)] {%d}" % len(header), header))
+            else:
+                if 'PEEK' not in parts:
+                    self.seen.add(num)
+                data.append((num + b" (RFC822 {%d}" % len(raw), raw))
+            data.append(b")")
+        return 'OK', data
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.uidvalidity).encode()]
+        if code == 'UIDNEXT':
+            return code, [str(max(int(n) for n in self.messages) + 1).encode()]
+        return code, [None]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            criterion = args[-1]
+            if criterion == 'UNSEEN':
+                return self.search(None, criterion)
+            low = int(criterion.split()[1].split(":")[0])
+            uids = sorted(int(n) for n in self.messages)
+            # Like real servers, 'n:*' always includes the highest UID
+            matches = [u for u in uids if u >= low] or uids[-1:]
+            return 'OK', [b" ".join(str(u).encode() for u in matches)]
+        if command == 'FETCH':
+            message_set, parts = args
+            status, data = self.fetch(message_set, parts)
+            return status, [
+                (item[0].replace(b" (", b" (UID %s " % item[0].split()[0], 1), item[1]) if isinstance(item, tuple) else item
+                for item in data
+            ]
+        raise NotImplementedError(command)
+
+    def _expand(self, message_set):
+        nums = []
+        for part in message_set.split(b","):
+            low, _, high = part.partition(b":")
+            nums.extend(str(n).encode() for n in range(int(low), int(high or low) + 1))
+        return [n for n in nums if n in self.messages]
+
+    def store(self, message_set, command, flags):
+        self.commands.append(("STORE", message_set, flags))
+        self.seen.update(self._expand(message_set))
+        return 'OK', []
+
+    def logout(self):
+        return 'BYE', []
+
+@pytest.fixture
+def fake_imap():
+    imap = FakeIMAP({
+        b"1": make_message("<old@example.com>", "Already processed", "Old body"),
+        b"2": make_message("<new@example.com>", "Fresh email", "New body"),
+    })
+    with patch('app.email_client.imaplib.IMAP4_SSL', return_value=imap) as imap_class:
+        imap.imap_class = imap_class
+        yield imap
+    imap_sessions.close()
+
+def test_fetch_skips_messages_already_in_database(fake_imap):
+    """Test that only new messages are downloaded in full."""
+    init_db()
+    store_email_data("<old@example.com>", "Already processed", "sender@example.com", "Old body", "Unwanted")
+
+    emails = fetch_unseen_emails()
+
+    assert [e["message_id"] for e in emails] == ["<new@example.com>"]
+    assert emails[0]["body"].strip() == "New body"
+    full_fetches = [c for c in fake_imap.commands if c[0] == "FETCH" and c[2] == '(RFC822)']
+    assert [c[1] for c in full_fetches] == [b"2"]
+    # The header phase is a single FETCH for all candidates
+    header_fetches = [c for c in fake_imap.commands if c[0] == "FETCH" and 'HEADER.FIELDS' in c[2]]
+    assert [c[1] for c in header_fetches] == [b"1:2"]
+    assert ("STORE", b"1", '\\Seen') in fake_imap.commands
+
+def test_header_check_splits_large_backlogs_into_chunks(fake_imap, monkeypatch):
+    """Test that Message-ID fetches and \\Seen updates are sent per chunk, as compact sequence sets."""
+    monkeypatch.setattr('app.config.settings.IMAP_FETCH_CHUNK_SIZE', 4)
+    init_db()
+    fake_imap.messages = {str(n).encode(): make_message(f"<m{n}@example.com>", f"Email {n}", "Body") for n in range(1, 11)}
+    for n in range(1, 10):
+        store_email_data(f"<m{n}@example.com>", f"Email {n}", "sender@example.com", "Body", "Unwanted")
+
+    emails = fetch_unseen_emails()
+
+    assert [e["message_id"] for e in emails] == ["<m10@example.com>"]
+    header_fetches = [c[1] for c in fake_imap.commands if c[0] == "FETCH" and 'HEADER.FIELDS' in c[2]]
+    assert header_fetches == [b"1:4", b"5:8", b"9:10"]
+    stores = [c[1] for c in fake_imap.commands if c[0] == "STORE"]
+    assert stores == [b"1:4", b"5:8", b"9"]
+
+def test_messages_without_message_id_get_a_stable_fallback_id(fake_imap, monkeypatch):
+    """Test that a missing Message-ID falls back to a header hash, not the shifting sequence number."""
+    monkeypatch.setattr('app.email_client.settings.IMAP_SERVER', "imap.example.com")
+    init_db()
+    store_email_data("<1@imap.example.com>", "Stored earlier", "sender@example.com", "Old body", "Unwanted")
+    fake_imap.messages = {
+        b"1": b"Subject: No id\r\nFrom: a@example.com\r\nDate: Mon, 1 Jan 2024 10:00:00 +0000\r\n\r\nBody\r\n",
+    }
+    first = fetch_unseen_emails()
+    # Expunges elsewhere in the mailbox shift the sequence number
+    fake_imap.messages = {b"5": fake_imap.messages[b"1"]}
+    second = fetch_unseen_emails()
+
+    assert [e["subject"] for e in first] == ["No id"]
+    assert first[0]["message_id"] != "<1@imap.example.com>"
+    assert first[0]["message_id"].endswith("@imap.example.com>")
+    assert second[0]["message_id"] == first[0]["message_id"]
+    assert not [c for c in fake_imap.commands if c[0] == "STORE"]
+
+def test_fetch_downloads_everything_when_database_is_empty(fake_imap):
+    """Test that all unseen messages are fetched on a first run."""
+    init_db()
+    emails = fetch_unseen_emails()
+    assert [e["subject"] for e in emails] == ["Already processed", "Fresh email"]
+    assert not [c for c in fake_imap.commands if c[0] == "STORE"]
+
+def test_uid_sync_bootstraps_from_unseen_then_fetches_only_new_uids(fake_imap):
+    """Test that the first sync processes the UNSEEN backlog and later syncs only UIDs above the watermark."""
+    init_db()
+    fake_imap.seen.add(b"1") # Read by the user before the first sync
+
+    emails, watermark = fetch_new_emails("inbox")
+    assert [e["uid"] for e in emails] == [2]
+    assert watermark == {"mailbox": "inbox", "uidvalidity": 1, "last_uid": 2, "complete": True}
+    save_sync_watermark(watermark)
+
+    # Marking a message unread again must not make it reappear
+    fake_imap.seen.discard(b"2")
+    emails, watermark = fetch_new_emails("inbox")
+    assert emails == []
+    assert watermark["last_uid"] == 2
+
+    fake_imap.messages[b"3"] = make_message("<third@example.com>", "Third", "Third body")
+    emails, watermark = fetch_new_emails("inbox")
+    assert [e["message_id"] for e in emails] == ["<third@example.com>"]
+    assert watermark["last_uid"] == 3
+
+def test_uid_sync_resynchronizes_when_uidvalidity_changes(fake_imap):
+    """Test that a UIDVALIDITY change discards the old watermark."""
+    init_db()
+    save_sync_watermark({"mailbox": "inbox", "uidvalidity": 99, "last_uid": 1000, "complete": True})
+    emails, watermark = fetch_new_emails("inbox")
+    assert [e["uid"] for e in emails] == [1, 2]
+    assert watermark == {"mailbox": "inbox", "uidvalidity": 1, "last_uid": 2, "complete": True}
+
+def test_stream_fetches_in_chunks(fake_imap, monkeypatch):
+    """Test that messages are downloaded with one FETCH per chunk and yielded lazily."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.IMAP_FETCH_CHUNK_SIZE', 2)
+    for i in range(3, 6):
+        fake_imap.messages[str(i).encode()] = make_message(f"<m{i}@example.com>", f"Subject {i}", "Body")
+
+    stream = stream_unseen_emails()
+    first = next(stream)
+    assert first["subject"] == "Already processed"
+    full_fetches = [c[1] for c in fake_imap.commands if c[0] == "FETCH" and c[2] == '(RFC822)']
+    assert full_fetches == [b"1:2"] # Later chunks are not requested yet
+
+    assert len(list(stream)) == 4
+    full_fetches = [c[1] for c in fake_imap.commands if c[0] == "FETCH" and c[2] == '(RFC822)']
+    assert full_fetches == [b"1:2", b"3:4", b"5"]
+
+def test_interrupted_stream_does_not_complete_watermark(fake_imap):
+    """Test that the watermark is only saved when every message was delivered."""
+    init_db()
+    stream, watermark = stream_new_emails("inbox")
+    next(stream)
+    stream.close()
+    assert watermark["complete"] is False
+    save_sync_watermark(watermark)
+    emails, _ = fetch_new_emails("inbox")
+    assert len(emails) == 2
+
+def test_dropped_stream_does_not_hold_the_session(fake_imap):
+    """Test that a UID stream closed before its first email leaves the IMAP session free and the watermark unsaved."""
+    init_db()
+    stream, watermark = stream_new_emails("inbox")
+    stream.close()
+    assert not imap_sessions._lock.locked()
+    assert watermark["uidvalidity"] is None
+    save_sync_watermark(watermark)
+    emails, watermark = fetch_new_emails("inbox")
+    assert [e["uid"] for e in emails] == [1, 2] and watermark["complete"]
+
+def test_session_is_reused_across_fetches(fake_imap, monkeypatch):
+    """Test that repeated fetches share one login and health-check an idle session with NOOP."""
+    init_db()
+    monkeypatch.setattr(imap_sessions, "healthcheck_interval", 0)
+    fetch_unseen_emails()
+    fetch_unseen_emails()
+    assert fake_imap.imap_class.call_count == 1
+    assert fake_imap.commands.count(("LOGIN",)) == 1
+    assert fake_imap.commands.count(("SELECT", "inbox")) == 1
+    assert ("NOOP",) in fake_imap.commands
+
+def test_session_reconnects_after_failed_noop(fake_imap, monkeypatch):
+    """Test that a dead session is replaced transparently."""
+    init_db()
+    monkeypatch.setattr(imap_sessions, "healthcheck_interval", 0)
+    fetch_unseen_emails()
+    monkeypatch.setattr(fake_imap, "noop", lambda: (_ for _ in ()).throw(OSError("connection reset")))
+    fake_imap.seen.clear()
+    assert len(fetch_unseen_emails()) == 2
+    assert fake_imap.imap_class.call_count == 2
+
+MIXED_STRUCTURE = (
+    b'1 (UID 1 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 12 1 NIL NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 30 1 NIL NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "alt") NIL NIL NIL)'
+    b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 1000000 NIL ("ATTACHMENT" ("FILENAME" "report.pdf")) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "mix") NIL NIL NIL))'
+)
+
+def test_bodystructure_selects_inline_text_part():
+    """Test that the first inline text/plain part is chosen and attachments are ignored."""
+    structure = parse_bodystructure(MIXED_STRUCTURE)
+    assert find_text_section(structure) == {"section": "1.1", "subtype": "plain", "encoding": "quoted-printable", "charset": "utf-8"}
+
+    html_only = parse_bodystructure(
+        b'2 (BODYSTRUCTURE (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL ("ATTACHMENT" ("FILENAME" "notes.txt")) NIL NIL)'
+        b'("TEXT" "HTML" ("CHARSET" "iso-8859-1") NIL NIL "BASE64" 40 1 NIL NIL NIL NIL) "MIXED" ("BOUNDARY" "b") NIL NIL NIL))'
+    )
+    assert find_text_section(html_only)["section"] == "2"
+    single = parse_bodystructure(b'3 (BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))')
+    assert find_text_section(single)["section"] == "TEXT"
+    assert find_text_section(parse_bodystructure(b'4 (BODYSTRUCTURE ("IMAGE" "PNG" NIL NIL NIL "BASE64" 9 NIL NIL NIL NIL))')) is None
+
+class StructureIMAP(FakeIMAP):
+    """FakeIMAP that also serves BODYSTRUCTURE and section fetches of multipart messages."""
+
+    def fetch(self, message_set, parts):
+        if 'BODYSTRUCTURE' not in parts and 'HEADER]' not in parts:
+            return super().fetch(message_set, parts)
+        self.commands.append(("FETCH", message_set, parts))
+        data = []
+        for num in self._expand(message_set):
+            raw = self.messages[num]
+            if 'BODYSTRUCTURE' in parts:
+                data.append(num + b" (" + self.structures[num] + b")")
+                continue
+            header, _, text = raw.partition(b"\r\n\r\n")
+            data.append((num + b" (BODY[HEADER] {%d}" % len(header), header + b"\r\n\r\n"))
+            section = parts.split("[")[-1].split("]")[0]
+            if section != "HEADER":
+                part = email.message_from_bytes(raw)
+                for index in ([] if section == "TEXT" else section.split(".")):
+                    part = part.get_payload()[int(index) - 1]
+                body = text if section == "TEXT" else part.get_payload().encode()
+                data.append((b" BODY[%s] {%d}" % (section.encode(), len(body)), body))
+            if 'PEEK' not in parts:
+                self.seen.add(num)
+            data.append(b")")
+        return 'OK', data
+
+def test_structure_mode_fetches_only_headers_and_text(monkeypatch):
+    """Test that structure mode never downloads attachments and decodes the text part."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.IMAP_FETCH_MODE', "structure")
+    multipart = (
+        b"Message-ID: <mixed@example.com>\r\nSubject: Report\r\nFrom: Sender <sender@example.com>\r\n"
+        b"MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary=mix\r\n\r\n"
+        b"--mix\r\nContent-Type: multipart/alternative; boundary=alt\r\n\r\n"
+        b"--alt\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n"
+        b"Caf=C3=A9 at 10?\r\n--alt\r\nContent-Type: text/html\r\n\r\n<p>Caf&eacute; at 10?</p>\r\n--alt--\r\n"
+        b"--mix\r\nContent-Type: application/pdf\r\nContent-Disposition: attachment; filename=report.pdf\r\n"
+        b"Content-Transfer-Encoding: base64\r\n\r\nJVBERi0xLjQ=\r\n--mix--\r\n"
+    )
+    imap = StructureIMAP({b"1": multipart, b"2": make_message("<plain@example.com>", "Plain", "Just text")})
+    imap.structures = {
+        b"1": MIXED_STRUCTURE.split(b"(", 1)[1].rsplit(b")", 1)[0].replace(b"UID 1 ", b""),
+        b"2": b'BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 11 1 NIL NIL NIL NIL)',
+    }
+    with patch('app.email_client.imaplib.IMAP4_SSL', return_value=imap):
+        emails = fetch_unseen_emails()
+    imap_sessions.close()
+
+    assert [e["message_id"] for e in emails] == ["<mixed@example.com>", "<plain@example.com>"]
+    assert emails[0]["subject"] == "Report"
+    assert emails[0]["body"].strip() == "Café at 10?"
+    assert emails[1]["body"].strip() == "Just text"
+    fetched_parts = [c[2] for c in imap.commands if c[0] == "FETCH"]
+    assert '(RFC822)' not in fetched_parts
+    assert '(BODY[HEADER] BODY[1.1])' in fetched_parts and '(BODY[HEADER] BODY[TEXT])' in fetched_parts
+    assert imap.seen == {b"1", b"2"}
+
+class LateUidIMAP(StructureIMAP):
+    """StructureIMAP whose section responses name the UID only after the first literal, as some servers do."""
+
+    def uid(self, command, *args):
+        if command != 'FETCH' or 'BODYSTRUCTURE' not in args[1] and 'HEADER]' not in args[1]:
+            return super().uid(command, *args)
+        status, data = self.fetch(*args)
+        if 'BODYSTRUCTURE' in args[1]:
+            return status, [item.replace(b" (", b" (UID %s " % item.split()[0], 1) for item in data]
+        return status, [item if isinstance(item, tuple) else b" UID %s)" % args[0] for item in data]
+
+def test_structure_mode_falls_back_to_full_fetch_for_unmatched_responses(monkeypatch):
+    """Test that a message whose section response carries no leading UID is fetched in full rather than dropped."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.IMAP_FETCH_MODE', "structure")
+    imap = LateUidIMAP({b"1": make_message("<late@example.com>", "Late UID", "Still here")})
+    imap.structures = {b"1": b'BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'}
+    with patch('app.email_client.imaplib.IMAP4_SSL', return_value=imap):
+        emails, watermark = fetch_new_emails("inbox")
+    imap_sessions.close()
+
+    assert [(e["message_id"], e["body"].strip()) for e in emails] == [("<late@example.com>", "Still here")]
+    assert ("FETCH", b"1", '(BODY.PEEK[])') in imap.commands
+    assert watermark["complete"]
@@ -0,0 +1,36 @@
+import socket
+import threading
+from unittest.mock import MagicMock
+from app.idle_listener import ImapIdleListener
+
+def run_fake_server(server_sock: socket.socket, exists_after_idle: bool):
+    """Plays the server side of one IDLE cycle over a socket pair."""
+    f = server_sock.makefile("rb")
+    tag = f.readline().split()[0]
+    server_sock.sendall(b"+ idling\r\n")
+    if exists_after_idle:
+        server_sock.sendall(b"* 4 EXISTS\r\n")
+    assert f.readline() == b"DONE\r\n"
+    server_sock.sendall(tag + b" OK IDLE terminated\r\n")
+
+def make_listener(client_sock: socket.socket, idle_timeout: int) -> ImapIdleListener:
+    listener = ImapIdleListener(on_new_mail=MagicMock(), idle_timeout=idle_timeout)
+    listener._mail = MagicMock()
+    listener._mail.socket.return_value = client_sock
+    return listener
+
+def test_idle_reports_new_mail_on_exists():
+    """Test that an EXISTS response ends the IDLE cycle with new mail."""
+    client_sock, server_sock = socket.socketpair()
+    server = threading.Thread(target=run_fake_server, args=(server_sock, True))
+    server.start()
+    assert make_listener(client_sock, idle_timeout=5)._idle() is True
+    server.join()
+
+def test_idle_times_out_without_activity():
+    """Test that a quiet IDLE cycle is refreshed after the timeout."""
+    client_sock, server_sock = socket.socketpair()
+    server = threading.Thread(target=run_fake_server, args=(server_sock, False))
+    server.start()
+    assert make_listener(client_sock, idle_timeout=0.1)._idle() is False
+    server.join()
@@ -0,0 +1,82 @@
+import threading
+import time
+from app.database import init_db
+from app.jobs import JobManager
+from app.main import run_ingest_pipeline
+from app.metrics import NODE_LATENCY
+
+def test_job_runs_in_background_and_reports_result():
+    """Test that submit returns immediately and the job records its result."""
+    manager = JobManager(history_size=10)
+    release = threading.Event()
+
+    def target(job):
+        job.add(fetched=3)
+        release.wait(5)
+        return {"done": True}
+
+    job = manager.submit(target)
+    assert job.status in ("queued", "running")
+    release.set()
+    manager.shutdown()
+    snapshot = job.snapshot()
+    assert snapshot["status"] == "completed"
+    assert snapshot["fetched"] == 3
+    assert snapshot["result"] == {"done": True}
+    assert manager.get(job.id) is job
+
+def test_failed_job_and_history_limit():
+    """Test that errors mark the job failed and only the newest finished jobs are kept."""
+    manager = JobManager(history_size=2)
+    jobs = []
+    for _ in range(3):
+        jobs.append(manager.submit(lambda job: 1 / 0))
+        for _ in range(500):
+            if jobs[-1].finished_at:
+                break
+            time.sleep(0.01)
+    manager.shutdown()
+    assert jobs[-1].status == "failed"
+    assert "division by zero" in jobs[-1].error
+    assert manager.get(jobs[0].id) is None
+    assert manager.get(jobs[2].id) is jobs[2]
+
+def test_ingest_pipeline_reports_progress(monkeypatch):
+    """Test that pipeline progress is counted per stage, and the store stage is timed as the store_email_data node."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.PARALLEL_CLASSIFICATION', False)
+    monkeypatch.setattr('app.config.settings.DB_WRITE_BATCH_SIZE', 2)
+    emails = [
+        {"message_id": f"<m{i}@example.com>", "subject": f"Subject {i}", "sender": "Bob <bob@example.com>",
+         "body": "Body", "classification": "Important" if i == 0 else "SPAM"}
+        for i in range(3)
+    ]
+    store_timings = NODE_LATENCY.count(node="store_email_data")
+    manager = JobManager(history_size=10)
+    job = manager.submit(lambda job: run_ingest_pipeline(iter(emails), job))
+    manager.shutdown()
+    snapshot = job.snapshot()
+    assert snapshot["status"] == "completed"
+    assert (snapshot["fetched"], snapshot["classified"], snapshot["replied"], snapshot["stored"]) == (3, 3, 1, 3)
+    assert NODE_LATENCY.count(node="store_email_data") > store_timings
+
+def test_submit_with_key_joins_job_in_progress():
+    """Test that a job with the same key is reused while active and a new one starts afterwards."""
+    manager = JobManager(history_size=10)
+    release = threading.Event()
+    calls = []
+
+    def target(job):
+        calls.append(job.id)
+        release.wait(5)
+
+    first = manager.submit(target, key="inbox")
+    assert manager.submit(target, key="inbox") is first
+    assert manager.submit(target, key="other") is not first
+    release.set()
+    first.wait(5)
+    second = manager.submit(target, key="inbox")
+    assert second is not first
+    second.wait(5)
+    manager.shutdown()
+    assert len(calls) == 3
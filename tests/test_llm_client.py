@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+import pytest
+from app.database import get_existing_message_ids, init_db
+from app.email_client import defer_emails
+from app.langgraph_agent import classify_email
+from app.main import run_ingest_pipeline
+from app.llm_client import CircuitBreaker, LLMUnavailableError, RateLimitedLLM, TokenBucket
+
+class FakeAPIError(Exception):
+    def __init__(self, status: int, headers: dict = None):
+        super().__init__(f"HTTP {status}")
+        self.status_code = status
+        self.response = SimpleNamespace(status_code=status, headers=headers or {})
+
+def make_client(llm, max_retries=3, breaker=None) -> RateLimitedLLM:
+    return RateLimitedLLM(llm, requests_per_minute=600, tokens_per_minute=100000, max_retries=max_retries,
+                          base_backoff=1, max_backoff=10, breaker=breaker or CircuitBreaker(5, 60))
+
+def test_retries_honour_retry_after_and_slow_down(monkeypatch):
+    """Test that 429s are retried after the server's Retry-After and lower the request rate."""
+    sleeps = []
+    monkeypatch.setattr('app.llm_client.time.sleep', sleeps.append)
+    llm = MagicMock()
+    llm.invoke.side_effect = [FakeAPIError(429, {"retry-after": "7"}), FakeAPIError(503), MagicMock(content="SPAM")]
+    client = make_client(llm)
+
+    assert client.invoke(["hello"]).content == "SPAM"
+    assert llm.invoke.call_count == 3
+    assert 7 in sleeps
+    assert 0.5 <= [s for s in sleeps if s][-1] <= 2 # Jittered backoff for the 503
+    assert client.requests.rate_per_minute < 600
+    assert client.stats()["rate_limited"] == 1
+
+def test_non_transient_errors_are_raised_unchanged(monkeypatch):
+    """Test that a bad request is not retried and does not count towards the breaker."""
+    llm = MagicMock()
+    llm.invoke.side_effect = FakeAPIError(400)
+    client = make_client(llm)
+    with pytest.raises(FakeAPIError):
+        client.invoke(["hello"])
+    assert llm.invoke.call_count == 1
+    assert client.breaker.failures == 0
+
+def test_circuit_breaker_opens_and_recovers(monkeypatch):
+    """Test that repeated outages open the breaker and a trial call closes it again."""
+    monkeypatch.setattr('app.llm_client.time.sleep', lambda s: None)
+    llm = MagicMock()
+    llm.invoke.side_effect = FakeAPIError(503)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    client = make_client(llm, max_retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(LLMUnavailableError):
+            client.invoke(["hello"])
+    assert breaker.state == "open"
+    with pytest.raises(LLMUnavailableError):
+        client.invoke(["hello"])
+    assert llm.invoke.call_count == 2 # Rejected without calling the API
+
+    breaker.reset_timeout = 0
+    llm.invoke.side_effect = None
+    llm.invoke.return_value = MagicMock(content="SPAM")
+    client.invoke(["hello"])
+    assert breaker.state == "closed"
+
+def test_async_invoke_uses_the_same_policy():
+    """Test that ainvoke retries and then raises LLMUnavailableError."""
+    llm = MagicMock()
+    async def failing(messages):
+        raise FakeAPIError(429, {"retry-after-ms": "1"})
+    llm.ainvoke.side_effect = failing
+    client = make_client(llm, max_retries=2)
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(client.ainvoke(["hello"]))
+    assert llm.ainvoke.call_count == 3
+
+def test_token_bucket_spaces_out_requests():
+    """Test that reservations beyond the budget report the wait needed."""
+    bucket = TokenBucket(rate_per_minute=60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(2, abs=0.05)
+
+def test_unavailable_llm_defers_instead_of_mislabeling(monkeypatch):
+    """Test that deferred emails are neither labelled nor stored and are fetched again later."""
+    init_db()
+    monkeypatch.setattr('app.config.settings.PARALLEL_CLASSIFICATION', False)
+    emails = [
+        {"message_id": "<ok@example.com>", "subject": "Known", "sender": "a@example.com", "body": "b", "classification": "SPAM", "uid": 5},
+        {"message_id": "<later@example.com>", "subject": "Pending", "sender": "a@example.com", "body": "Quarterly figures attached", "uid": 6},
+    ]
+    with patch('app.langgraph_agent.llm') as mock_llm:
+        mock_llm.invoke.side_effect = LLMUnavailableError("circuit open")
+        assert classify_email({"current_email": emails[1]})["classification"] == "Deferred"
+        run = run_ingest_pipeline(iter(emails))
+
+    assert get_existing_message_ids(["<ok@example.com>", "<later@example.com>"]) == {"<ok@example.com>"}
+    assert run["deferred"] == [emails[1]] and emails[1]["deferred"] is True
+    watermark = {"mailbox": "inbox", "uidvalidity": 1, "last_uid": 9, "complete": True}
+    defer_emails([emails[1]], watermark)
+    assert watermark["last_uid"] == 5
@@ -0,0 +1,48 @@
+import pytest
+
+from app.metrics import Counter, Histogram, MetricsRegistry, timed
+
+def test_histogram_renders_cumulative_buckets():
+    """Test that histograms render cumulative buckets, sum and count in the text format."""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("op_seconds", "Operation time.", ["op"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, op="read")
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP op_seconds Operation time.", "# TYPE op_seconds histogram"]
+    assert 'op_seconds_bucket{op="read",le="0.1"} 1' in lines
+    assert 'op_seconds_bucket{op="read",le="1.0"} 3' in lines
+    assert 'op_seconds_bucket{op="read",le="+Inf"} 4' in lines
+    assert 'op_seconds_count{op="read"} 4' in lines
+    assert histogram.count(op="read") == 4
+
+def test_histogram_quantile_interpolates_within_bucket():
+    """Test that quantiles are interpolated linearly within the bucket holding the rank."""
+    histogram = Histogram("t", "t", buckets=(1, 2, 4))
+    for value in (1.5, 1.5, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(1 + 2 / 3) # Rank 2 of the 3 samples in (1, 2]
+    assert 2 < histogram.quantile(0.99) <= 4
+    assert Histogram("empty", "e").quantile(0.5) is None
+
+def test_counter_labels_are_escaped_and_timed_records_calls():
+    """Test that label values are escaped and that @timed records one sample per call."""
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("errors_total", "Errors.", ["kind"]))
+    counter.inc(kind='bad "quote"')
+    counter.inc(2, kind='bad "quote"')
+    assert 'errors_total{kind="bad \\"quote\\""} 3' in registry.render()
+
+    histogram = registry.histogram("call_seconds", "Calls.")
+    decorated = timed(histogram)(lambda x: x * 2)
+    assert decorated(21) == 42
+    assert histogram.count() == 1
+
+def test_failing_callback_does_not_break_rendering():
+    """Test that a callback metric that raises is left out instead of breaking /metrics."""
+    registry = MetricsRegistry()
+    registry.callback("broken", "Raises.", lambda: 1 / 0)
+    registry.callback("answer", "Works.", lambda: {(): 42})
+    text = registry.render()
+    assert "broken" not in text
+    assert "answer 42" in text
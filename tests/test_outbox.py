@@ -0,0 +1,78 @@
+import sqlite3
+import time
+import pytest
+from unittest.mock import MagicMock, patch
+from app import database
+from app.database import claim_due_replies, init_db, store_email_data
+from app.main import run_ingest_pipeline
+from app.outbox import OutboxDispatcher
+
+REPLY = {"to_address": "client@example.com", "subject": "Appointment Confirmed", "body": "Thanks"}
+
+def fetch_all(query: str) -> list[tuple]:
+    conn = sqlite3.connect(database.DATABASE_FILE)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+def make_dispatcher(results: list[bool], max_attempts: int = 3) -> OutboxDispatcher:
+    sender = MagicMock()
+    sender.send_many.side_effect = lambda messages: results[:len(messages)]
+    return OutboxDispatcher(sender, poll_interval=1, batch_size=10, max_attempts=max_attempts,
+                            base_backoff=10, max_backoff=100, lease_seconds=60)
+
+@pytest.fixture(autouse=True)
+def db():
+    init_db()
+
+def test_reply_is_queued_once_per_message_id():
+    """Test that storing the same email twice queues a single reply."""
+    store_email_data("<m1@example.com>", "Meeting", "client@example.com", "Body", "Important", reply=REPLY)
+    store_email_data("<m1@example.com>", "Meeting", "client@example.com", "Body", "Important", reply=REPLY)
+    assert fetch_all("SELECT message_id, status FROM outbox") == [("<m1@example.com>", "pending")]
+
+def test_dispatcher_marks_sent_and_updates_email():
+    """Test that a delivered reply sets response_sent on the email."""
+    store_email_data("<m1@example.com>", "Meeting", "client@example.com", "Body", "Important", reply=REPLY)
+    dispatcher = make_dispatcher([True])
+    assert dispatcher.drain_once() == 1
+    assert fetch_all("SELECT status FROM outbox") == [("sent",)]
+    assert fetch_all("SELECT response_sent FROM emails") == [(1,)]
+    assert dispatcher.drain_once() == 0 # Nothing is sent twice
+
+def test_dispatcher_retries_with_backoff_then_gives_up():
+    """Test that failed sends are rescheduled and abandoned after max_attempts."""
+    store_email_data("<m1@example.com>", "Meeting", "client@example.com", "Body", "Important", reply=REPLY)
+    dispatcher = make_dispatcher([False], max_attempts=2)
+    dispatcher.drain_once()
+    status, attempts, next_attempt_at = fetch_all("SELECT status, attempts, next_attempt_at FROM outbox")[0]
+    assert (status, attempts) == ("pending", 1)
+    assert next_attempt_at > time.time() + 4 # At least half of the 10s base backoff
+    assert dispatcher.drain_once() == 0 # Not due yet
+
+    conn = sqlite3.connect(database.DATABASE_FILE)
+    conn.execute("UPDATE outbox SET next_attempt_at = 0")
+    conn.commit()
+    conn.close()
+    dispatcher.drain_once()
+    assert fetch_all("SELECT status, attempts FROM outbox") == [("failed", 2)]
+    assert fetch_all("SELECT response_sent FROM emails") == [(0,)]
+
+def test_expired_lease_is_reclaimed():
+    """Test that a reply claimed by a crashed dispatcher becomes due again."""
+    store_email_data("<m1@example.com>", "Meeting", "client@example.com", "Body", "Important", reply=REPLY)
+    assert len(claim_due_replies(10, lease_seconds=-1)) == 1 # Simulated crash right after claiming
+    rows = claim_due_replies(10, lease_seconds=60)
+    assert [(row[1], row[5]) for row in rows] == [("<m1@example.com>", 2)]
+    assert claim_due_replies(10, lease_seconds=60) == []
+
+def test_pipeline_queues_reply_for_important_email(monkeypatch):
+    """Test that the ingest pipeline enqueues the reply instead of sending it inline."""
+    monkeypatch.setattr('app.config.settings.PARALLEL_CLASSIFICATION', False)
+    emails = [{"message_id": "<m2@example.com>", "subject": "Meeting", "sender": "Client <client@example.com>",
+               "body": "Can we meet?", "classification": "Important"}]
+    with patch('app.langgraph_agent.outbox_dispatcher') as dispatcher:
+        run_ingest_pipeline(iter(emails))
+    dispatcher.wake.assert_called_once()
+    assert fetch_all("SELECT message_id, to_address FROM outbox") == [("<m2@example.com>", "client@example.com")]
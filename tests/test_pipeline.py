@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from app.pipeline import StagedPipeline
+
+def test_backpressure_bounds_items_in_flight():
+    """Test that a slow stage throttles the source instead of letting items pile up."""
+    pulled = []
+    stored = []
+
+    def source():
+        for i in range(2000):
+            pulled.append(i)
+            yield i
+
+    in_flight = []
+
+    def slow_store(batch):
+        in_flight.append(len(pulled) - len(stored))
+        time.sleep(0.0005)
+        stored.extend(batch)
+
+    pipeline = StagedPipeline(source(), queue_size=10)
+    pipeline.add_stage("double", lambda batch: [i * 2 for i in batch], batch_size=5)
+    pipeline.add_stage("store", slow_store, batch_size=5)
+    stages = pipeline.run()
+
+    assert stored == [i * 2 for i in range(2000)]
+    # Two queues of 10, two batches of 5 and the item the source holds
+    assert max(in_flight) <= 2 * 10 + 2 * 5 + 1
+    assert [s["stage"] for s in stages] == ["fetch", "double", "store"]
+    assert all(s["processed"] == 2000 for s in stages)
+    assert stages[2]["max_queue_depth"] <= 10
+    assert stages[2]["throughput_per_second"] > 0
+
+def test_stage_error_aborts_the_pipeline_and_closes_the_source():
+    closed = []
+
+    def source():
+        try:
+            for i in range(10000):
+                yield i
+        finally:
+            closed.append(True)
+
+    def failing(batch):
+        if 50 in batch:
+            raise ValueError("boom")
+        return batch
+
+    pipeline = StagedPipeline(source(), queue_size=4)
+    pipeline.add_stage("check", failing)
+    pipeline.add_stage("sink", lambda batch: None)
+    with pytest.raises(ValueError, match="boom"):
+        pipeline.run()
+    assert closed == [True]
+
+def test_stop_source_finishes_items_already_in_flight():
+    seen = []
+    pipeline = StagedPipeline(iter(range(100000)), queue_size=2)
+
+    def sink(batch):
+        seen.extend(batch)
+        if len(seen) >= 10:
+            pipeline.stop_source()
+
+    pipeline.add_stage("sink", sink)
+    stages = pipeline.run()
+    assert seen == list(range(len(seen)))
+    assert 10 <= len(seen) <= 10 + 3
+    assert stages[0]["processed"] == len(seen)
+
+def test_on_thread_exit_runs_on_every_stage_thread():
+    """Test that each stage thread runs the exit hook, so per-thread resources are released every run."""
+    exited = []
+    pipeline = StagedPipeline(iter(range(10)), queue_size=2, on_thread_exit=lambda: exited.append(threading.current_thread().name))
+    pipeline.add_stage("parse", lambda batch: batch)
+    pipeline.add_stage("store", lambda batch: None)
+    pipeline.run()
+    assert sorted(exited) == ["pipeline-fetch", "pipeline-parse", "pipeline-store"]
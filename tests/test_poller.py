@@ -0,0 +1,20 @@
+from app.jobs import Job
+from app.poller import MailboxPoller
+
+def finished_job(fetched: int, status: str = "completed") -> Job:
+    job = Job("inbox")
+    job.add(fetched=fetched)
+    job.status = status
+    job._done.set()
+    return job
+
+def test_interval_backs_off_when_idle_and_resets_on_mail():
+    """Test that idle or failed polls stretch the interval up to the cap and mail resets it."""
+    results = iter([finished_job(0), finished_job(0), finished_job(0, status="failed"), finished_job(0), finished_job(5)])
+    poller = MailboxPoller(submit=lambda: next(results), min_interval=10, max_interval=60, backoff_factor=2)
+
+    intervals = []
+    for _ in range(5):
+        poller.poll_once()
+        intervals.append(poller.interval)
+    assert intervals == [20, 40, 60, 60, 10]
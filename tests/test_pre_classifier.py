@@ -0,0 +1,60 @@
+import pytest
+from app.config import settings
+from app.database import init_db, store_email_data
+from app.pre_classifier import PreClassifier, pre_classify, report, train
+
+def seed_history(start: int, count: int):
+    for i in range(start, start + count):
+        if i % 3 == 0:
+            store_email_data(f"id-{i}", "WIN a FREE prize now", "promo@lottery-winner.biz",
+                             "Claim your free prize, click the link to win cash now", "SPAM", classification_source="llm")
+        elif i % 3 == 1:
+            store_email_data(f"id-{i}", "Our monthly newsletter", "news@shop.example.com",
+                             "Read the latest articles and product news from our blog", "Unwanted", classification_source="llm")
+        else:
+            store_email_data(f"id-{i}", "Contract review meeting", "client@partner.example.org",
+                             "Can we schedule a meeting to review the contract next week", "Important", classification_source="llm")
+
+@pytest.fixture
+def trained(monkeypatch):
+    monkeypatch.setattr(settings, "PRECLASSIFIER_MIN_TRAINING_EMAILS", 30)
+    init_db()
+    seed_history(0, 30)
+    return train()
+
+def test_pre_classify_settles_confident_spam(trained):
+    """Test that a clear SPAM email is classified locally."""
+    assert pre_classify("FREE prize inside", "promo@lottery-winner.biz", "Click to win your free cash prize now") == "SPAM"
+
+def test_pre_classify_never_settles_important(trained):
+    """Test that Important emails are always left to the LLM."""
+    assert pre_classify("Contract review", "client@partner.example.org", "Can we schedule a meeting about the contract") is None
+
+def test_pre_classify_idle_until_enough_history(monkeypatch, trained):
+    """Test that the model abstains while it has seen too few emails."""
+    monkeypatch.setattr(settings, "PRECLASSIFIER_MIN_TRAINING_EMAILS", 1000)
+    assert pre_classify("FREE prize inside", "promo@lottery-winner.biz", "Click to win your free cash prize now") is None
+
+def test_incremental_training_only_reads_new_emails(trained):
+    """Test that retraining picks up from the last trained email id."""
+    assert trained.trained_emails == 30
+    seed_history(30, 6)
+    model = train()
+    assert model.trained_emails == 36
+    assert PreClassifier.load(settings.PRECLASSIFIER_MODEL_PATH).last_trained_id == 36
+    assert train(full=True).trained_emails == 36
+
+def test_report_agreement(trained):
+    """Test the agreement report against stored labels."""
+    result = report()
+    assert result["evaluated"] == 30
+    assert result["agreement"] == 1.0
+    assert result["agreement_when_skipped"] == 1.0
+
+def test_training_skips_labels_the_llm_did_not_decide(trained):
+    """Test that cached, pre-classified, fallback and legacy labels never reach the model or the report."""
+    for i, source in enumerate(["cache", "preclassifier", "fallback", None]):
+        store_email_data(f"other-{i}", "Contract review meeting", "client@partner.example.org",
+                         "Can we schedule a meeting to review the contract next week", "Unwanted", classification_source=source)
+    assert train().trained_emails == 30
+    assert report()["evaluated"] == 30
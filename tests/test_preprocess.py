@@ -0,0 +1,44 @@
+from app.email_client import parse_email_message
+from app.preprocess import html_to_text, prepare_body, prompt_body, strip_quoted_reply, strip_signature, truncate_tokens
+from app.utils import estimate_tokens
+
+def test_html_to_text_drops_markup_and_scripts():
+    """Test that HTML is reduced to its visible text with block elements on separate lines."""
+    html = "<html><head><style>p {color: red}</style></head><body><p>Hello&nbsp;there</p><div>Book a <b>call</b></div><script>track()</script></body></html>"
+    assert html_to_text(html) == "Hello there\n\nBook a call"
+
+def test_strip_quoted_reply_and_signature():
+    """Test that quoted history and signatures are removed, but a fully quoted text is kept."""
+    reply = "Thanks, Tuesday works.\n\nOn Mon, 3 Jun 2024 at 10:00, Alice <alice@example.com>\nwrote:\n> Can we meet?\n> Alice"
+    assert strip_quoted_reply(reply) == "Thanks, Tuesday works."
+    outlook = "See attached.\n\nFrom: Bob\nSent: Monday\nTo: Alice\nSubject: Report\n\nOld text"
+    assert strip_quoted_reply(outlook) == "See attached."
+    assert strip_quoted_reply("> only a quote") == "> only a quote"
+    assert strip_signature("Please call me.\n-- \nBob\nCEO, Example Inc.") == "Please call me."
+    assert strip_signature("Short note\n\nSent from my iPhone") == "Short note"
+
+def test_truncate_tokens_keeps_head_and_tail():
+    """Test that long bodies are cut to the budget keeping both ends."""
+    text = "START " + "filler " * 2000 + "END"
+    truncated = truncate_tokens(text, 100)
+    assert estimate_tokens(truncated) <= 100
+    assert truncated.startswith("START") and truncated.endswith("END")
+    assert truncate_tokens("short", 100) == "short"
+
+def test_prepare_body_records_tokens_saved(monkeypatch):
+    """Test that the prompt body is bounded and the saving is recorded on the email dict."""
+    monkeypatch.setattr('app.config.settings.PROMPT_BODY_MAX_TOKENS', 50)
+    email_data = {"subject": "Thread", "body": "Latest reply\n\nOn Mon, Bob wrote:\n" + "> old line\n" * 500}
+    body = prompt_body(email_data)
+    assert body == "Latest reply"
+    assert email_data["tokens_saved"] > 1000
+    assert prepare_body("x" * 4000)[1] > 900
+
+def test_parse_email_message_falls_back_to_html_part():
+    """Test that HTML-only emails get a plain text body."""
+    raw = (
+        b"From: a@example.com\r\nSubject: Offer\r\nMessage-ID: <h1@example.com>\r\nMIME-Version: 1.0\r\n"
+        b"Content-Type: multipart/alternative; boundary=XX\r\n\r\n"
+        b"--XX\r\nContent-Type: text/html; charset=utf-8\r\n\r\n<p>Big <i>sale</i></p>\r\n--XX--\r\n"
+    )
+    assert parse_email_message(raw)["body"] == "Big sale"
@@ -0,0 +1,74 @@
+import smtplib
+import pytest
+from unittest.mock import patch
+from app.email_client import SmtpSender
+
+class FakeSMTP:
+    """Stand-in for smtplib.SMTP that records sessions and delivered messages."""
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        self.logged_in = False
+        self.fail_next_send = None
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        return 220, b'Ready'
+
+    def login(self, user, password):
+        self.logged_in = True
+        return 235, b'Authenticated'
+
+    def noop(self):
+        return 250, b'OK'
+
+    def send_message(self, msg):
+        if self.fail_next_send:
+            error, self.fail_next_send = self.fail_next_send, None
+            raise error
+        self.sent.append(msg['To'])
+
+    def quit(self):
+        return 221, b'Bye'
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def fake_smtp():
+    FakeSMTP.instances = []
+    with patch('app.email_client.smtplib.SMTP', FakeSMTP):
+        yield FakeSMTP
+
+def test_many_replies_share_one_session(fake_smtp):
+    """Test that a batch of replies is sent over a single authenticated connection."""
+    sender = SmtpSender(idle_timeout=60, max_messages_per_session=100)
+    results = sender.send_many([(f"user{i}@example.com", "Re: hi", "Thanks") for i in range(50)])
+    assert results == [True] * 50
+    assert len(fake_smtp.instances) == 1
+    assert len(fake_smtp.instances[0].sent) == 50
+
+def test_reconnects_when_server_drops_connection(fake_smtp):
+    """Test that a dropped session is reopened and the message is still delivered."""
+    sender = SmtpSender(idle_timeout=60, max_messages_per_session=100)
+    assert sender.send("a@example.com", "Re: hi", "Thanks")
+    fake_smtp.instances[0].fail_next_send = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+    assert sender.send("b@example.com", "Re: hi", "Thanks")
+    assert len(fake_smtp.instances) == 2
+    assert fake_smtp.instances[1].sent == ["b@example.com"]
+
+def test_reports_per_message_failures(fake_smtp):
+    """Test that a refused recipient fails only its own message."""
+    sender = SmtpSender(idle_timeout=60, max_messages_per_session=100)
+    sender.send("warmup@example.com", "Re: hi", "Thanks")
+    fake_smtp.instances[0].fail_next_send = smtplib.SMTPRecipientsRefused({"bad@example.com": (550, b"No such user")})
+    results = sender.send_many([("bad@example.com", "Re: hi", "Thanks"), ("good@example.com", "Re: hi", "Thanks")])
+    assert results == [False, True]
+    assert len(fake_smtp.instances) == 1
+
+def test_rotates_session_after_message_limit(fake_smtp):
+    """Test that the provider's per-connection message cap is respected."""
+    sender = SmtpSender(idle_timeout=60, max_messages_per_session=2)
+    sender.send_many([(f"user{i}@example.com", "Re: hi", "Thanks") for i in range(5)])
+    assert [len(s.sent) for s in fake_smtp.instances] == [2, 2, 1]